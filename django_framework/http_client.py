@@ -0,0 +1,134 @@
+"""
+Shared HTTP client for the external APIs we call (EIA, NREL, Google geocoding).
+
+Each process keeps one requests.Session per provider, so repeated calls (e.g. the many
+pages of an EIA query) reuse keep-alive connections instead of doing a fresh TCP/TLS
+handshake every time. Requests that fail with a connection error, a timeout or a
+retryable status code (429, 5xx) are retried with exponential backoff and jitter, waiting
+at least as long as the server's Retry-After header asks for.
+
+It lives in the project package rather than in one of the apps because both
+load_shifting and geopportunity use it. Every final response is also passed to the
+function named by the HTTP_RESPONSE_RECORDER setting, if any; load_shifting uses that to
+record EIA and NREL responses as fixtures for offline replay (see
+load_shifting/api_fixtures.py).
+"""
+
+import email.utils
+import os
+import random
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# (connect timeout, read timeout) in seconds. Can be overridden per provider with the
+# HTTP_TIMEOUTS setting.
+DEFAULT_TIMEOUTS = {
+    "eia": (5, 60),
+    "nrel": (5, 120),  # PSM3 builds the CSV for a whole year on the fly, it can be slow
+    "google": (5, 10),
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_timeout(provider):
+    timeouts = dict(DEFAULT_TIMEOUTS, **getattr(settings, "HTTP_TIMEOUTS", {}))
+    return timeouts.get(provider, (5, 30))
+
+
+def get_session(provider):
+    """
+    The pooled session for provider, in this process. Sessions aren't shared across a
+    fork (gunicorn workers, process pools), since the pooled sockets would be.
+    """
+    key = (os.getpid(), provider)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            pool_size = max(10, getattr(settings, "EIA_MAX_CONCURRENT_REQUESTS", 4))
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[key] = session
+    return session
+
+
+def _retry_after_seconds(response):
+    # Retry-After is either a number of seconds or an HTTP date
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    retry_at = email.utils.parsedate_to_datetime(value)
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def backoff_seconds(attempt, response=None):
+    """
+    How long to wait before retry number attempt (0-based): exponential backoff with "full
+    jitter", capped at HTTP_MAX_BACKOFF_SECONDS, but never shorter than Retry-After.
+    """
+    base = getattr(settings, "HTTP_BACKOFF_BASE_SECONDS", 0.5)
+    cap = getattr(settings, "HTTP_MAX_BACKOFF_SECONDS", 30)
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if response is not None:
+        retry_after = _retry_after_seconds(response)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, cap))
+    return delay
+
+
+def record_response(provider, url, request_kwargs, response):
+    recorder = getattr(settings, "HTTP_RESPONSE_RECORDER", None)
+    if recorder:
+        import_string(recorder)(provider, url, request_kwargs, response)
+
+
+def request(provider, method, url, max_retries=None, **kwargs):
+    """
+    Make an HTTP request to provider through its pooled session, retrying transient
+    failures. Returns the final requests.Response (which may still be an error status, if
+    we ran out of retries); connection errors on the last attempt are raised.
+    """
+    if max_retries is None:
+        max_retries = getattr(settings, "HTTP_MAX_RETRIES", 4)
+    kwargs.setdefault("timeout", get_timeout(provider))
+    session = get_session(provider)
+
+    attempt = 0
+    while True:
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= max_retries:
+                raise
+            delay = backoff_seconds(attempt)
+            print("{} request failed ({}), retrying in {:.1f}s".format(provider, e.__class__.__name__, delay))
+        else:
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt >= max_retries:
+                record_response(provider, url, kwargs, response)
+                return response
+            delay = backoff_seconds(attempt, response)
+            print("{} gave status code {}, retrying in {:.1f}s".format(provider, response.status_code, delay))
+            response.close()
+        time.sleep(delay)
+        attempt += 1
+
+
+def get(provider, url, **kwargs):
+    return request(provider, "GET", url, **kwargs)
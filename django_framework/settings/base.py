@@ -128,4 +128,56 @@ STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Byte budget for the per-process in-memory tier of the load_shifting data frame cache.
+# Each gunicorn worker gets its own. Set to 0 to disable.
+LOAD_SHIFTING_MEMORY_CACHE_BYTES = int(os.getenv("LOAD_SHIFTING_MEMORY_CACHE_BYTES", 256 * 1024 * 1024))
+
+# When several workers miss the cache for the same entry, one computes it and the others
+# wait. The one computing renews its lock every quarter of this; if it hasn't for this
+# many seconds (e.g. it crashed), another worker takes over.
+LOAD_SHIFTING_CACHE_FILL_LOCK_STALE_SECONDS = int(os.getenv("LOAD_SHIFTING_CACHE_FILL_LOCK_STALE_SECONDS", 600))
+
+# How many pages of one EIA API query to download at the same time.
+EIA_MAX_CONCURRENT_REQUESTS = int(os.getenv("EIA_MAX_CONCURRENT_REQUESTS", 4))
+
+# Retries for calls to external APIs (EIA, NREL, Google), see django_framework/http_client.py.
+# Per-provider (connect, read) timeouts can be overridden with HTTP_TIMEOUTS = {"eia": (5, 60), ...}
+HTTP_MAX_RETRIES = 4
+HTTP_BACKOFF_BASE_SECONDS = 0.5
+HTTP_MAX_BACKOFF_SECONDS = 30
+
+# Worker processes for per-BA loops such as the CO2 boxplot (load_shifting/parallel.py).
+# 1 means compute everything in the request's own process.
+LOAD_SHIFTING_MAX_WORKERS = int(os.getenv("LOAD_SHIFTING_MAX_WORKERS", 4))
+
+# Emission factor table used when a request doesn't pick one with ?factors=, and any
+# tables to add to the built-in ones, as {"name": {"Coal": 2.30, ...}} in pounds CO2e per
+# kWh. See load_shifting/emission_factors.py.
+LOAD_SHIFTING_EMISSION_FACTORS = os.getenv("LOAD_SHIFTING_EMISSION_FACTORS", "eia-faq-74-v1")
+LOAD_SHIFTING_EMISSION_FACTOR_TABLES = {}
+
+# How far ahead the smart HVAC algorithm looks: the name of one of
+# house_simulation.SMART_HVAC_LOOKAHEAD_KERNELS ("2h" or "1-4h-weighted") or of one added
+# here as {"name": {hours ahead: weight}}.
+LOAD_SHIFTING_SMART_HVAC_LOOKAHEAD_KERNEL = os.getenv("LOAD_SHIFTING_SMART_HVAC_LOOKAHEAD_KERNEL", "2h")
+LOAD_SHIFTING_SMART_HVAC_LOOKAHEAD_KERNELS = {}
+
+# How many house simulation results (one home over one set of weather and CO2 inputs)
+# to keep in the database cache, see load_shifting/simulation_cache.py. The least
+# recently used go first.
+LOAD_SHIFTING_SIMULATION_CACHE_MAX_ENTRIES = int(os.getenv("LOAD_SHIFTING_SIMULATION_CACHE_MAX_ENTRIES", 200))
+
+# Where the EIA and NREL APIs live. Point these at a load_shifting.api_fixtures stand-in
+# server (python manage.py serve_api_fixtures) to run without network access.
+EIA_API_URL = os.getenv("EIA_API_URL", "https://api.eia.gov/v2/electricity/rto/")
+NREL_PSM3_URL = os.getenv("NREL_PSM3_URL")  # None means pvlib's default PSM3 endpoint
+
+# If set, successful EIA and NREL responses are saved as fixtures in this directory
+# (python manage.py record_api_fixtures does this for one BA).
+API_FIXTURE_RECORD_DIR = os.getenv("API_FIXTURE_RECORD_DIR")
+
+# Called with every final response django_framework/http_client.py gets; this one does
+# the API_FIXTURE_RECORD_DIR recording.
+HTTP_RESPONSE_RECORDER = "load_shifting.api_fixtures.record_response"
+
 CSRF_TRUSTED_ORIGINS = ['https://climate-data-viz-jonoxia.koyeb.app']
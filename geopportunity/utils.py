@@ -4,10 +4,10 @@ from django.conf import settings
 import pandas as pd
 import os
 import re
-import requests
 import datetime
 import json
 from io import StringIO
+from django_framework import http_client
 from .models import GeocodingAPICache
 
 def google_geocode(address):
@@ -33,7 +33,7 @@ def google_geocode(address):
         "address": address,
         "key": api_key
     }
-    google_response = requests.get(url, params=params)
+    google_response = http_client.get("google", url, params=params)
 
     if google_response.status_code == 200:
         google_data = google_response.json()
@@ -51,7 +51,7 @@ def google_geocode(address):
 
         else:
 
-            print(f"Error: {data['error_message']}")
+            print(f"Error: {google_data.get('error_message')}")
             return 0, 0
 
     else:
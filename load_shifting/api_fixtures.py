@@ -0,0 +1,317 @@
+"""
+Record EIA and NREL API responses to compressed fixture files, and replay them from a
+local stand-in server, so that the fetch, cache and compute pipelines can be run (and
+timed) on a machine with no network and no API keys.
+
+Recording: while record_api_fixtures(directory) is active, or when the
+API_FIXTURE_RECORD_DIR environment variable / setting is set, every successful EIA or
+NREL response that goes through django_framework.http_client is saved under that directory:
+
+    eia/<url_segment>/<frequency>/<hash of the X-Params>.json.gz   the page's data rows
+    nrel/<hash of the query>.json.gz                               the PSM3 CSV
+
+API keys and the NREL contact fields are never written to the fixtures.
+
+Replay: FixtureServer answers EIA rto/*/data queries from the union of all the rows
+recorded for that url_segment and frequency, filtered by the query's facets and dates,
+sorted by period and paginated with offset/length like the real API. So a recording of
+e.g. CISO and its neighbors can serve any subset of those BAs, any sub-range of the dates
+and any page size. PSM3 queries are matched exactly. Optional latency (per request and
+per thousand rows) makes timings look more like the real thing.
+
+    with replay_api_fixtures("path/to/fixtures", latency_seconds=0.2):
+        compute_hourly_consumption_by_source_ba("CISO", start_date, end_date)
+
+points EIA_API_URL and NREL_PSM3_URL at a server running in a background thread.
+"""
+
+import contextlib
+import glob
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+from django.conf import settings
+
+
+# Same page size limit as the real EIA API
+EIA_MAX_PAGE_LENGTH = 5000
+
+# PSM3 query parameters that identify the person asking rather than the data
+NREL_IDENTITY_PARAMS = ["api_key", "email", "full_name", "affiliation", "reason", "mailing_list"]
+
+_record_directory = None
+
+
+def recording_directory():
+    if _record_directory is not None:
+        return _record_directory
+    directory = os.getenv("API_FIXTURE_RECORD_DIR")
+    if directory is None:
+        directory = getattr(settings, "API_FIXTURE_RECORD_DIR", None)
+    return directory
+
+
+@contextlib.contextmanager
+def record_api_fixtures(directory):
+    global _record_directory
+    previous_directory = _record_directory
+    _record_directory = directory
+    try:
+        yield directory
+    finally:
+        _record_directory = previous_directory
+
+
+def _hash_json(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _write_gzip_json(path, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename, so a replay server never sees a half written file
+    temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with gzip.open(temp_path, "wt", encoding="utf-8") as outfile:
+        json.dump(value, outfile)
+    os.replace(temp_path, path)
+
+
+def _read_gzip_json(path):
+    with gzip.open(path, "rt", encoding="utf-8") as infile:
+        return json.load(infile)
+
+
+def eia_url_segment(url):
+    # .../electricity/rto/<url_segment>/data/
+    path_parts = [part for part in urlsplit(url).path.split("/") if part]
+    return path_parts[-2]
+
+
+def nrel_request_key(url, params):
+    query = {key: str(value) for key, value in params.items() if not key in NREL_IDENTITY_PARAMS}
+    return {"endpoint": urlsplit(url).path.rstrip("/").split("/")[-1], "query": query}
+
+
+def write_eia_fixture(directory, url_segment, eia_params, rows):
+    frequency = eia_params.get("frequency", "daily")
+    path = os.path.join(directory, "eia", url_segment, frequency, _hash_json(eia_params) + ".json.gz")
+    _write_gzip_json(path, {"request": eia_params, "rows": rows})
+    return path
+
+
+def write_nrel_fixture(directory, url, params, body):
+    request_key = nrel_request_key(url, params)
+    path = os.path.join(directory, "nrel", _hash_json(request_key) + ".json.gz")
+    _write_gzip_json(path, {"request": request_key, "body": body})
+    return path
+
+
+def record_response(provider, url, request_kwargs, response):
+    """
+    Called by http_client for every response while recording. Only successful EIA and
+    NREL responses are kept.
+    """
+    directory = recording_directory()
+    if directory is None or response.status_code != 200:
+        return None
+    if provider == "eia":
+        eia_params = json.loads(request_kwargs.get("headers", {}).get("X-Params", "{}"))
+        response_content = response.json()
+        if "response" in response_content:
+            response_content = response_content["response"]
+        return write_eia_fixture(directory, eia_url_segment(url), eia_params, response_content.get("data", []))
+    if provider == "nrel":
+        params = dict(request_kwargs.get("params") or {})
+        params.update(parse_qsl(urlsplit(url).query))
+        return write_nrel_fixture(directory, url, params, response.content.decode("utf-8"))
+    return None
+
+
+def eia_period_key(period):
+    # "2024-04-30T10-07" -> "2024-04-30T10": the hour on the period's own clock (the UTC
+    # offset isn't part of what EIA compares). Daily periods stay as they are.
+    return str(period)[:13]
+
+
+def eia_bound_key(bound, period_key):
+    """
+    A query's start or end, comparable with period_key. Like the real API, a bare date
+    on hourly data means the first hour of that day (so end=2024-04-30 stops at
+    2024-04-30T00), and an hour bound on daily data means its day.
+    """
+    bound = str(bound)
+    if len(period_key) <= 10:
+        return bound[:10]
+    if len(bound) <= 10:
+        return bound[:10] + "T00"
+    return bound[:13]
+
+
+class FixtureStore:
+    """
+    The recorded fixtures in one directory. Files are loaded the first time they're
+    needed and kept in memory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._eia_rows = {}
+        self._nrel_bodies = None
+        self._lock = threading.Lock()
+
+    def eia_rows(self, url_segment, frequency):
+        # All the distinct rows recorded for this url_segment and frequency, in any query
+        with self._lock:
+            key = (url_segment, frequency)
+            if not key in self._eia_rows:
+                rows_by_identity = {}
+                pattern = os.path.join(self.directory, "eia", url_segment, frequency, "*.json.gz")
+                for path in sorted(glob.glob(pattern)):
+                    for row in _read_gzip_json(path)["rows"]:
+                        identity = tuple(sorted((column, str(value)) for column, value in row.items() if column != "value"))
+                        rows_by_identity[identity] = row
+                self._eia_rows[key] = list(rows_by_identity.values())
+            return self._eia_rows[key]
+
+    def eia_query(self, url_segment, eia_params):
+        """
+        Rows matching the query's facets and start/end (inclusive, compared hour by hour
+        for hourly data, see eia_bound_key), sorted by period like the real API (only "period" sorting is supported). Returns (total, page rows).
+        """
+        rows = self.eia_rows(url_segment, eia_params.get("frequency", "daily"))
+        facets = eia_params.get("facets", {})
+        start = eia_params.get("start")
+        end = eia_params.get("end")
+
+        def matches(row):
+            for column, values in facets.items():
+                if not str(row.get(column)) in [str(value) for value in values]:
+                    return False
+            period = eia_period_key(row.get("period"))
+            return (start is None or period >= eia_bound_key(start, period)) and \
+                (end is None or period <= eia_bound_key(end, period))
+
+        matching_rows = [row for row in rows if matches(row)]
+        for sort in reversed(eia_params.get("sort", [])):
+            matching_rows.sort(key=lambda row: str(row.get(sort["column"])), reverse=sort.get("direction") == "desc")
+
+        offset = int(eia_params.get("offset", 0))
+        length = min(int(eia_params.get("length", EIA_MAX_PAGE_LENGTH)), EIA_MAX_PAGE_LENGTH)
+        return len(matching_rows), matching_rows[offset:offset + length]
+
+    def nrel_body(self, url, params):
+        with self._lock:
+            if self._nrel_bodies is None:
+                self._nrel_bodies = {}
+                for path in glob.glob(os.path.join(self.directory, "nrel", "*.json.gz")):
+                    fixture = _read_gzip_json(path)
+                    self._nrel_bodies[_hash_json(fixture["request"])] = fixture["body"]
+        return self._nrel_bodies.get(_hash_json(nrel_request_key(url, params)))
+
+
+class FixtureRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real APIs, so http_client's connection pooling is exercised
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if "/rto/" in self.path:
+            self.reply_eia()
+        else:
+            self.reply_nrel()
+
+    def reply_eia(self):
+        eia_params = json.loads(self.headers.get("X-Params", "{}"))
+        total, rows = self.server.fixture_store.eia_query(eia_url_segment(self.path), eia_params)
+        self.server.simulate_latency(len(rows))
+        self.send_body(200, "application/json", json.dumps({
+            "response": {
+                "total": str(total),
+                "frequency": eia_params.get("frequency"),
+                "description": "Replayed from recorded fixtures",
+                "data": rows,
+            },
+            "request": {"params": eia_params},
+        }))
+
+    def reply_nrel(self):
+        params = dict(parse_qsl(urlsplit(self.path).query))
+        body = self.server.fixture_store.nrel_body(self.path, params)
+        self.server.simulate_latency(0)
+        if body is None:
+            self.send_body(404, "application/json", json.dumps({"errors": ["No recorded fixture for this query"]}))
+        else:
+            self.send_body(200, "text/csv", body)
+
+    def send_body(self, status, content_type, body):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FixtureServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, directory, host="127.0.0.1", port=0, latency_seconds=0, seconds_per_thousand_rows=0):
+        super().__init__((host, port), FixtureRequestHandler)
+        self.fixture_store = FixtureStore(directory)
+        self.latency_seconds = latency_seconds
+        self.seconds_per_thousand_rows = seconds_per_thousand_rows
+
+    def simulate_latency(self, row_count):
+        delay = self.latency_seconds + self.seconds_per_thousand_rows * row_count / 1000
+        if delay > 0:
+            time.sleep(delay)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def api_urls(self):
+        # Values for the EIA_API_URL and NREL_PSM3_URL settings that point at this server
+        return {
+            "EIA_API_URL": self.base_url + "/v2/electricity/rto/",
+            "NREL_PSM3_URL": self.base_url + "/api/nsrdb/v2/solar/psm3-2-2-download.csv",
+        }
+
+
+@contextlib.contextmanager
+def replay_api_fixtures(directory, latency_seconds=0, seconds_per_thousand_rows=0):
+    """
+    Serve the fixtures in directory from a background thread and point the EIA and NREL
+    calls at it (through environment variables, which take precedence over settings).
+    Placeholder API keys are set if there aren't any, since the stand-in doesn't check them.
+    """
+    server = FixtureServer(directory, latency_seconds=latency_seconds,
+                           seconds_per_thousand_rows=seconds_per_thousand_rows)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    environment = dict(server.api_urls())
+    for key_name in ["EIA_API_KEY", "NREL_API_KEY", "NREL_API_EMAIL"]:
+        if os.getenv(key_name) is None and getattr(settings, key_name, None) is None:
+            environment[key_name] = "fixture-replay"
+    previous_environment = {name: os.environ.get(name) for name in environment}
+    os.environ.update(environment)
+    try:
+        yield server
+    finally:
+        for name, value in previous_environment.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -0,0 +1,598 @@
+"""
+Storage helpers for the all-purpose data frame cache (see cache_csv in utils.py).
+
+Cached frames used to be stored as CSV text, which meant every cache hit had to
+re-parse the whole CSV, and dtypes and the index got lost on the way (hence the
+"Unnamed: 0" workarounds). Frames are now stored in a small columnar binary format:
+
+    b"LSFRAME1" | header length (4 bytes, little-endian) | JSON header | column buffers
+
+The JSON header describes every column (name, dtype, timezone, byte offset) and the
+index. Numeric, boolean and datetime columns are stored as raw numpy buffers, so
+reading them back is a memcpy. String columns are dictionary-encoded (like Arrow's
+dictionary arrays): the header holds the distinct strings and the buffer holds the
+integer codes. Anything else (e.g. a column of Timestamps with mixed UTC offsets)
+falls back to pickle for that one column.
+
+Unpickling runs whatever the pickle says to, so this assumes the cache table is only
+ever written by this app: anyone who can write AllPurposeCSVCache rows can run code in
+it. Never load frame_data from anywhere else (a copied database, a fixture someone sent).
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import pickle
+import random
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+import pytz
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from .models import AllPurposeCSVCache, CacheFillLock
+
+
+FRAME_FORMAT_MAGIC = b"LSFRAME1"
+_HEADER_LENGTH = struct.Struct("<I")
+
+
+def _canonical_datetime(value):
+    # Dates and naive datetimes get stored by Django as UTC midnight/UTC wall time (USE_TZ
+    # with TIME_ZONE = "UTC"), so normalize them the same way to get one key per row.
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime(year=value.year, month=value.month, day=value.day)
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return value.astimezone(datetime.timezone.utc).isoformat()
+
+
+def canonical_cache_key(function_name, key_params, start_date, end_date):
+    """
+    Stable sha256 hex digest identifying one cache entry. key_params is a dict (or the
+    key_params_json string stored on the row); keys are sorted so that the same params
+    passed in a different order map to the same entry.
+    """
+    if isinstance(key_params, str):
+        key_params = json.loads(key_params)
+    canonical_json = json.dumps({
+        "function": function_name,
+        "params": key_params,
+        "start_date": _canonical_datetime(start_date),
+        "end_date": _canonical_datetime(end_date),
+    }, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical_json.encode("utf-8")).hexdigest()
+
+
+def canonical_params_key(function_name, key_params):
+    """
+    Like canonical_cache_key() but without the dates: identifies a series whose cache
+    entries may cover different date ranges.
+    """
+    if isinstance(key_params, str):
+        key_params = json.loads(key_params)
+    canonical_json = json.dumps({
+        "function": function_name,
+        "params": key_params,
+    }, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical_json.encode("utf-8")).hexdigest()
+
+
+def _tz_to_json(tz):
+    if tz is None:
+        return None
+    if isinstance(tz, pytz.tzinfo.BaseTzInfo) or tz is pytz.utc:
+        return {"pytz": tz.zone}
+    if isinstance(tz, pytz._FixedOffset):
+        return {"pytz_offset_minutes": int(tz.utcoffset(None).total_seconds() // 60)}
+    if isinstance(tz, datetime.timezone):
+        if tz is datetime.timezone.utc:
+            return {"utc": True}
+        return {"offset_seconds": int(tz.utcoffset(None).total_seconds())}
+    if hasattr(tz, "key"):
+        # zoneinfo.ZoneInfo
+        return {"zoneinfo": tz.key}
+    return {"name": str(tz)}
+
+
+def _tz_from_json(tz_json):
+    if tz_json is None:
+        return None
+    if "pytz" in tz_json:
+        return pytz.timezone(tz_json["pytz"])
+    if "pytz_offset_minutes" in tz_json:
+        return pytz.FixedOffset(tz_json["pytz_offset_minutes"])
+    if "utc" in tz_json:
+        return datetime.timezone.utc
+    if "offset_seconds" in tz_json:
+        return datetime.timezone(datetime.timedelta(seconds=tz_json["offset_seconds"]))
+    if "zoneinfo" in tz_json:
+        import zoneinfo
+        return zoneinfo.ZoneInfo(tz_json["zoneinfo"])
+    return tz_json["name"]
+
+
+def _is_string_column(values):
+    # True if every non-null entry is a str, so we can dictionary-encode the column
+    non_null = values[pd.notna(values)]
+    return all(isinstance(x, str) for x in non_null)
+
+
+def _encode_array(name, values, buffers, offset):
+    """
+    Append the raw bytes for one column (or index level) to buffers and return the
+    JSON spec describing how to read it back.
+    """
+    spec = {"name": name}
+    dtype = values.dtype
+
+    if isinstance(dtype, pd.CategoricalDtype):
+        categories = values.array.categories
+        codes = np.asarray(values.array.codes)
+        spec["kind"] = "category"
+        spec["ordered"] = bool(dtype.ordered)
+        spec["categories"] = _encode_array(None, pd.Series(categories), buffers, offset)
+        offset = spec["categories"]["offset"] + spec["categories"]["nbytes"]
+        raw = np.ascontiguousarray(codes).tobytes()
+        spec["dtype"] = codes.dtype.str
+    elif isinstance(dtype, pd.DatetimeTZDtype):
+        spec["kind"] = "datetime"
+        spec["tz"] = _tz_to_json(dtype.tz)
+        spec["unit"] = dtype.unit
+        raw = np.ascontiguousarray(values.array.asi8).tobytes()
+        spec["dtype"] = "<i8"
+    elif dtype == object:
+        object_values = np.asarray(values, dtype=object)
+        if _is_string_column(object_values):
+            codes, uniques = pd.factorize(object_values, use_na_sentinel=True)
+            spec["kind"] = "string"
+            spec["uniques"] = list(uniques)
+            spec["null_is_none"] = any(x is None for x in object_values)
+            codes = codes.astype(np.int32)
+            spec["dtype"] = codes.dtype.str
+            raw = codes.tobytes()
+        else:
+            spec["kind"] = "pickle"
+            spec["dtype"] = "|u1"
+            raw = pickle.dumps(object_values, protocol=pickle.HIGHEST_PROTOCOL)
+    elif isinstance(dtype, np.dtype):
+        spec["kind"] = "numpy"
+        spec["dtype"] = dtype.str
+        raw = np.ascontiguousarray(np.asarray(values)).tobytes()
+    else:
+        # Extension types we don't special-case (nullable ints, etc.)
+        spec["kind"] = "pickle"
+        spec["dtype"] = "|u1"
+        raw = pickle.dumps(values.array, protocol=pickle.HIGHEST_PROTOCOL)
+
+    spec["offset"] = offset
+    spec["nbytes"] = len(raw)
+    buffers.append(raw)
+    return spec
+
+
+def _decode_array(spec, payload):
+    start = spec["offset"]
+    raw = payload[start:start + spec["nbytes"]]
+    kind = spec["kind"]
+
+    if kind == "pickle":
+        return pickle.loads(raw)
+
+    # np.frombuffer gives a read-only view of the payload, copy so the frame owns its data
+    values = np.frombuffer(raw, dtype=np.dtype(spec["dtype"])).copy()
+
+    if kind == "numpy":
+        return values
+    if kind == "string":
+        null_value = None if spec["null_is_none"] else np.nan
+        uniques = np.array(spec["uniques"], dtype=object)
+        if len(uniques) == 0:
+            return np.full(len(values), null_value, dtype=object)
+        decoded = uniques.take(values, mode="clip")
+        decoded[values < 0] = null_value
+        return decoded
+    if kind == "datetime":
+        utc_times = pd.DatetimeIndex(values.view("M8[{}]".format(spec["unit"]))).tz_localize("UTC")
+        return utc_times.tz_convert(_tz_from_json(spec["tz"])).array
+    if kind == "category":
+        categories = _decode_array(spec["categories"], payload)
+        return pd.Categorical.from_codes(values, categories=categories, ordered=spec["ordered"])
+    raise ValueError("Unknown column kind {} in cached frame".format(kind))
+
+
+def serialize_frame(df):
+    """
+    Convert a data frame into the LSFRAME1 binary format described above.
+    """
+    buffers = []
+    offset = 0
+
+    column_specs = []
+    for position in range(df.shape[1]):
+        spec = _encode_array(df.columns[position], df.iloc[:, position], buffers, offset)
+        offset = spec["offset"] + spec["nbytes"]
+        column_specs.append(spec)
+
+    index = df.index
+    if isinstance(index, pd.RangeIndex):
+        index_spec = {"kind": "range", "start": index.start, "stop": index.stop,
+                      "step": index.step, "name": index.name}
+    else:
+        levels = []
+        for level in range(index.nlevels):
+            level_values = index.get_level_values(level)
+            spec = _encode_array(level_values.name, level_values, buffers, offset)
+            offset = spec["offset"] + spec["nbytes"]
+            if isinstance(level_values, pd.DatetimeIndex) and level_values.freq is not None:
+                spec["freq"] = level_values.freqstr
+            levels.append(spec)
+        index_spec = {"kind": "levels", "levels": levels}
+
+    header = json.dumps({
+        "columns": column_specs,
+        "index": index_spec,
+        "length": len(df),
+    }).encode("utf-8")
+    return b"".join([FRAME_FORMAT_MAGIC, _HEADER_LENGTH.pack(len(header)), header] + buffers)
+
+
+def deserialize_frame(data):
+    """
+    Inverse of serialize_frame(). Round-trips dtypes, the index and timezones exactly.
+    """
+    data = bytes(data)
+    if not data.startswith(FRAME_FORMAT_MAGIC):
+        raise ValueError("Not a cached frame (bad magic bytes)")
+    header_start = len(FRAME_FORMAT_MAGIC) + _HEADER_LENGTH.size
+    (header_length,) = _HEADER_LENGTH.unpack_from(data, len(FRAME_FORMAT_MAGIC))
+    header = json.loads(data[header_start:header_start + header_length])
+    payload = memoryview(data)[header_start + header_length:]
+
+    index_spec = header["index"]
+    if index_spec["kind"] == "range":
+        index = pd.RangeIndex(index_spec["start"], index_spec["stop"], index_spec["step"],
+                              name=index_spec["name"])
+    else:
+        levels = []
+        for spec in index_spec["levels"]:
+            if "freq" in spec:
+                levels.append(pd.DatetimeIndex(_decode_array(spec, payload), name=spec["name"], freq=spec["freq"]))
+            else:
+                levels.append(pd.Index(_decode_array(spec, payload), name=spec["name"]))
+        index = levels[0] if len(levels) == 1 else pd.MultiIndex.from_arrays(levels)
+
+    columns = [spec["name"] for spec in header["columns"]]
+    data_by_position = {
+        position: _decode_array(spec, payload) for position, spec in enumerate(header["columns"])
+    }
+    df = pd.DataFrame(data_by_position, index=index, copy=False)
+    if len(columns) == 0:
+        df = pd.DataFrame(index=index)
+    df.columns = pd.Index(columns, dtype=object)
+    return df
+
+
+def read_legacy_csv(raw_csv):
+    """
+    Parse a cache row written before the binary format existed. The result has the
+    same shape those rows always had (index written out as an "Unnamed: 0" column,
+    see fix_timestamp_index).
+    """
+    return pd.read_csv(StringIO(raw_csv))
+
+
+def read_cache_row(cache_row):
+    """
+    Return the data frame stored in an AllPurposeCSVCache row. Legacy CSV rows are
+    converted to the binary format the first time they are read, so each old row
+    pays the CSV parsing cost at most once.
+    """
+    if cache_row.frame_data is not None:
+        return deserialize_frame(cache_row.frame_data)
+
+    cached_df = read_legacy_csv(cache_row.raw_csv)
+    cache_row.frame_data = serialize_frame(cached_df)
+    cache_row.raw_csv = ""
+    cache_row.save(update_fields=["frame_data", "raw_csv"])
+    return cached_df
+
+
+def lookup_cached_frame(key_hash):
+    """
+    Return the cached frame for key_hash, or None. One indexed query.
+    """
+    cache_row = AllPurposeCSVCache.objects.filter(key_hash=key_hash).first()
+    if cache_row is None:
+        return None
+    return read_cache_row(cache_row)
+
+
+def store_cached_frame(function_name, key_params, start_date, end_date, df, key_hash=None):
+    """
+    Insert or replace the cache row for these arguments in a single upsert statement, so
+    two processes filling the same entry can't leave duplicate rows behind.
+    """
+    if key_hash is None:
+        key_hash = canonical_cache_key(function_name, key_params, start_date, end_date)
+    AllPurposeCSVCache.objects.bulk_create(
+        [AllPurposeCSVCache(
+            cache_function_name = function_name,
+            cached_date = timezone.now(),
+            key_params_json = json.dumps(key_params),
+            start_date = start_date,
+            end_date = end_date,
+            raw_csv = "",
+            frame_data = serialize_frame(df),
+            key_hash = key_hash,
+            params_hash = canonical_params_key(function_name, key_params))],
+        update_conflicts=True,
+        unique_fields=["key_hash"],
+        update_fields=["cached_date", "key_params_json", "start_date", "end_date", "raw_csv", "frame_data",
+                       "params_hash"])
+    return key_hash
+
+
+def as_date(value):
+    if isinstance(value, datetime.datetime):
+        if timezone.is_aware(value):
+            value = value.astimezone(datetime.timezone.utc)
+        return value.date()
+    return value
+
+
+def find_cache_rows_for_range(function_name, key_params, start_date, end_date):
+    """
+    Find cache entries of the same series (same function and params, any dates) that
+    could help answer a request for start_date..end_date.
+
+    Returns (covering_row, touching_rows): covering_row is an entry whose range contains
+    the whole request (or None), touching_rows are entries that overlap the request or
+    sit right next to it, so they can be merged with freshly fetched gaps.
+    Dates are compared at day granularity.
+    """
+    params_hash = canonical_params_key(function_name, key_params)
+    start_day = as_date(start_date)
+    end_day = as_date(end_date)
+
+    series_rows = AllPurposeCSVCache.objects.filter(params_hash=params_hash)
+    covering_row = series_rows.filter(
+        start_date__date__lte=start_day, end_date__date__gte=end_day).order_by("-cached_date").first()
+    if covering_row is not None:
+        return covering_row, []
+
+    touching_rows = list(series_rows.filter(
+        start_date__date__lte=end_day + datetime.timedelta(days=1),
+        end_date__date__gte=start_day - datetime.timedelta(days=1)).order_by("start_date"))
+    return None, touching_rows
+
+
+def missing_date_ranges(start_date, end_date, covered_ranges):
+    """
+    Given the requested range and a list of (start, end) ranges already cached, return the
+    list of (start, end) date ranges, inclusive at day granularity, that still need fetching.
+    """
+    gaps = []
+    next_needed_day = as_date(start_date)
+    end_day = as_date(end_date)
+    for covered_start, covered_end in sorted((as_date(s), as_date(e)) for s, e in covered_ranges):
+        if covered_start > next_needed_day:
+            gaps.append((next_needed_day, min(covered_start - datetime.timedelta(days=1), end_day)))
+        next_needed_day = max(next_needed_day, covered_end + datetime.timedelta(days=1))
+        if next_needed_day > end_day:
+            break
+    if next_needed_day <= end_day:
+        gaps.append((next_needed_day, end_day))
+    return gaps
+
+
+def replace_cached_frames(old_rows, function_name, key_params, start_date, end_date, df):
+    """
+    Store df as the single entry for start_date..end_date, dropping the old entries it was
+    merged from.
+    """
+    with transaction.atomic():
+        key_hash = canonical_cache_key(function_name, key_params, start_date, end_date)
+        AllPurposeCSVCache.objects.filter(
+            id__in=[row.id for row in old_rows]).exclude(key_hash=key_hash).delete()
+        return store_cached_frame(function_name, key_params, start_date, end_date, df, key_hash=key_hash)
+
+
+# How long a cache fill may hold its lock before other processes consider it abandoned
+# (e.g. the worker was killed mid-request) and take over.
+CACHE_FILL_LOCK_STALE_SECONDS = getattr(settings, "LOAD_SHIFTING_CACHE_FILL_LOCK_STALE_SECONDS", 600)
+CACHE_FILL_LOCK_POLL_SECONDS = 0.5
+# How often the process holding a lock refreshes its acquired_at while it's computing, so
+# a long but healthy fill never looks stale
+CACHE_FILL_LOCK_HEARTBEAT_SECONDS = CACHE_FILL_LOCK_STALE_SECONDS / 4
+
+
+def _lock_owner():
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(), threading.get_ident())
+
+
+def _try_acquire_fill_lock(lock_key, owner):
+    try:
+        with transaction.atomic():
+            CacheFillLock.objects.create(lock_key=lock_key, owner=owner, acquired_at=timezone.now())
+        return True
+    except IntegrityError:
+        return False
+
+
+class _FillLockHeartbeat:
+    """
+    Background thread that touches our lock row's acquired_at every
+    CACHE_FILL_LOCK_HEARTBEAT_SECONDS until stopped. Only a holder that has died stops
+    doing this, so only its lock goes stale.
+    """
+
+    def __init__(self, lock_key, owner):
+        self.lock_key = lock_key
+        self.owner = owner
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        try:
+            while not self._stopped.wait(CACHE_FILL_LOCK_HEARTBEAT_SECONDS):
+                CacheFillLock.objects.filter(lock_key=self.lock_key, owner=self.owner).update(acquired_at=timezone.now())
+        finally:
+            # This thread's own database connection
+            connection.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+
+def _wait_for_fill_lock(lock_key):
+    """
+    Block until whoever holds lock_key releases it. If the lock's holder stops renewing it
+    (see _FillLockHeartbeat) for CACHE_FILL_LOCK_STALE_SECONDS, delete it so that someone
+    can take over.
+    """
+    while True:
+        lock = CacheFillLock.objects.filter(lock_key=lock_key).first()
+        if lock is None:
+            return
+        lock_age = (timezone.now() - lock.acquired_at).total_seconds()
+        if lock_age > CACHE_FILL_LOCK_STALE_SECONDS:
+            print("Cache fill lock {} held by {} not renewed for {:.0f}s, taking over".format(lock_key, lock.owner, lock_age))
+            # Only delete the exact lock we saw, in case someone else took over already
+            CacheFillLock.objects.filter(id=lock.id, acquired_at=lock.acquired_at).delete()
+            return
+        # Jitter so that a crowd of waiting workers doesn't poll in lockstep
+        time.sleep(CACHE_FILL_LOCK_POLL_SECONDS * (0.5 + random.random()))
+
+
+def run_single_flight(lock_key, lookup, compute):
+    """
+    Coalesce cache misses for the same entry across threads and processes (all the
+    gunicorn workers share the database).
+
+    lookup() returns the cached frame or None; compute() does the expensive work, stores the
+    result in the cache and returns it. The first caller to miss takes a CacheFillLock row
+    and runs compute(); everyone else waits for the lock row to disappear and then reads
+    the freshly cached result with lookup(). The leader keeps its lock fresh while it
+    works, however long that takes; if it fails, or dies and its lock goes stale, one of
+    the followers becomes the new leader.
+    """
+    owner = _lock_owner()
+    while True:
+        if _try_acquire_fill_lock(lock_key, owner):
+            try:
+                # Someone may have filled the cache between our miss and getting the lock
+                result_df = lookup()
+                if result_df is None:
+                    with _FillLockHeartbeat(lock_key, owner):
+                        result_df = compute()
+                return result_df
+            finally:
+                CacheFillLock.objects.filter(lock_key=lock_key, owner=owner).delete()
+
+        _wait_for_fill_lock(lock_key)
+        result_df = lookup()
+        if result_df is not None:
+            return result_df
+
+
+class FrameMemoryCache:
+    """
+    Per-process LRU cache of data frames, sitting in front of the database cache so that
+    repeat requests served by the same gunicorn worker don't go back to SQLite and
+    deserialize the same frame again.
+
+    Frames are copied on the way in and on the way out, so callers that modify their
+    result in place (fix_timestamp_index, set_index(inplace=True), adding columns...)
+    can never corrupt the cached copy. A deep copy of a frame is a memcpy, which is
+    still far cheaper than a database round-trip plus deserializing.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (frame, size in bytes)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def frame_size(df):
+        return int(df.memory_usage(index=True, deep=True).sum())
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            cached_df = entry[0]
+        return cached_df.copy(deep=True)
+
+    def put(self, key, df):
+        size = self.frame_size(df)
+        if size > self.max_bytes:
+            # Wouldn't fit even in an empty cache, don't evict everything else for it.
+            return
+        cached_df = df.copy(deep=True)
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (cached_df, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            }
+
+
+# One per process. Set LOAD_SHIFTING_MEMORY_CACHE_BYTES = 0 in settings to turn it off.
+frame_memory_cache = FrameMemoryCache(
+    getattr(settings, "LOAD_SHIFTING_MEMORY_CACHE_BYTES", 256 * 1024 * 1024))
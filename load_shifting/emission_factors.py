@@ -0,0 +1,105 @@
+"""
+Emission factor tables: pounds of CO2e per kWh generated, by fuel type.
+
+Cached frames hold only physical quantities (MWh by time, BA and fuel type); emissions
+are worked out when the data is read, by looking up each fuel type's factor in one of
+these tables. So switching or comparing tables costs a multiply rather than refetching
+and recomputing the usage.
+
+Tables are named with a version, and a table is never changed once it's been used:
+anything materialized with it (HourlyCO2Intensity rows, rollup cells, the boxplot cache)
+is keyed by its name. To change factors, add a table under a new name, e.g.
+"eia-faq-74-v2" with Other set to 0 if "Other" turns out to be mostly batteries.
+
+Besides the built-in tables, more (e.g. eGRID's fuel-specific output emission rates for
+a given year) can be added with the LOAD_SHIFTING_EMISSION_FACTOR_TABLES setting,
+{"name": {"Coal": 2.2, ...}}, and the default picked with LOAD_SHIFTING_EMISSION_FACTORS.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+
+EMISSION_FACTOR_TABLES = {
+    # From https://www.eia.gov/tools/faqs/faq.php?id=74&t=11
+    # estimates of CO2e per kwh for fossil fuels:
+    "eia-faq-74-v1": {
+        "COL": 2.30,
+        "NG": 0.97,
+        "OIL": 2.38,
+        "NUC": 0,
+        "SUN": 0,
+        "WAT": 0,
+        "WND": 0,
+        "OTH": 0.86, # from EIA's "average across all power sources", shrug emoji
+        "Hydro": 0,
+        "Solar": 0,
+        "Petroleum": 2.38,
+        "Nuclear": 0,
+        "Natural gas": 0.97,
+        "Wind": 0,
+        "Coal": 2.30,
+        "Other": 0.86,
+    },
+}
+
+DEFAULT_EMISSION_FACTORS = "eia-faq-74-v1"
+
+
+class UnknownEmissionFactors(Exception):
+    pass
+
+
+def emission_factor_tables():
+    # The built-in tables plus any from settings
+    tables = dict(EMISSION_FACTOR_TABLES)
+    tables.update(getattr(settings, "LOAD_SHIFTING_EMISSION_FACTOR_TABLES", {}))
+    return tables
+
+
+def default_emission_factors():
+    name = os.getenv("LOAD_SHIFTING_EMISSION_FACTORS")
+    if name is None:
+        name = getattr(settings, "LOAD_SHIFTING_EMISSION_FACTORS", DEFAULT_EMISSION_FACTORS)
+    return name
+
+
+def emission_factor_table(name=None):
+    """
+    The {fuel type: pounds CO2e per kWh} table called name (default: the configured
+    default table).
+    """
+    if name is None:
+        name = default_emission_factors()
+    tables = emission_factor_tables()
+    if not name in tables:
+        raise UnknownEmissionFactors("No emission factor table called {!r}; there's {}".format(
+            name, ", ".join(sorted(tables))))
+    return tables[name]
+
+
+def emission_factors_for(fuels, name=None):
+    # Array of factors lined up with fuels. KeyError for a fuel type the table doesn't have.
+    table = emission_factor_table(name)
+    return np.array([table[fuel] for fuel in fuels], dtype=np.float64)
+
+
+def apply_emission_factors(usage_df, name=None, fuel_column="generation_type", usage_column="Usage (MWh)"):
+    """
+    Copy of usage_df (MWh by fuel type) with emissions_per_kwh and emissions (pounds)
+    columns. The factors are looked up once per fuel type category, not per row.
+    """
+    fuels = usage_df[fuel_column]
+    if not isinstance(fuels.dtype, pd.CategoricalDtype):
+        fuels = fuels.astype("category")
+    factors = emission_factors_for(fuels.cat.categories.astype(str), name)
+    # Code -1 (missing fuel type) picks the NaN on the end
+    emissions_per_kwh = np.append(factors, np.nan)[fuels.cat.codes.to_numpy()]
+
+    with_emissions = usage_df.copy()
+    with_emissions["emissions_per_kwh"] = emissions_per_kwh
+    with_emissions["emissions"] = emissions_per_kwh * with_emissions[usage_column].to_numpy(dtype=np.float64) * 1000
+    return with_emissions
@@ -0,0 +1,173 @@
+"""
+Dense array version of the import/export fuel mix calculation.
+
+Timestamps, source BAs and fuel types are mapped to integer axes, and the data goes into
+NumPy arrays:
+
+    generation[t, ba, fuel]   MWh generated (NaN where EIA has no row)
+    consumed_from[t, ba]      MWh consumed locally that came from ba (NaN where no row)
+
+so that usage = consumed_from * generation / total generation is a couple of
+broadcasts, instead of a groupby, join and merge over long frames with string keys. The
+result is converted back to the long (timestamp, fromba, generation_type) frame only at
+the end.
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class FuelMixTensors:
+    timestamps: pd.Index          # the t axis, see _local_axis
+    bas: pd.Index                 # the ba axis
+    fuels: pd.Index               # the fuel axis
+    generation: np.ndarray        # [t, ba, fuel]
+    consumed_from: np.ndarray     # [t, ba]
+    # Where each generation row went, as (t, ba, fuel) codes, in the order of the rows
+    generation_cells: tuple
+
+
+def _datetime_index(timestamps):
+    timestamps = pd.Series(timestamps, copy=False)
+    if not pd.api.types.is_datetime64_any_dtype(timestamps.dtype):
+        # Timestamps with several UTC offsets (a range across a daylight saving change, see
+        # parse_eia_period) only go into a datetime64 column as UTC
+        timestamps = pd.to_datetime(timestamps, utc=True)
+    return pd.DatetimeIndex(timestamps)
+
+
+def _local_axis(axis_length, cells_and_timestamps):
+    """
+    The t axis labelled with the rows' own (local) timestamps, for when they don't all
+    share one UTC offset. cells_and_timestamps is [(t codes, timestamp column), ...]; where
+    columns disagree on the offset of an instant, the later one wins. Like
+    parse_eia_period: datetime64 if there's a single offset after all, else an object
+    index of Timestamps.
+    """
+    labels = np.empty(axis_length, dtype=object)
+    for t, timestamps in cells_and_timestamps:
+        present_t, first_rows = np.unique(t, return_index=True)
+        labels[present_t] = [pd.Timestamp(value) for value in pd.Series(timestamps, copy=False).iloc[first_rows]]
+    if len({label.utcoffset() for label in labels}) <= 1:
+        return pd.DatetimeIndex(list(labels))
+    return pd.Index(labels, dtype=object)
+
+
+def _timestamp_values(timestamps):
+    # int64 nanoseconds since the epoch (UTC for tz-aware timestamps), for fast matching
+    return _datetime_index(timestamps).as_unit("ns").asi8
+
+
+def _codes(values, labels):
+    """
+    Positions of values in labels. For categoricals only the categories are looked up,
+    not every row.
+    """
+    values = pd.Series(values, copy=False)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        category_codes = labels.get_indexer(values.cat.categories.astype(str))
+        return category_codes[values.cat.codes.to_numpy()]
+    return labels.get_indexer(values.astype(str))
+
+
+def _labels(*columns):
+    labels = set()
+    for column in columns:
+        column = pd.Series(column, copy=False)
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            labels.update(column.cat.categories[np.unique(column.cat.codes)].astype(str))
+        else:
+            labels.update(column.astype(str).unique())
+    return pd.Index(sorted(labels))
+
+
+def build_fuel_mix_tensors(generation_df, consumption_df,
+                           generation_column="Generation (MWh)",
+                           consumption_column="Power consumed locally (MWh)"):
+    """
+    generation_df has timestamp, fromba, generation_type and generation_column;
+    consumption_df has timestamp, fromba and consumption_column.
+    Rows for the same cell are added up.
+    """
+    generation_timestamps = _datetime_index(generation_df["timestamp"])
+    generation_times = generation_timestamps.as_unit("ns").asi8
+    consumption_times = _timestamp_values(consumption_df["timestamp"])
+    time_values = np.unique(np.concatenate([generation_times, consumption_times]))
+    generation_t = np.searchsorted(time_values, generation_times)
+    consumption_t = np.searchsorted(time_values, consumption_times)
+    if not all(pd.api.types.is_datetime64_any_dtype(df["timestamp"].dtype) for df in [generation_df, consumption_df]):
+        # Matched in UTC above, but labelled in local time again for the output; the
+        # consumption rows are on the local BA's clock
+        timestamps = _local_axis(len(time_values), [(generation_t, generation_df["timestamp"]),
+                                                    (consumption_t, consumption_df["timestamp"])])
+    elif generation_timestamps.tz is None:
+        timestamps = pd.DatetimeIndex(time_values).as_unit(generation_timestamps.unit)
+    else:
+        timestamps = pd.to_datetime(time_values, utc=True).as_unit(generation_timestamps.unit).tz_convert(generation_timestamps.tz)
+
+    bas = _labels(generation_df["fromba"], consumption_df["fromba"])
+    generation_ba = _codes(generation_df["fromba"], bas)
+    consumption_ba = _codes(consumption_df["fromba"], bas)
+
+    fuels = _labels(generation_df["generation_type"])
+    generation_fuel = _codes(generation_df["generation_type"], fuels)
+
+    shape = (len(time_values), len(bas), len(fuels))
+    # A generation cell whose values are all NaN stays NaN, like the row did before
+    generation = _scatter_sum(shape, (generation_t, generation_ba, generation_fuel), generation_df[generation_column], min_count=1)
+    consumed_from = _scatter_sum(shape[:2], (consumption_t, consumption_ba), consumption_df[consumption_column])
+
+    return FuelMixTensors(timestamps, bas, fuels, generation, consumed_from,
+                          (generation_t, generation_ba, generation_fuel))
+
+
+def _scatter_sum(shape, cells, values, min_count=0):
+    """
+    Dense array of the given shape, with values added up into cells, like
+    groupby().sum(min_count=min_count): NaN values count as 0, and cells with fewer than
+    min_count non-NaN values are NaN. Cells with no rows at all are always NaN.
+    """
+    flat_cells = np.ravel_multi_index(cells, shape)
+    values = np.asarray(values, dtype=np.float64)
+    not_nan = ~np.isnan(values)
+    size = int(np.prod(shape))
+    totals = np.bincount(flat_cells, weights=np.where(not_nan, values, 0.0), minlength=size)
+    present = np.bincount(flat_cells, minlength=size) > 0
+    if min_count > 0:
+        present &= np.bincount(flat_cells, weights=not_nan, minlength=size) >= min_count
+    return np.where(present, totals, np.nan).reshape(shape)
+
+
+def usage_by_fuel(tensors):
+    """
+    usage[t, ba, fuel]: MWh consumed locally from each source BA and fuel type. That's the
+    power consumed locally from the source BA, times the fuel type's share of the source
+    BA's total generation.
+    """
+    generation = tensors.generation
+    total_generation = np.nansum(generation, axis=2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        share = generation / total_generation[:, :, np.newaxis]
+    return tensors.consumed_from[:, :, np.newaxis] * share
+
+
+def fuel_mix_frame(tensors, usage):
+    """
+    Back to the long format frame compute_hourly_fuel_mix_after_import_export has always
+    returned (less the emissions columns, see emission_factors.py): one row per generation
+    row whose (timestamp, source BA) also has consumption, in the order of the generation
+    rows.
+    """
+    t, ba, fuel = tensors.generation_cells
+    has_consumption = ~np.isnan(tensors.consumed_from[t, ba])
+    t, ba, fuel = t[has_consumption], ba[has_consumption], fuel[has_consumption]
+
+    return pd.DataFrame({
+        "timestamp": tensors.timestamps[t],
+        "fromba": pd.Categorical.from_codes(ba, categories=tensors.bas),
+        "generation_type": pd.Categorical.from_codes(fuel, categories=tensors.fuels),
+        "Usage (MWh)": usage[t, ba, fuel],
+    })
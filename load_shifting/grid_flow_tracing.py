@@ -0,0 +1,193 @@
+"""
+Consumption-based carbon intensity for every BA on the grid at once, by flow tracing.
+
+The per-BA calculation (compute_hourly_consumption_by_source_ba and friends) looks one
+hop upstream: energy imported from a neighbor is assumed to have that neighbor's
+*generation* mix. But the neighbor may itself be passing through energy it imported from
+somewhere else. Flow tracing (proportional sharing) gets this right for any number of
+hops: every BA's outflows, and its own consumption, have the mix of everything flowing
+into it, i.e. its own generation plus its imports. For each hour and BA i:
+
+    P_i = sum_f G_if + sum_j F_ji                (throughput: generation plus imports)
+    P_i x_if = G_if + sum_j F_ji x_jf            (mix of the throughput, for each fuel f)
+
+where G_if is generation of fuel f, F_ji the flow from j to i and x_if the share of fuel f
+in what i consumes and exports. That's a sparse linear system (diag(P) - F^T) x = G with
+one row per BA and one right hand side per fuel. All hours are stacked into one block
+diagonal system and solved in a single sparse LU factorization, so all ~65 BAs cost one
+solve rather than one pipeline run each.
+
+Timestamps are UTC here, since BAs report in their own local time.
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+
+
+@dataclass
+class GridNetwork:
+    timestamps: pd.DatetimeIndex   # t axis, UTC
+    bas: pd.Index                  # node axis: BAs with generation data
+    fuels: pd.Index                # fuel axis
+    generation: np.ndarray         # [t, ba, fuel] MWh, negative values (e.g. storage charging) clipped to 0
+    # Flows between BAs, one entry per (hour, exporter, importer), MWh
+    flow_t: np.ndarray
+    flow_from: np.ndarray
+    flow_to: np.ndarray
+    flow_mwh: np.ndarray
+
+
+def utc_timestamps(period):
+    # EIA local-hourly periods carry their UTC offset ("2024-04-01T00-07")
+    return pd.DatetimeIndex(pd.to_datetime(pd.Series(period, copy=False).astype(str), format="ISO8601", utc=True))
+
+
+def build_grid_network(generation_df, interchange_df,
+                       generation_column="Generation (MWh)",
+                       interchange_column="Interchange to local BA (MWh)"):
+    """
+    generation_df: EIA fuel-type-data rows (period, respondent, type-name, generation_column)
+    interchange_df: EIA interchange-data rows (period, fromba, toba, interchange_column),
+    where a positive value is a flow from fromba to toba.
+
+    Each tie line is usually reported by both BAs, with opposite signs; we average the two
+    reports. Flows to or from BAs without generation data (e.g. Canadian or Mexican ones)
+    are left out.
+    """
+    generation_times = utc_timestamps(generation_df["period"])
+    interchange_times = utc_timestamps(interchange_df["period"])
+    timestamps = generation_times.append(interchange_times).unique().sort_values()
+
+    bas = pd.Index(sorted(pd.Series(generation_df["respondent"]).astype(str).unique()))
+    fuels = pd.Index(sorted(pd.Series(generation_df["type-name"]).astype(str).unique()))
+
+    generation_t = timestamps.get_indexer(generation_times)
+    generation_ba = bas.get_indexer(pd.Series(generation_df["respondent"]).astype(str))
+    generation_fuel = fuels.get_indexer(pd.Series(generation_df["type-name"]).astype(str))
+    shape = (len(timestamps), len(bas), len(fuels))
+    generation_values = np.nan_to_num(np.asarray(generation_df[generation_column], dtype=np.float64), nan=0.0)
+    generation = np.bincount(
+        np.ravel_multi_index((generation_t, generation_ba, generation_fuel), shape),
+        weights=np.clip(generation_values, 0, None),
+        minlength=int(np.prod(shape)),
+    ).reshape(shape)
+
+    # Orient every report from the alphabetically first BA of the pair to the second, so
+    # both reports of the same tie line land in the same group
+    from_ba = bas.get_indexer(pd.Series(interchange_df["fromba"]).astype(str))
+    to_ba = bas.get_indexer(pd.Series(interchange_df["toba"]).astype(str))
+    values = np.asarray(interchange_df[interchange_column], dtype=np.float64)
+    usable = (from_ba >= 0) & (to_ba >= 0) & (from_ba != to_ba) & ~np.isnan(values)
+    t = timestamps.get_indexer(interchange_times)[usable]
+    from_ba, to_ba, values = from_ba[usable], to_ba[usable], values[usable]
+    first_ba = np.minimum(from_ba, to_ba)
+    second_ba = np.maximum(from_ba, to_ba)
+    oriented_values = np.where(from_ba == first_ba, values, -values)
+
+    tie_lines = pd.DataFrame({"t": t, "first": first_ba, "second": second_ba, "mwh": oriented_values})
+    tie_lines = tie_lines.groupby(["t", "first", "second"])["mwh"].mean().reset_index()
+    tie_lines = tie_lines[tie_lines["mwh"] != 0]
+    forward = tie_lines["mwh"].to_numpy() > 0
+    first_ba = tie_lines["first"].to_numpy()
+    second_ba = tie_lines["second"].to_numpy()
+
+    return GridNetwork(
+        timestamps=timestamps,
+        bas=bas,
+        fuels=fuels,
+        generation=generation,
+        flow_t=tie_lines["t"].to_numpy(),
+        flow_from=np.where(forward, first_ba, second_ba),
+        flow_to=np.where(forward, second_ba, first_ba),
+        flow_mwh=np.abs(tie_lines["mwh"].to_numpy()),
+    )
+
+
+def trace_fuel_shares(network):
+    """
+    Solve the flow tracing equations for all hours at once. Returns (shares, throughput):
+    shares[t, ba, fuel] is the fraction of fuel in what ba consumes at hour t, and
+    throughput[t, ba] is generation plus imports. BAs with nothing flowing through them
+    in an hour get NaN shares.
+    """
+    hours, node_count, fuel_count = network.generation.shape
+    size = hours * node_count
+
+    # Node index in the stacked system
+    importer = network.flow_t * node_count + network.flow_to
+    exporter = network.flow_t * node_count + network.flow_from
+
+    throughput = network.generation.sum(axis=2).reshape(size)
+    throughput += np.bincount(importer, weights=network.flow_mwh, minlength=size)
+    empty = throughput <= 0
+    # Keep the system solvable; these rows come out as 0 and are set to NaN below
+    diagonal = np.where(empty, 1.0, throughput)
+
+    matrix = sparse.csc_matrix(
+        (
+            np.concatenate([diagonal, -network.flow_mwh]),
+            (np.concatenate([np.arange(size), importer]), np.concatenate([np.arange(size), exporter])),
+        ),
+        shape=(size, size),
+    )
+    right_hand_side = network.generation.reshape(size, fuel_count)
+    shares = spsolve(matrix, right_hand_side)
+    shares = np.asarray(shares).reshape(size, fuel_count)
+    shares[empty] = np.nan
+    return shares.reshape(hours, node_count, fuel_count), throughput.reshape(hours, node_count)
+
+
+def grid_fuel_usage(generation_df, interchange_df):
+    """
+    Wide frame of what every BA consumes (and passes on) each hour, by fuel type: timestamp
+    (UTC), ba, "Throughput (MWh)" and a MWh column per fuel type. Only physical quantities,
+    so it can be cached whatever emission factors are applied to it later.
+    """
+    network = build_grid_network(generation_df, interchange_df)
+    shares, throughput = trace_fuel_shares(network)
+    usage = shares * throughput[:, :, np.newaxis]
+
+    hours, node_count, fuel_count = usage.shape
+    fuel_usage = pd.DataFrame({
+        "timestamp": np.repeat(network.timestamps, node_count),
+        "ba": pd.Categorical.from_codes(np.tile(np.arange(node_count), hours), categories=network.bas),
+        "Throughput (MWh)": throughput.ravel(),
+    })
+    for fuel_number, fuel in enumerate(network.fuels):
+        fuel_usage[fuel] = usage[:, :, fuel_number].ravel()
+    return fuel_usage
+
+
+def fuel_columns(fuel_usage):
+    return [column for column in fuel_usage.columns if not column in ["timestamp", "ba", "Throughput (MWh)"]]
+
+
+def grid_co2_intensity_from_fuel_usage(fuel_usage, emissions_per_kwh_by_fuel):
+    """
+    grid_fuel_usage's frame -> timestamp, ba, "Throughput (MWh)" and pounds_co2_per_kwh,
+    in the same units as compute_hourly_fuel_mix_after_import_export's emissions_per_kwh.
+    The factors are one matrix-vector product over the fuel columns.
+    """
+    fuels = fuel_columns(fuel_usage)
+    factors = np.array([emissions_per_kwh_by_fuel[fuel] for fuel in fuels], dtype=np.float64)
+    usage = fuel_usage[fuels].to_numpy(dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        intensity = (usage @ factors) / usage.sum(axis=1)
+    return pd.DataFrame({
+        "timestamp": fuel_usage["timestamp"],
+        "ba": fuel_usage["ba"],
+        "Throughput (MWh)": fuel_usage["Throughput (MWh)"],
+        "pounds_co2_per_kwh": intensity,
+    })
+
+
+def grid_co2_intensity(generation_df, interchange_df, emissions_per_kwh_by_fuel):
+    """
+    Long frame of consumption-based intensity for every BA and hour: timestamp (UTC), ba,
+    "Throughput (MWh)" and pounds_co2_per_kwh.
+    """
+    return grid_co2_intensity_from_fuel_usage(grid_fuel_usage(generation_df, interchange_df), emissions_per_kwh_by_fuel)
@@ -0,0 +1,523 @@
+"""
+Array version of model_one_house's simulation loop.
+
+model_one_house used to call calculate_next_timestep once per timestep, which looked up
+the weather row with .loc twice, built a pd.Series of the results and read the look-ahead
+values with more .loc lookups; the frame was then built from ~8,760 Series. Here:
+
+ - the inputs are pulled out of the weather frame once, as plain arrays
+   (SimulationInputs), including the look-ahead values the smart HVAC algorithm uses
+ - everything that only depends on the home and the timestep length is worked out once
+   before the loop (HouseConstants)
+ - the loop writes each timestep's results into preallocated arrays (SimulationOutputs),
+   and the data frame is built from those at the end.
+
+The arithmetic is the same as calculate_next_timestep's, operation for operation, so
+with the default look-ahead kernel the results match it.
+
+simulate_houses does the same for N homes at once: the state (indoor temperature) is a
+vector of shape (N,), each timestep is a handful of array operations over all the homes,
+and both HVAC algorithms are written as masks over the home axis. Outputs are (T, N).
+That makes a thousand home variants cost about what a few single-home runs do.
+
+The smart HVAC algorithm's look-ahead is worked out before the loop too. It looks at
+the outdoor temperature and CO2 intensity some time ahead, as a weighted average over a
+look-ahead kernel, {hours ahead: weight}. The default kernel, {2: 1}, is the original
+"2 hours ahead"; "1-4h-weighted" is the weighted average of 1 to 4 hours ahead that the
+old TODO asked for, and more can be added with the
+LOAD_SHIFTING_SMART_HVAC_LOOKAHEAD_KERNELS setting. From the look-ahead values,
+smart_hvac_decisions gives, for each timestep (and home), whether the smart algorithm
+would overdrive heating, overdrive cooling or coast; the loop only has to check those
+against the indoor temperature, so a smart home runs as fast as a basic one.
+
+By default each step is calculate_next_timestep's explicit Euler step. solver="exact"
+uses the closed-form solution of the single-zone RC model over each step instead (see
+_exact_step_energies), which stays accurate with steps of a few hours; thermal_network.py
+has a three-node (air / envelope / mass) model solved the same way.
+"""
+
+import math
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+
+# Also define a few permanent constants
+JOULES_PER_KWH = 3.6e+6
+JOULES_PER_MEGAJOULE = 1e6
+SECONDS_PER_HOUR = 3600
+AIR_VOLUMETRIC_HEAT_CAPACITY = 1200 # Energy in joules per cubic meter of air per degree K. (J/m3/K)
+
+# hvac_mode codes in SimulationOutputs
+HVAC_OFF = 0
+HVAC_HEATING = 1
+HVAC_COOLING = 2
+HVAC_MODE_NAMES = np.array(["off", "heating", "cooling"], dtype=object)
+
+# How far ahead the smart HVAC algorithm looks: {hours ahead: weight}
+SMART_HVAC_LOOKAHEAD_KERNELS = {
+    "2h": {2: 1.0},
+    "1-4h-weighted": {1: 0.4, 2: 0.3, 3: 0.2, 4: 0.1},
+}
+DEFAULT_SMART_HVAC_LOOKAHEAD_KERNEL = "2h"
+
+# lookahead_status values: all the look-ahead times are in the data, one of them is past
+# the end of the data (the smart algorithm falls back to the basic one), or one of them
+# isn't in the data at all
+LOOKAHEAD_OK = 0
+PAST_THE_END = -1
+MISSING_ROW = -2
+
+# How simulate_house steps the indoor temperature forward, see _exact_step_energies
+SOLVERS = ["euler", "exact"]
+
+# The smart algorithm reacts to look-ahead CO2 intensity changes bigger than this
+# (pounds per kWh)...
+SMART_HVAC_CO2_DELTA = 0.05
+# ...and overdrives when co2_delta * degrees outside the setpoint is bigger than this
+SMART_HVAC_OVERDRIVE_BENEFIT = 2
+# How far from the heating setpoint it lets the temperature drift while coasting
+SMART_HVAC_COASTING_RANGE_C = 2
+
+
+def smart_hvac_lookahead_kernels():
+    # The built-in kernels plus any from settings
+    kernels = dict(SMART_HVAC_LOOKAHEAD_KERNELS)
+    kernels.update(getattr(settings, "LOAD_SHIFTING_SMART_HVAC_LOOKAHEAD_KERNELS", {}))
+    return kernels
+
+
+def smart_hvac_lookahead_kernel(kernel=None):
+    """
+    The {hours ahead: weight} kernel: kernel itself if it's a dict, else the one called
+    kernel, by default the configured LOAD_SHIFTING_SMART_HVAC_LOOKAHEAD_KERNEL.
+    """
+    if isinstance(kernel, dict):
+        return kernel
+    if kernel is None:
+        kernel = getattr(settings, "LOAD_SHIFTING_SMART_HVAC_LOOKAHEAD_KERNEL", DEFAULT_SMART_HVAC_LOOKAHEAD_KERNEL)
+    kernels = smart_hvac_lookahead_kernels()
+    if not kernel in kernels:
+        raise ValueError("No smart HVAC look-ahead kernel called {!r}; there's {}".format(
+            kernel, ", ".join(sorted(kernels))))
+    return kernels[kernel]
+
+
+@dataclass
+class SimulationInputs:
+    timestamps: pd.Index
+    temp_air: np.ndarray            # outdoor temperature (C)
+    irradiance: np.ndarray          # poa_direct through south-facing windows
+    co2_intensity: np.ndarray       # pounds_co2_per_kwh
+    # The smart HVAC algorithm's look-ahead, kernel-weighted; NaN where lookahead_status
+    # isn't LOOKAHEAD_OK
+    future_temp_air: np.ndarray
+    future_co2_intensity: np.ndarray
+    co2_delta: np.ndarray           # future_co2_intensity - co2_intensity
+    lookahead_status: np.ndarray    # LOOKAHEAD_OK, PAST_THE_END or MISSING_ROW
+    missing_lookahead_times: list   # the look-ahead timestamp missing at each MISSING_ROW row
+    dt_seconds: int
+
+
+@dataclass
+class HouseConstants:
+    # For one home, or for N homes with each field an array of shape (N,)
+    surface_area_sq_m: float
+    wall_insulation_r_value_si: float
+    air_change_volume: float        # cubic meters of air exchanged per timestep
+    window_solar_gain: float        # window size * solar heat gain coefficient
+    hvac_energy_j: float            # energy the HVAC adds or removes per timestep when on
+    building_heat_capacity: float
+    heating_setpoint_c: float
+    cooling_setpoint_c: float
+    can_close_curtains: bool
+    smart_hvac_algorithm: bool
+    optimal_hvac_algorithm: bool
+    hvac_joules_per_kwh_used: float # JOULES_PER_KWH * system efficiency
+    # For the "exact" solver:
+    conductance_w_per_k: float      # through the walls and roof
+    air_change_w_per_k: float       # carried by air changes
+    time_constant_s: float          # building_heat_capacity / total conductance
+    decay: float                    # exp(-timestep / time_constant_s)
+
+
+@dataclass
+class SimulationOutputs:
+    temperature_difference_c: np.ndarray
+    conductive_energy_j: np.ndarray
+    air_change_energy_j: np.ndarray
+    radiant_energy_j: np.ndarray
+    hvac_energy_j: np.ndarray
+    hvac_mode: np.ndarray           # HVAC_OFF, HVAC_HEATING or HVAC_COOLING
+    net_energy_j: np.ndarray
+    delta_t: np.ndarray
+    indoor_temperature_c: np.ndarray  # at the end of the timestep
+    hvac_energy_use_kwh: np.ndarray
+
+    @classmethod
+    def allocate(cls, length, home_count=None):
+        # Arrays of shape (length,) for one home, (length, home_count) for several
+        shape = length if home_count is None else (length, home_count)
+        arrays = {name: np.empty(shape, dtype=np.float64) for name in cls.__dataclass_fields__}
+        arrays["hvac_mode"] = np.empty(shape, dtype=np.int8)
+        return cls(**arrays)
+
+    def for_home(self, home_number):
+        # One home's column of (T, N) outputs, as views
+        return SimulationOutputs(**{name: getattr(self, name)[:, home_number] for name in self.__dataclass_fields__})
+
+
+def _lookahead_rows(timestamps, offset):
+    # Row of each timestamp + offset, or PAST_THE_END or MISSING_ROW
+    lookahead_times = pd.Index([timestamp + offset for timestamp in timestamps]) \
+        if timestamps.dtype == object else timestamps + offset
+    rows = timestamps.get_indexer(lookahead_times)
+    rows = np.where(rows >= 0, rows, MISSING_ROW)
+    rows[np.asarray(lookahead_times > timestamps.max())] = PAST_THE_END
+    return rows, lookahead_times
+
+
+def simulation_inputs(weather_with_co2_timeseries, lookahead_kernel=None):
+    """
+    weather_with_co2_timeseries is indexed by timestamp, with temp_air, poa_direct and
+    pounds_co2_per_kwh columns, like model_one_house takes. lookahead_kernel is a kernel
+    name or {hours ahead: weight} dict for the smart HVAC algorithm (see
+    smart_hvac_lookahead_kernel).
+    """
+    timestamps = weather_with_co2_timeseries.index
+    temp_air = weather_with_co2_timeseries["temp_air"].to_numpy(dtype=np.float64)
+    co2_intensity = weather_with_co2_timeseries["pounds_co2_per_kwh"].to_numpy(dtype=np.float64)
+
+    kernel = smart_hvac_lookahead_kernel(lookahead_kernel)
+    total_weight = sum(kernel.values())
+    future_temp_air = np.zeros(len(timestamps))
+    future_co2_intensity = np.zeros(len(timestamps))
+    past_the_end = np.zeros(len(timestamps), dtype=bool)
+    missing = np.zeros(len(timestamps), dtype=bool)
+    missing_lookahead_times = [None] * len(timestamps)
+    for hours_ahead, weight in sorted(kernel.items()):
+        rows, lookahead_times = _lookahead_rows(timestamps, pd.Timedelta(hours=hours_ahead))
+        # Rows that aren't there pick up junk here, which gets replaced with NaN below
+        future_temp_air += weight * temp_air[rows]
+        future_co2_intensity += weight * co2_intensity[rows]
+        past_the_end |= rows == PAST_THE_END
+        for row in np.flatnonzero((rows == MISSING_ROW) & ~missing):
+            missing_lookahead_times[row] = lookahead_times[row]
+        missing |= rows == MISSING_ROW
+    # Past the end wins over missing, like the old max() check came before the .loc
+    lookahead_status = np.where(past_the_end, PAST_THE_END, np.where(missing, MISSING_ROW, LOOKAHEAD_OK)).astype(np.int8)
+    future_temp_air = np.where(lookahead_status == LOOKAHEAD_OK, future_temp_air / total_weight, np.nan)
+    future_co2_intensity = np.where(lookahead_status == LOOKAHEAD_OK, future_co2_intensity / total_weight, np.nan)
+
+    return SimulationInputs(
+        timestamps=timestamps,
+        temp_air=temp_air,
+        irradiance=weather_with_co2_timeseries["poa_direct"].to_numpy(dtype=np.float64),
+        co2_intensity=co2_intensity,
+        future_temp_air=future_temp_air,
+        future_co2_intensity=future_co2_intensity,
+        co2_delta=future_co2_intensity - co2_intensity,
+        lookahead_status=lookahead_status,
+        missing_lookahead_times=missing_lookahead_times,
+        dt_seconds=int((timestamps[1] - timestamps[0]).total_seconds()),
+    )
+
+
+def house_constants(home, dt_seconds):
+    conductance_w_per_k = home.surface_area_to_area_sq_m / home.wall_insulation_r_value_si
+    air_change_w_per_k = home.building_volume_cu_m * home.ach_natural / SECONDS_PER_HOUR * AIR_VOLUMETRIC_HEAT_CAPACITY
+    time_constant_s = home.building_heat_capacity / (conductance_w_per_k + air_change_w_per_k)
+    return HouseConstants(
+        surface_area_sq_m=home.surface_area_to_area_sq_m,
+        wall_insulation_r_value_si=home.wall_insulation_r_value_si,
+        air_change_volume=dt_seconds * home.building_volume_cu_m * home.ach_natural / SECONDS_PER_HOUR,
+        window_solar_gain=home.south_facing_window_size_sq_m * home.window_solar_heat_gain_coefficient,
+        hvac_energy_j=home.hvac_capacity_w * dt_seconds,
+        building_heat_capacity=home.building_heat_capacity,
+        heating_setpoint_c=home.heating_setpoint_c,
+        cooling_setpoint_c=home.cooling_setpoint_c,
+        can_close_curtains=home.can_close_curtains,
+        smart_hvac_algorithm=home.smart_hvac_algorithm,
+        optimal_hvac_algorithm=home.optimal_hvac_algorithm,
+        hvac_joules_per_kwh_used=JOULES_PER_KWH * home.hvac_overall_system_efficiency,
+        conductance_w_per_k=conductance_w_per_k,
+        air_change_w_per_k=air_change_w_per_k,
+        time_constant_s=time_constant_s,
+        decay=math.exp(-dt_seconds / time_constant_s),
+    )
+
+
+def stacked_house_constants(homes, dt_seconds):
+    # HouseConstants of N homes, each field an array of shape (N,)
+    per_home = [house_constants(home, dt_seconds) for home in homes]
+    return HouseConstants(**{
+        name: np.array([getattr(constants, name) for constants in per_home],
+                       dtype=bool if name in ["can_close_curtains", "smart_hvac_algorithm", "optimal_hvac_algorithm"] else np.float64)
+        for name in HouseConstants.__dataclass_fields__
+    })
+
+
+@dataclass
+class SmartHVACDecisions:
+    # Shape (T,) for one home, (T, N) for several; all False for basic HVAC homes
+    overdrive_heating: np.ndarray   # heat, as long as it's below the cooling setpoint
+    overdrive_cooling: np.ndarray   # cool, as long as it's above the heating setpoint
+    coasting: np.ndarray            # only heat or cool outside the widened range
+
+
+def smart_hvac_decisions(constants, inputs):
+    """
+    What utils.smart_hvac_algorithm decides from the look-ahead values, for every
+    timestep at once. Only the comparisons against the indoor temperature are left for
+    the simulation loop. Raises KeyError, like the .loc lookup used to, if a smart home
+    needs a look-ahead time that isn't in the data.
+    """
+    smart = constants.smart_hvac_algorithm
+    missing_rows = np.flatnonzero(inputs.lookahead_status == MISSING_ROW)
+    if np.any(smart) and len(missing_rows) > 0:
+        raise KeyError(inputs.missing_lookahead_times[missing_rows[0]])
+
+    co2_delta = inputs.co2_delta
+    future_temp_air = inputs.future_temp_air
+    if np.ndim(smart) > 0:
+        # Timesteps down, homes across
+        co2_delta = co2_delta[:, np.newaxis]
+        future_temp_air = future_temp_air[:, np.newaxis]
+
+    # NaN co2_delta (no look-ahead) compares False everywhere, so those are basic
+    with np.errstate(invalid="ignore"):
+        expensive_later = smart & (co2_delta > SMART_HVAC_CO2_DELTA)
+        overdrive_heating_benefit = co2_delta * (constants.heating_setpoint_c - future_temp_air)
+        overdrive_cooling_benefit = co2_delta * (future_temp_air - constants.cooling_setpoint_c)
+        return SmartHVACDecisions(
+            overdrive_heating=expensive_later & (overdrive_heating_benefit > SMART_HVAC_OVERDRIVE_BENEFIT),
+            overdrive_cooling=expensive_later & (overdrive_cooling_benefit > SMART_HVAC_OVERDRIVE_BENEFIT),
+            coasting=smart & (co2_delta < -SMART_HVAC_CO2_DELTA),
+        )
+
+
+def _check_solver(solver):
+    if not solver in SOLVERS:
+        raise ValueError("No solver called {!r}; there's {}".format(solver, ", ".join(SOLVERS)))
+
+
+def _exact_step_energies(outdoor_temperature_c, indoor_temperature_c, energy_from_sun_j, energy_from_hvac_j,
+                         constants, dt_seconds):
+    """
+    Conductive and air change energy over a timestep for the "exact" solver: instead of
+    holding the indoor temperature at its start-of-step value for the whole step (explicit
+    Euler), follow the exponential it actually takes with the outdoor temperature, sun
+    and HVAC held constant over the step. The indoor temperature heads for the
+    equilibrium where the sun and HVAC balance what's lost through the walls and air
+    changes:
+
+        T(t) = T_eq + (T_0 - T_eq) exp(-t / tau)
+
+    and the energy in through the walls over the step is conductance * the integral of
+    (outdoor - T(t)). That's exact for any step length, so coarse steps stay accurate
+    and stable, where Euler overshoots once a step gets near the time constant.
+    Works on floats or (N,) arrays.
+    """
+    total_conductance = constants.conductance_w_per_k + constants.air_change_w_per_k
+    equilibrium_c = outdoor_temperature_c + (energy_from_sun_j + energy_from_hvac_j) / dt_seconds / total_conductance
+    # Integral of (outdoor - indoor) over the step, in K s
+    step_difference = (outdoor_temperature_c - equilibrium_c) * dt_seconds + \
+        (equilibrium_c - indoor_temperature_c) * constants.time_constant_s * (1 - constants.decay)
+    return step_difference * constants.conductance_w_per_k, step_difference * constants.air_change_w_per_k
+
+
+def _optimal_hvac_policy(home, inputs, solver):
+    # hvac_optimizer builds on this module, so it's imported when it's needed
+    from .hvac_optimizer import optimal_hvac_policy
+    return optimal_hvac_policy(home, inputs, solver=solver)
+
+
+def simulate_house(home, inputs, initial_indoor_temperature_c=None, solver="euler", policy=None):
+    """
+    Run the simulation over all the timesteps of inputs. Starts from
+    initial_indoor_temperature_c, by default the heating setpoint. solver is "euler",
+    calculate_next_timestep's explicit Euler step, or "exact" (see _exact_step_energies).
+    Either way the HVAC mode and the curtains are decided at the start of each step and
+    held through it. Homes with optimal_hvac_algorithm follow policy, by default one
+    solved with hvac_optimizer for the home's setpoints.
+    """
+    _check_solver(solver)
+    exact = solver == "exact"
+    if policy is None and home.optimal_hvac_algorithm:
+        policy = _optimal_hvac_policy(home, inputs, solver)
+    constants = house_constants(home, inputs.dt_seconds)
+    decisions = smart_hvac_decisions(constants, inputs)
+    outputs = SimulationOutputs.allocate(len(inputs.temp_air))
+
+    # Python floats and lists are much quicker to index one at a time than NumPy arrays
+    dt_seconds = inputs.dt_seconds
+    surface_area_sq_m = constants.surface_area_sq_m
+    r_value_si = constants.wall_insulation_r_value_si
+    air_change_volume = constants.air_change_volume
+    window_solar_gain = constants.window_solar_gain
+    heat_capacity = constants.building_heat_capacity
+    heating_setpoint_c = constants.heating_setpoint_c
+    cooling_setpoint_c = constants.cooling_setpoint_c
+    coasting_floor_c = constants.heating_setpoint_c - SMART_HVAC_COASTING_RANGE_C
+    coasting_ceiling_c = constants.heating_setpoint_c + SMART_HVAC_COASTING_RANGE_C
+    hvac_energy_j = constants.hvac_energy_j
+    can_close_curtains = constants.can_close_curtains
+    joules_per_kwh_used = constants.hvac_joules_per_kwh_used
+    temp_air = inputs.temp_air.tolist()
+    irradiance = inputs.irradiance.tolist()
+    overdrive_heating = decisions.overdrive_heating.tolist()
+    overdrive_cooling = decisions.overdrive_cooling.tolist()
+    coasting = decisions.coasting.tolist()
+
+    indoor_temperature_c = home.heating_setpoint_c if initial_indoor_temperature_c is None else initial_indoor_temperature_c
+    for row in range(len(temp_air)):
+        temperature_difference_c = temp_air[row] - indoor_temperature_c
+        energy_from_conduction_j = temperature_difference_c * surface_area_sq_m / r_value_si * dt_seconds
+        energy_from_air_change_j = temperature_difference_c * air_change_volume * AIR_VOLUMETRIC_HEAT_CAPACITY
+        energy_from_sun_j = window_solar_gain * irradiance[row] * dt_seconds
+        if indoor_temperature_c > cooling_setpoint_c and can_close_curtains:
+            energy_from_sun_j *= 0.1
+
+        # Same decisions as utils.optimal_hvac_algorithm / smart_hvac_algorithm / basic_hvac_algorithm
+        if policy is not None:
+            hvac_mode, energy_from_hvac_j = policy.decide(row, indoor_temperature_c)
+        elif overdrive_heating[row] and indoor_temperature_c < cooling_setpoint_c:
+            hvac_mode, energy_from_hvac_j = HVAC_HEATING, hvac_energy_j
+        elif overdrive_cooling[row] and indoor_temperature_c > heating_setpoint_c:
+            hvac_mode, energy_from_hvac_j = HVAC_COOLING, -hvac_energy_j
+        elif coasting[row]:
+            if indoor_temperature_c < coasting_floor_c:
+                hvac_mode, energy_from_hvac_j = HVAC_HEATING, hvac_energy_j
+            elif indoor_temperature_c > coasting_ceiling_c:
+                hvac_mode, energy_from_hvac_j = HVAC_COOLING, -hvac_energy_j
+            else:
+                hvac_mode, energy_from_hvac_j = HVAC_OFF, 0
+        elif indoor_temperature_c < heating_setpoint_c:
+            hvac_mode, energy_from_hvac_j = HVAC_HEATING, hvac_energy_j
+        elif indoor_temperature_c > cooling_setpoint_c:
+            hvac_mode, energy_from_hvac_j = HVAC_COOLING, -hvac_energy_j
+        else:
+            hvac_mode, energy_from_hvac_j = HVAC_OFF, 0
+
+        if exact:
+            energy_from_conduction_j, energy_from_air_change_j = _exact_step_energies(
+                temp_air[row], indoor_temperature_c, energy_from_sun_j, energy_from_hvac_j, constants, dt_seconds)
+
+        total_energy_in_j = energy_from_conduction_j + energy_from_air_change_j + energy_from_sun_j + energy_from_hvac_j
+        delta_t = total_energy_in_j / heat_capacity
+
+        outputs.temperature_difference_c[row] = temperature_difference_c
+        outputs.conductive_energy_j[row] = energy_from_conduction_j
+        outputs.air_change_energy_j[row] = energy_from_air_change_j
+        outputs.radiant_energy_j[row] = energy_from_sun_j
+        outputs.hvac_energy_j[row] = energy_from_hvac_j
+        outputs.hvac_mode[row] = hvac_mode
+        outputs.net_energy_j[row] = total_energy_in_j
+        outputs.delta_t[row] = delta_t
+        indoor_temperature_c = indoor_temperature_c + delta_t
+        outputs.indoor_temperature_c[row] = indoor_temperature_c
+        outputs.hvac_energy_use_kwh[row] = abs(energy_from_hvac_j) / joules_per_kwh_used
+
+    return outputs
+
+
+def simulation_frame(inputs, outputs):
+    # The data frame model_one_house has always returned
+    house_simulation = pd.DataFrame({
+        "timestamp": inputs.timestamps,
+        "temperature_difference_c": outputs.temperature_difference_c,
+        "Conductive energy (J)": outputs.conductive_energy_j,
+        "Air change energy (J)": outputs.air_change_energy_j,
+        "Radiant energy (J)": outputs.radiant_energy_j,
+        "HVAC energy (J)": outputs.hvac_energy_j,
+        "hvac_mode": HVAC_MODE_NAMES[outputs.hvac_mode],
+        "Net energy xfer": outputs.net_energy_j,
+        "ΔT": outputs.delta_t,
+        "Outdoor Temperature (C)": inputs.temp_air,
+        "Indoor Temperature (C)": outputs.indoor_temperature_c,
+        # Actual energy consumption from the HVAC system:
+        "HVAC energy use (kWh)": outputs.hvac_energy_use_kwh,
+        "pounds_co2_per_kwh": inputs.co2_intensity,
+    }, index=pd.RangeIndex(len(inputs.temp_air)))
+
+    house_simulation["pounds_co2"] = house_simulation["HVAC energy use (kWh)"] * house_simulation["pounds_co2_per_kwh"]
+    house_simulation["heat_xfer_from_outside"] = house_simulation['Conductive energy (J)'] + \
+        house_simulation['Air change energy (J)'] + house_simulation['Radiant energy (J)']
+    return house_simulation
+
+
+def _hvac_masked(row, indoor_temperature_c, constants, decisions):
+    # The decisions in simulate_house's loop, for all the homes at once:
+    # (hvac_mode, energy_from_hvac_j) arrays
+    heating = indoor_temperature_c < constants.heating_setpoint_c
+    cooling = ~heating & (indoor_temperature_c > constants.cooling_setpoint_c)
+
+    coasting = decisions.coasting[row]
+    heating = np.where(coasting, indoor_temperature_c < constants.heating_setpoint_c - SMART_HVAC_COASTING_RANGE_C, heating)
+    cooling = np.where(coasting, indoor_temperature_c > constants.heating_setpoint_c + SMART_HVAC_COASTING_RANGE_C, cooling)
+
+    overdrive_heating = decisions.overdrive_heating[row] & (indoor_temperature_c < constants.cooling_setpoint_c)
+    overdrive_cooling = ~overdrive_heating & decisions.overdrive_cooling[row] & (indoor_temperature_c > constants.heating_setpoint_c)
+    heating = overdrive_heating | (~overdrive_cooling & heating)
+    cooling = overdrive_cooling | (~overdrive_heating & cooling)
+
+    hvac_mode = np.where(heating, HVAC_HEATING, np.where(cooling, HVAC_COOLING, HVAC_OFF))
+    energy_from_hvac_j = np.where(heating, constants.hvac_energy_j, np.where(cooling, -constants.hvac_energy_j, 0.0))
+    return hvac_mode, energy_from_hvac_j
+
+
+def simulate_houses(homes, inputs, initial_indoor_temperature_c=None, solver="euler"):
+    """
+    simulate_house for N homes stepped together over the same inputs. Homes can mix the
+    basic and smart HVAC algorithms (basic homes just never get a smart decision).
+    Returns SimulationOutputs of shape (T, N); outputs.for_home(n) is home n's, the same
+    as simulate_house(homes[n], inputs, solver=solver) gives. Homes with
+    optimal_hvac_algorithm are decided one by one, from their own policies.
+    """
+    _check_solver(solver)
+    policies = {home_number: _optimal_hvac_policy(home, inputs, solver)
+                for home_number, home in enumerate(homes) if home.optimal_hvac_algorithm}
+    constants = stacked_house_constants(homes, inputs.dt_seconds)
+    outputs = SimulationOutputs.allocate(len(inputs.temp_air), len(homes))
+    decisions = smart_hvac_decisions(constants, inputs)
+    dt_seconds = inputs.dt_seconds
+    closes_curtains = constants.can_close_curtains
+
+    if initial_indoor_temperature_c is None:
+        initial_indoor_temperature_c = constants.heating_setpoint_c
+    indoor_temperature_c = np.array(initial_indoor_temperature_c, dtype=np.float64) * np.ones(len(homes))
+
+    for row in range(len(inputs.temp_air)):
+        temperature_difference_c = inputs.temp_air[row] - indoor_temperature_c
+        energy_from_conduction_j = temperature_difference_c * constants.surface_area_sq_m / constants.wall_insulation_r_value_si * dt_seconds
+        energy_from_air_change_j = temperature_difference_c * constants.air_change_volume * AIR_VOLUMETRIC_HEAT_CAPACITY
+        energy_from_sun_j = constants.window_solar_gain * inputs.irradiance[row] * dt_seconds
+        energy_from_sun_j = np.where((indoor_temperature_c > constants.cooling_setpoint_c) & closes_curtains,
+                                     energy_from_sun_j * 0.1, energy_from_sun_j)
+
+        hvac_mode, energy_from_hvac_j = _hvac_masked(row, indoor_temperature_c, constants, decisions)
+        for home_number, policy in policies.items():
+            hvac_mode[home_number], energy_from_hvac_j[home_number] = policy.decide(row, indoor_temperature_c[home_number])
+        if solver == "exact":
+            energy_from_conduction_j, energy_from_air_change_j = _exact_step_energies(
+                inputs.temp_air[row], indoor_temperature_c, energy_from_sun_j, energy_from_hvac_j, constants, dt_seconds)
+
+        total_energy_in_j = energy_from_conduction_j + energy_from_air_change_j + energy_from_sun_j + energy_from_hvac_j
+        delta_t = total_energy_in_j / constants.building_heat_capacity
+
+        outputs.temperature_difference_c[row] = temperature_difference_c
+        outputs.conductive_energy_j[row] = energy_from_conduction_j
+        outputs.air_change_energy_j[row] = energy_from_air_change_j
+        outputs.radiant_energy_j[row] = energy_from_sun_j
+        outputs.hvac_energy_j[row] = energy_from_hvac_j
+        outputs.hvac_mode[row] = hvac_mode
+        outputs.net_energy_j[row] = total_energy_in_j
+        outputs.delta_t[row] = delta_t
+        indoor_temperature_c = indoor_temperature_c + delta_t
+        outputs.indoor_temperature_c[row] = indoor_temperature_c
+
+    # Doesn't depend on the state, so it's done for all timesteps at once
+    outputs.hvac_energy_use_kwh[:] = np.abs(outputs.hvac_energy_j) / constants.hvac_joules_per_kwh_used
+    return outputs
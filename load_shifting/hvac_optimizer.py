@@ -0,0 +1,133 @@
+"""
+Minimum-CO2 HVAC control by dynamic programming, the "exactly correct" answer that
+smart_hvac_algorithm's comments talk about: with the whole year's weather and CO2
+intensity known, when should the HVAC run to keep the home within its comfort bounds
+for the least CO2?
+
+The indoor temperature is put on a grid (GRID_STEP_C apart, from a degree below the
+comfort range to a degree above). Working backwards from the last timestep, for every
+grid temperature we try the three things the HVAC can do (off, heat, cool) and keep the
+cheapest of
+
+    pounds of CO2 for the HVAC's kWh this step
+    + COMFORT_PENALTY for every degree the step ends up outside the comfort bounds
+    + the cheapest cost from the temperature the step ends at onwards
+
+with the cost-to-go between grid points interpolated linearly. The next temperatures
+are worked out for the whole grid at once, so each timestep is a few array operations
+over a few hundred values, and a year of hourly steps solves in well under a second.
+
+The result is an OptimalHVACPolicy holding the cost-to-go for every timestep. Its
+decide() picks the cheapest action from the actual (not grid) indoor temperature,
+so the simulation loop stays closed-loop: a home that ends up somewhere off-grid
+still gets the best action from where it is. The comfort bounds are soft, so a home
+whose HVAC can't keep up still gets a schedule (the one that stays closest to them).
+"""
+
+from dataclasses import dataclass, astuple
+
+import numpy as np
+
+from .house_simulation import (AIR_VOLUMETRIC_HEAT_CAPACITY, HVAC_OFF, HVAC_HEATING, HVAC_COOLING,
+                               house_constants, simulation_inputs, _exact_step_energies)
+
+
+GRID_STEP_C = 0.05
+# How far outside the comfort bounds the grid goes
+GRID_MARGIN_C = 1
+# Pounds of CO2 that a degree-hour outside the comfort bounds is "worth". Running a 10 kW
+# HVAC for an hour costs ~10 pounds, so this makes the bounds nearly hard.
+COMFORT_PENALTY = 100
+
+ACTIONS = np.array([HVAC_OFF, HVAC_HEATING, HVAC_COOLING])
+
+
+def _next_temperatures(indoor_temperature_c, row, hvac_energy_j, constants, inputs, solver):
+    # Indoor temperature at the end of timestep row, the same way simulate_house works it
+    # out; indoor_temperature_c and hvac_energy_j broadcast against each other
+    dt_seconds = inputs.dt_seconds
+    outdoor_temperature_c = inputs.temp_air[row]
+    energy_from_sun_j = constants.window_solar_gain * inputs.irradiance[row] * dt_seconds
+    if constants.can_close_curtains:
+        energy_from_sun_j = np.where(indoor_temperature_c > constants.cooling_setpoint_c, energy_from_sun_j * 0.1, energy_from_sun_j)
+
+    if solver == "exact":
+        energy_from_conduction_j, energy_from_air_change_j = _exact_step_energies(
+            outdoor_temperature_c, indoor_temperature_c, energy_from_sun_j, hvac_energy_j, constants, dt_seconds)
+    else:
+        temperature_difference_c = outdoor_temperature_c - indoor_temperature_c
+        energy_from_conduction_j = temperature_difference_c * constants.surface_area_sq_m / constants.wall_insulation_r_value_si * dt_seconds
+        energy_from_air_change_j = temperature_difference_c * constants.air_change_volume * AIR_VOLUMETRIC_HEAT_CAPACITY
+
+    total_energy_in_j = energy_from_conduction_j + energy_from_air_change_j + energy_from_sun_j + hvac_energy_j
+    return indoor_temperature_c + total_energy_in_j / constants.building_heat_capacity
+
+
+@dataclass
+class OptimalHVACPolicy:
+    constants: object               # HouseConstants
+    inputs: object                  # SimulationInputs
+    solver: str
+    comfort_min_c: float
+    comfort_max_c: float
+    grid: np.ndarray                # indoor temperatures
+    cost_to_go: np.ndarray          # (timesteps + 1, grid size), pounds of CO2 (+ penalties)
+    action_energy_j: np.ndarray     # HVAC energy for each of ACTIONS
+    action_pounds_co2: np.ndarray   # (timesteps, actions)
+
+    def _step_costs(self, row, indoor_temperature_c):
+        next_temperatures = _next_temperatures(
+            indoor_temperature_c, row, self.action_energy_j, self.constants, self.inputs, self.solver)
+        discomfort = np.maximum(self.comfort_min_c - next_temperatures, 0) + np.maximum(next_temperatures - self.comfort_max_c, 0)
+        return self.action_pounds_co2[row] + COMFORT_PENALTY * discomfort * self.inputs.dt_seconds / 3600 + \
+            np.interp(next_temperatures, self.grid, self.cost_to_go[row + 1])
+
+    def decide(self, row, indoor_temperature_c):
+        # (hvac_mode, energy_from_hvac_j) that's cheapest from here
+        action = int(np.argmin(self._step_costs(row, np.full(len(ACTIONS), float(indoor_temperature_c)))))
+        return ACTIONS[action], self.action_energy_j[action]
+
+
+def optimal_hvac_policy(home, inputs, comfort_min_c=None, comfort_max_c=None, solver="euler", grid_step_c=GRID_STEP_C):
+    """
+    Solve for the minimum-CO2 way to run home's HVAC over all of inputs (a
+    house_simulation.SimulationInputs), keeping the indoor temperature between
+    comfort_min_c and comfort_max_c, by default the heating and cooling setpoints.
+    """
+    if comfort_min_c is None:
+        comfort_min_c = home.heating_setpoint_c
+    if comfort_max_c is None:
+        comfort_max_c = home.cooling_setpoint_c
+    constants = house_constants(home, inputs.dt_seconds)
+    grid = np.arange(comfort_min_c - GRID_MARGIN_C, comfort_max_c + GRID_MARGIN_C + grid_step_c / 2, grid_step_c)
+
+    action_energy_j = np.array([0.0, constants.hvac_energy_j, -constants.hvac_energy_j])
+    action_kwh = np.abs(action_energy_j) / constants.hvac_joules_per_kwh_used
+    action_pounds_co2 = inputs.co2_intensity[:, np.newaxis] * action_kwh
+    timesteps = len(inputs.temp_air)
+
+    policy = OptimalHVACPolicy(
+        constants=constants, inputs=inputs, solver=solver, comfort_min_c=comfort_min_c, comfort_max_c=comfort_max_c,
+        grid=grid, cost_to_go=np.zeros((timesteps + 1, len(grid))),
+        action_energy_j=action_energy_j, action_pounds_co2=action_pounds_co2)
+    # Grid temperatures down, actions across
+    grid_by_action = np.repeat(grid[:, np.newaxis], len(ACTIONS), axis=1)
+    for row in range(timesteps - 1, -1, -1):
+        policy.cost_to_go[row] = policy._step_costs(row, grid_by_action).min(axis=1)
+    return policy
+
+
+# optimal_hvac_algorithm gets called once per timestep with the same home and frame, so
+# the solved policies are kept here (with their frames, so the ids can't be reused)
+_policies_by_frame = {}
+MAX_CACHED_POLICIES = 8
+
+
+def cached_optimal_hvac_policy(home, weather_with_co2_timeseries):
+    key = (id(weather_with_co2_timeseries), astuple(home))
+    if not key in _policies_by_frame:
+        if len(_policies_by_frame) >= MAX_CACHED_POLICIES:
+            _policies_by_frame.clear()
+        _policies_by_frame[key] = (weather_with_co2_timeseries,
+                                   optimal_hvac_policy(home, simulation_inputs(weather_with_co2_timeseries)))
+    return _policies_by_frame[key][1]
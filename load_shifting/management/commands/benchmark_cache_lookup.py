@@ -0,0 +1,71 @@
+import datetime
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from load_shifting.caching import canonical_cache_key
+from load_shifting.models import AllPurposeCSVCache
+
+
+BENCHMARK_FUNCTION_NAME = "benchmark_cache_lookup"
+
+
+class Command(BaseCommand):
+    help = (
+        "Time cache_csv lookups as the AllPurposeCSVCache table grows, comparing the "
+        "indexed key_hash lookup with the old filter on key_params_json + dates. "
+        "Runs inside a transaction that is rolled back, so no rows are left behind."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", nargs="+", type=int, default=[100, 1000, 10000, 100000])
+        parser.add_argument("--lookups", type=int, default=200)
+
+    def handle(self, *args, **options):
+        start_date = datetime.datetime(year=2024, month=4, day=1, tzinfo=datetime.timezone.utc)
+        end_date = datetime.datetime(year=2024, month=4, day=30, tzinfo=datetime.timezone.utc)
+
+        def params_for(i):
+            return {"url_segment": "fuel-type-data", "facets": {"respondent": ["BA{}".format(i)]}}
+
+        self.stdout.write("{:>8}  {:>14}  {:>14}".format("rows", "key_hash (ms)", "old filter (ms)"))
+        with transaction.atomic():
+            rows_inserted = 0
+            for size in sorted(options["sizes"]):
+                AllPurposeCSVCache.objects.bulk_create([
+                    AllPurposeCSVCache(
+                        cache_function_name = BENCHMARK_FUNCTION_NAME,
+                        cached_date = timezone.now(),
+                        key_params_json = json.dumps(params_for(i)),
+                        start_date = start_date,
+                        end_date = end_date,
+                        frame_data = b"",
+                        key_hash = canonical_cache_key(BENCHMARK_FUNCTION_NAME, params_for(i), start_date, end_date))
+                    for i in range(rows_inserted, size)
+                ], batch_size=5000)
+                rows_inserted = size
+
+                probes = [params_for(i * size // options["lookups"]) for i in range(options["lookups"])]
+
+                started = time.perf_counter()
+                for params in probes:
+                    key_hash = canonical_cache_key(BENCHMARK_FUNCTION_NAME, params, start_date, end_date)
+                    AllPurposeCSVCache.objects.filter(key_hash=key_hash).first()
+                hashed_ms = (time.perf_counter() - started) * 1000 / len(probes)
+
+                started = time.perf_counter()
+                for params in probes:
+                    cache_hits = AllPurposeCSVCache.objects.filter(
+                        cache_function_name = BENCHMARK_FUNCTION_NAME,
+                        key_params_json = json.dumps(params),
+                        start_date = start_date,
+                        end_date = end_date)
+                    if cache_hits.count() > 0:
+                        cache_hits[0]
+                old_ms = (time.perf_counter() - started) * 1000 / len(probes)
+
+                self.stdout.write("{:>8}  {:>14.3f}  {:>14.3f}".format(size, hashed_ms, old_ms))
+            transaction.set_rollback(True)
@@ -0,0 +1,132 @@
+import contextlib
+import datetime
+import io
+import time
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand
+
+from load_shifting.api_fixtures import replay_api_fixtures
+from load_shifting.utils import consumption_by_source_ba_from_frames, get_eia_timeseries, categorize_eia_key_columns
+
+
+def legacy_consumption_by_source_ba(balancing_authority, demand_df, interchange_df):
+    # The per-timestamp groupby().apply() version of compute_hourly_consumption_by_source_ba,
+    # kept here to compare against.
+    def get_energy_generated_and_consumed_locally(df):
+        demand_stats = df.groupby("type-name", observed=True)["Demand (MWh)"].sum()
+        try:
+            return min(demand_stats["Demand"], demand_stats["Net generation"])
+        except KeyError:
+            print(f'Warning - either Demand or Net generation is missing from this timestamp. Values found for "type-name": {list(demand_stats.index)}')
+            return 0
+
+    energy_generated_and_used_locally = demand_df.groupby("timestamp").apply(
+        get_energy_generated_and_consumed_locally
+    )
+    consumed_locally_column_name = "Power consumed locally (MWh)"
+    energy_imported_then_consumed_locally_by_source_ba = (
+        interchange_df.groupby(["timestamp", "fromba"], observed=True)[
+            "Interchange to local BA (MWh)"
+        ].sum()
+        .apply(lambda interchange: max(interchange, 0))
+    )
+    energy_consumed_locally_by_source_ba = pd.concat(
+        [
+            energy_imported_then_consumed_locally_by_source_ba.rename(
+                consumed_locally_column_name
+            ).reset_index("fromba"),
+            pd.DataFrame(
+                {
+                    "fromba": balancing_authority,
+                    consumed_locally_column_name: energy_generated_and_used_locally,
+                }
+            ),
+        ]
+    ).reset_index()
+    energy_consumed_locally_by_source_ba['timestamp'] = pd.to_datetime( energy_consumed_locally_by_source_ba.timestamp )
+    return energy_consumed_locally_by_source_ba
+
+
+def synthetic_year(balancing_authority, year, neighbors, gap_fraction, seed=0):
+    """
+    A year of hourly D/NG/TI and interchange rows shaped like the EIA data (fixed UTC-8
+    offset, newest first), with gap_fraction of the Demand and Net generation rows dropped.
+    """
+    rng = np.random.default_rng(seed)
+    timestamps = pd.date_range(
+        datetime.datetime(year, 1, 1), datetime.datetime(year, 12, 31, 23), freq="h",
+        tz=datetime.timezone(datetime.timedelta(hours=-8)))[::-1]
+    hours = len(timestamps)
+
+    demand = rng.uniform(15000, 35000, hours)
+    generation = demand + rng.normal(-3000, 3000, hours)
+    demand_df = pd.DataFrame({
+        "timestamp": np.repeat(timestamps, 3),
+        "respondent": balancing_authority,
+        "type-name": np.tile(["Demand", "Net generation", "Total interchange"], hours),
+        "Demand (MWh)": np.column_stack([demand, generation, generation - demand]).ravel(),
+    })
+    dropped = (demand_df["type-name"] != "Total interchange") & (rng.random(len(demand_df)) < gap_fraction)
+    demand_df = demand_df[~dropped].reset_index(drop=True)
+
+    interchange_df = pd.DataFrame({
+        "timestamp": np.repeat(timestamps, len(neighbors)),
+        "fromba": np.tile(neighbors, hours),
+        "toba": balancing_authority,
+        "Interchange to local BA (MWh)": rng.normal(200, 800, hours * len(neighbors)),
+    })
+    return categorize_eia_key_columns(demand_df), categorize_eia_key_columns(interchange_df)
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the vectorized compute_hourly_consumption_by_source_ba calculation against "
+        "the old per-timestamp groupby().apply() version, on a year of hourly data, and "
+        "check that both give the same result. Uses synthetic CISO-shaped data, or real "
+        "data replayed from fixtures recorded with record_api_fixtures."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--ba", default="CISO")
+        parser.add_argument("--year", type=int, default=2023)
+        parser.add_argument("--fixtures", help="Directory of recorded API fixtures covering the year")
+        parser.add_argument("--gap-fraction", type=float, default=0.01)
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **options):
+        ba = options["ba"]
+        if options["fixtures"]:
+            start_date = datetime.datetime(options["year"], 1, 1)
+            end_date = datetime.datetime(options["year"], 12, 31)
+            kwargs = dict(start_date=start_date, end_date=end_date, frequency="local-hourly", include_timezone=False)
+            with replay_api_fixtures(options["fixtures"]):
+                demand_df = get_eia_timeseries(
+                    "region-data", {"respondent": [ba], "type": ["D", "NG", "TI"]}, value_column_name="Demand (MWh)", **kwargs)
+                interchange_df = get_eia_timeseries(
+                    "interchange-data", {"toba": [ba]}, value_column_name="Interchange to local BA (MWh)", **kwargs)
+        else:
+            neighbors = ["BANC", "BPAT", "IID", "LDWP", "NEVP", "PACW", "SRP", "TIDC", "WALC"]
+            demand_df, interchange_df = synthetic_year(ba, options["year"], neighbors, options["gap_fraction"])
+        self.stdout.write("{} demand rows, {} interchange rows".format(len(demand_df), len(interchange_df)))
+
+        def timed(function):
+            best = None
+            for _ in range(options["repeat"]):
+                started = time.perf_counter()
+                # The old version prints a warning per gap
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = function(ba, demand_df, interchange_df)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            return result, best
+
+        legacy_result, legacy_seconds = timed(legacy_consumption_by_source_ba)
+        vectorized_result, vectorized_seconds = timed(consumption_by_source_ba_from_frames)
+
+        pd.testing.assert_frame_equal(
+            legacy_result.astype({"fromba": str}), vectorized_result.astype({"fromba": str}))
+        self.stdout.write("old groupby().apply(): {:.3f} s".format(legacy_seconds))
+        self.stdout.write("vectorized:            {:.3f} s ({:.0f}x faster), same result".format(
+            vectorized_seconds, legacy_seconds / vectorized_seconds))
@@ -0,0 +1,108 @@
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand
+
+from load_shifting.management.commands.benchmark_consumption_by_source_ba import synthetic_year
+from load_shifting.utils import EMISSIONS_BY_FUEL, consumption_by_source_ba_from_frames, fuel_mix_after_import_export_from_frames
+
+
+FUEL_TYPES = ["Coal", "Hydro", "Natural gas", "Nuclear", "Other", "Petroleum", "Solar", "Wind"]
+
+
+def legacy_fuel_mix_after_import_export(generation_types_by_ba, energy_consumed_locally_by_source_ba):
+    # The groupby / join / merge version of compute_hourly_fuel_mix_after_import_export,
+    # kept here to compare against.
+    total_generation_by_source_ba = generation_types_by_ba.groupby(["timestamp", "fromba"], observed=True)[
+        "Generation (MWh)"
+    ].sum()
+    generation_types_by_ba_with_totals = generation_types_by_ba.join(
+        total_generation_by_source_ba,
+        how="left",
+        on=["timestamp", "fromba"],
+        rsuffix=" Total",
+    )
+    generation_types_by_ba_with_totals["Generation (% of BA generation)"] = (
+        generation_types_by_ba_with_totals["Generation (MWh)"]
+        / generation_types_by_ba_with_totals["Generation (MWh) Total"]
+    )
+    generation_types_by_ba_with_totals_and_source_ba_breakdown = generation_types_by_ba_with_totals.merge(
+        energy_consumed_locally_by_source_ba.rename(
+            {"Power consumed locally (MWh)": "Power consumed locally from source BA (MWh)"},
+            axis="columns",
+        ),
+        on=["timestamp", "fromba"],
+    )
+    full_df_reindexed = (
+        generation_types_by_ba_with_totals_and_source_ba_breakdown.set_index(
+            ["timestamp", "fromba", "generation_type"]
+        )
+    )
+    usage_by_ba_and_generation_type = (
+        (
+            full_df_reindexed["Power consumed locally from source BA (MWh)"]
+            * full_df_reindexed["Generation (% of BA generation)"]
+        )
+        .rename("Usage (MWh)")
+        .reset_index()
+    )
+    usage_by_ba_and_generation_type["emissions_per_kwh"] = usage_by_ba_and_generation_type["generation_type"].apply(lambda x: EMISSIONS_BY_FUEL[x])
+    usage_by_ba_and_generation_type["emissions"] = usage_by_ba_and_generation_type["emissions_per_kwh"] * usage_by_ba_and_generation_type["Usage (MWh)"] * 1000
+    return usage_by_ba_and_generation_type
+
+
+def synthetic_generation(timestamps, bas, seed=0):
+    # Hourly generation by fuel type for each BA, newest first like the EIA data
+    rng = np.random.default_rng(seed)
+    rows = len(timestamps) * len(bas) * len(FUEL_TYPES)
+    return pd.DataFrame({
+        "timestamp": np.repeat(timestamps, len(bas) * len(FUEL_TYPES)),
+        "fromba": pd.Categorical(np.tile(np.repeat(bas, len(FUEL_TYPES)), len(timestamps))),
+        "generation_type": pd.Categorical(np.tile(FUEL_TYPES, len(timestamps) * len(bas))),
+        "Generation (MWh)": rng.uniform(0, 5000, rows),
+    })
+
+
+def comparable(df):
+    return df.astype({"fromba": str, "generation_type": str, "emissions_per_kwh": np.float64}).reset_index(drop=True)
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the dense array compute_hourly_fuel_mix_after_import_export calculation "
+        "against the old groupby/join/merge version on synthetic hourly data, with peak "
+        "memory, and check that both give the same result."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--ba", default="CISO")
+        parser.add_argument("--year", type=int, default=2023)
+        parser.add_argument("--neighbors", type=int, default=9)
+
+    def handle(self, *args, **options):
+        ba = options["ba"]
+        neighbors = ["N{:02d}".format(i) for i in range(options["neighbors"])]
+        demand_df, interchange_df = synthetic_year(ba, options["year"], neighbors, gap_fraction=0.01)
+        consumption_df = consumption_by_source_ba_from_frames(ba, demand_df, interchange_df)
+        generation_df = synthetic_generation(demand_df["timestamp"].unique(), [ba] + neighbors)
+        self.stdout.write("{} generation rows, {} consumption rows".format(len(generation_df), len(consumption_df)))
+
+        def measure(function):
+            tracemalloc.start()
+            started = time.perf_counter()
+            result = function(generation_df.copy(), consumption_df.copy())
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return result, elapsed, peak / 1e6
+
+        legacy_result, legacy_seconds, legacy_mb = measure(legacy_fuel_mix_after_import_export)
+        dense_result, dense_seconds, dense_mb = measure(fuel_mix_after_import_export_from_frames)
+
+        pd.testing.assert_frame_equal(comparable(legacy_result), comparable(dense_result))
+        self.stdout.write("groupby/join/merge: {:.3f} s, peak {:.0f} MB, result {:.0f} MB".format(
+            legacy_seconds, legacy_mb, legacy_result.memory_usage(deep=True).sum() / 1e6))
+        self.stdout.write("dense arrays:       {:.3f} s, peak {:.0f} MB, result {:.0f} MB, same result".format(
+            dense_seconds, dense_mb, dense_result.memory_usage(deep=True).sum() / 1e6))
@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand
+
+from load_shifting.house_simulation import simulation_inputs, simulate_house, simulate_houses
+from load_shifting.synthetic_data import legacy_model_one_house, synthetic_weather_with_co2, example_home, home_variants
+from load_shifting.utils import model_one_house
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the array-based model_one_house against the old one-calculate_next_timestep-"
+        "per-row version, on a synthetic year of hourly weather and CO2 intensity, and "
+        "check that both give the same result. Then time --homes home variants stepped "
+        "together with simulate_houses."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--year", type=int, default=2022)
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--homes", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        weather_with_co2 = synthetic_weather_with_co2(options["year"])
+        self.stdout.write("{} hourly timesteps".format(len(weather_with_co2)))
+
+        for smart in [False, True]:
+            home = example_home(smart)
+            started = time.perf_counter()
+            legacy_result = legacy_model_one_house(home, weather_with_co2)
+            legacy_seconds = time.perf_counter() - started
+
+            array_seconds = []
+            for _ in range(options["repeat"]):
+                started = time.perf_counter()
+                array_result = model_one_house(home, weather_with_co2)
+                array_seconds.append(time.perf_counter() - started)
+
+            pd.testing.assert_frame_equal(legacy_result.infer_objects(), array_result, check_dtype=False)
+            self.stdout.write("{} HVAC: per-timestep Series {:.3f} s, arrays {:.3f} s (best of {}), {:.0f}x, same result".format(
+                "smart" if smart else "basic", legacy_seconds, min(array_seconds), options["repeat"],
+                legacy_seconds / min(array_seconds)))
+
+        homes = home_variants(options["homes"])
+        inputs = simulation_inputs(weather_with_co2)
+        started = time.perf_counter()
+        outputs = simulate_houses(homes, inputs)
+        batch_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        checked = list(range(0, len(homes), max(len(homes) // 20, 1)))
+        for home_number in checked:
+            single = simulate_house(homes[home_number], inputs)
+            np.testing.assert_array_equal(single.indoor_temperature_c, outputs.for_home(home_number).indoor_temperature_c)
+            np.testing.assert_array_equal(single.hvac_mode, outputs.for_home(home_number).hvac_mode)
+        single_seconds = (time.perf_counter() - started) / len(checked)
+        self.stdout.write("{} homes stepped together: {:.3f} s, {:.1f} single-home array runs' worth, "
+                          "{} of them checked to give the same result".format(
+                              len(homes), batch_seconds, batch_seconds / single_seconds, len(checked)))
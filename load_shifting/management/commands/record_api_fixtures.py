@@ -0,0 +1,63 @@
+import datetime
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from load_shifting.api_fixtures import record_api_fixtures
+from load_shifting.utils import get_eia_timeseries, get_psm3
+
+
+class Command(BaseCommand):
+    help = (
+        "Fetch (bypassing the cache) the EIA data the load shifting pipeline needs for one "
+        "balancing authority and its neighbors, and optionally the PSM3 solar weather for "
+        "one location, saving the responses as fixtures that serve_api_fixtures can replay. "
+        "Needs real EIA (and NREL) API keys."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("output_directory")
+        parser.add_argument("--ba", default="CISO")
+        parser.add_argument("--start", default="2024-04-01", help="YYYY-MM-DD")
+        parser.add_argument("--end", default="2024-04-30", help="YYYY-MM-DD")
+        parser.add_argument("--daily", action="store_true", help="Also record the daily-* data used by the energy mix charts")
+        parser.add_argument("--latitude", type=float)
+        parser.add_argument("--longitude", type=float)
+
+    def handle(self, *args, **options):
+        ba = options["ba"]
+        start_date = datetime.datetime.strptime(options["start"], "%Y-%m-%d")
+        end_date = datetime.datetime.strptime(options["end"], "%Y-%m-%d")
+
+        variants = [("", "local-hourly", False)]
+        if options["daily"]:
+            variants.append(("daily-", "daily", True))
+
+        with record_api_fixtures(options["output_directory"]):
+            for prefix, frequency, include_timezone in variants:
+                kwargs = dict(start_date=start_date, end_date=end_date, frequency=frequency, include_timezone=include_timezone)
+
+                # Same queries as compute_hourly_consumption_by_source_ba and
+                # compute_hourly_fuel_mix_after_import_export
+                interchange_df = get_eia_timeseries(
+                    prefix + "interchange-data", {"toba": [ba]},
+                    value_column_name="Interchange to local BA (MWh)", **kwargs)
+                get_eia_timeseries(
+                    prefix + "region-data", {"respondent": [ba], "type": ["D", "NG", "TI"]},
+                    value_column_name="Demand (MWh)", **kwargs)
+                source_bas = sorted(set([ba] + interchange_df["fromba"].astype(str).unique().tolist()))
+                get_eia_timeseries(
+                    prefix + "fuel-type-data", {"respondent": source_bas},
+                    value_column_name="Generation (MWh)", **kwargs)
+                self.stdout.write("Recorded {}{} data for {}".format(prefix, frequency, ", ".join(source_bas)))
+
+            if options["latitude"] is not None and options["longitude"] is not None:
+                get_psm3(
+                    latitude=options["latitude"],
+                    longitude=options["longitude"],
+                    year=end_date.year,
+                    api_key=os.getenv("NREL_API_KEY") or settings.NREL_API_KEY,
+                    email=os.getenv("NREL_API_EMAIL") or settings.NREL_API_EMAIL,
+                )
+                self.stdout.write("Recorded PSM3 solar weather for {}, {}".format(options["latitude"], options["longitude"]))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from load_shifting.api_fixtures import FixtureServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local stand-in for the EIA and NREL APIs that replays fixtures saved by "
+        "record_api_fixtures. Start the app with the printed EIA_API_URL and NREL_PSM3_URL "
+        "environment variables (and any non-empty API keys) to use it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("fixture_directory")
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--latency", type=float, default=0.25, help="Seconds added to every response")
+        parser.add_argument("--seconds-per-thousand-rows", type=float, default=0.1,
+                            help="Extra seconds per thousand EIA rows returned")
+
+    def handle(self, *args, **options):
+        server = FixtureServer(
+            options["fixture_directory"],
+            host=options["host"],
+            port=options["port"],
+            latency_seconds=options["latency"],
+            seconds_per_thousand_rows=options["seconds_per_thousand_rows"],
+        )
+        for name, url in server.api_urls().items():
+            self.stdout.write("{}={}".format(name, url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
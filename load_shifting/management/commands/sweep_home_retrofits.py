@@ -0,0 +1,97 @@
+import datetime
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from load_shifting.parameter_sweep import grid_scenarios, sampled_scenarios, run_sweep, DEFAULT_CHUNK_SIZE
+from load_shifting.utils import HomeCharacteristics, get_weather_with_co2
+from load_shifting.synthetic_data import synthetic_weather_with_co2
+
+
+# The "old home" of home_simulation_json, in Jeffersonville, Vermont
+BASE_HOME = dict(
+    latitude=44.64536116761554, longitude=-72.82704009279546,
+    heating_setpoint_c=20, cooling_setpoint_c=22,
+    hvac_capacity_w=10000, hvac_overall_system_efficiency=1,
+    conditioned_floor_area_sq_m=200, ceiling_height_m=3,
+    wall_insulation_r_value_imperial=11, ach50=10,
+    south_facing_window_size_sq_m=10, window_solar_heat_gain_coefficient=0.5,
+    can_close_curtains=False, smart_hvac_algorithm=False,
+)
+
+
+def parse_value(text):
+    if text.lower() in ["true", "false"]:
+        return text.lower() == "true"
+    number = float(text)
+    return int(number) if number.is_integer() and not "." in text else number
+
+
+def parse_assignments(assignments, separator):
+    # ["field=a,b,c", ...] -> {field: [a, b, c]} (or [low, high] with separator ":")
+    parsed = {}
+    for assignment in assignments:
+        field, _, values = assignment.partition("=")
+        if not values:
+            raise CommandError("Expected field=values, got {!r}".format(assignment))
+        parsed[field] = [parse_value(value) for value in values.split(separator)]
+    return parsed
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate a home over a year with many combinations of retrofit parameters, e.g. "
+        "--grid wall_insulation_r_value_imperial=11,19,27 --grid ach50=10,5,1.5 --grid "
+        "hvac_overall_system_efficiency=1,3, and write annual kWh, pounds of CO2 and comfort "
+        "violations for each to a CSV file, as they finish. Running again with the same "
+        "arguments and output file carries on where an interrupted sweep stopped. With "
+        "--samples N, draws N random scenarios instead: --grid values are chosen from and "
+        "--uniform field=low:high ranges drawn from. Uses real weather and CO2 intensity "
+        "(needs API keys or cached data) unless --synthetic-year is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("output")
+        parser.add_argument("--grid", action="append", default=[], help="field=value,value,...")
+        parser.add_argument("--uniform", action="append", default=[], help="field=low:high, with --samples")
+        parser.add_argument("--samples", type=int)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--base", default="{}", help="JSON of HomeCharacteristics fields to change from the default home")
+        parser.add_argument("--ba", default="CISO")
+        parser.add_argument("--year", type=int, default=2022)
+        parser.add_argument("--synthetic-year", type=int, help="Use synthetic weather and CO2 intensity for this year")
+        parser.add_argument("--solver", default="euler")
+        parser.add_argument("--lookahead-kernel")
+        parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+        parser.add_argument("--workers", type=int)
+
+    def handle(self, *args, **options):
+        base_home = HomeCharacteristics(**{**BASE_HOME, **json.loads(options["base"])})
+
+        grids = parse_assignments(options["grid"], ",")
+        ranges = parse_assignments(options["uniform"], ":")
+        if options["samples"] is not None:
+            distributions = {**grids, **{field: tuple(values) for field, values in ranges.items()}}
+            scenarios = sampled_scenarios(distributions, options["samples"], options["seed"])
+        elif ranges:
+            raise CommandError("--uniform needs --samples")
+        else:
+            scenarios = grid_scenarios(grids)
+
+        if options["synthetic_year"] is not None:
+            weather_with_co2 = synthetic_weather_with_co2(options["synthetic_year"])
+        else:
+            weather_with_co2 = get_weather_with_co2(
+                base_home.latitude, base_home.longitude, options["ba"],
+                datetime.datetime(options["year"], 1, 1), datetime.datetime(options["year"], 12, 31))
+
+        started = time.perf_counter()
+        try:
+            count = run_sweep(base_home, scenarios, weather_with_co2, options["output"],
+                              chunk_size=options["chunk_size"], max_workers=options["workers"],
+                              solver=options["solver"], lookahead_kernel=options["lookahead_kernel"])
+        except ValueError as e:
+            raise CommandError(e)
+        self.stdout.write("Ran {} of {} scenarios in {:.1f} s, results in {}".format(
+            count, len(scenarios), time.perf_counter() - started, options["output"]))
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 01:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('load_shifting', '0005_remove_obsolete_cache_tables'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='allpurposecsvcache',
+            name='frame_data',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='allpurposecsvcache',
+            name='raw_csv',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
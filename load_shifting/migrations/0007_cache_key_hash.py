@@ -0,0 +1,68 @@
+# Generated by Django 4.2 on 2026-10-18 01:18
+
+import datetime
+import hashlib
+import json
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+# Frozen copies of caching._canonical_datetime and caching.canonical_cache_key as they
+# were when this migration was written, so that changing those later can't change what
+# this migration does.
+def _canonical_datetime(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime(year=value.year, month=value.month, day=value.day)
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return value.astimezone(datetime.timezone.utc).isoformat()
+
+
+def canonical_cache_key(function_name, key_params, start_date, end_date):
+    if isinstance(key_params, str):
+        key_params = json.loads(key_params)
+    canonical_json = json.dumps({
+        "function": function_name,
+        "params": key_params,
+        "start_date": _canonical_datetime(start_date),
+        "end_date": _canonical_datetime(end_date),
+    }, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical_json.encode("utf-8")).hexdigest()
+
+
+def backfill_key_hashes(apps, schema_editor):
+    # Give every existing row its key hash. Duplicate rows (possible before key_hash was
+    # unique) are collapsed into the most recently cached one.
+    AllPurposeCSVCache = apps.get_model("load_shifting", "AllPurposeCSVCache")
+    seen_hashes = set()
+    for cache_row in AllPurposeCSVCache.objects.order_by("-cached_date", "-id"):
+        key_hash = canonical_cache_key(
+            cache_row.cache_function_name, cache_row.key_params_json,
+            cache_row.start_date, cache_row.end_date)
+        if key_hash in seen_hashes:
+            cache_row.delete()
+            continue
+        seen_hashes.add(key_hash)
+        cache_row.key_hash = key_hash
+        cache_row.save(update_fields=["key_hash"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('load_shifting', '0006_cache_binary_frame_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='allpurposecsvcache',
+            name='key_hash',
+            field=models.CharField(max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_key_hashes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2 on 2026-10-18 01:20
+
+import hashlib
+import json
+
+from django.db import migrations, models
+
+
+# Frozen copy of caching.canonical_params_key as it was when this migration was written
+def canonical_params_key(function_name, key_params):
+    if isinstance(key_params, str):
+        key_params = json.loads(key_params)
+    canonical_json = json.dumps({
+        "function": function_name,
+        "params": key_params,
+    }, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical_json.encode("utf-8")).hexdigest()
+
+
+def backfill_params_hashes(apps, schema_editor):
+    AllPurposeCSVCache = apps.get_model("load_shifting", "AllPurposeCSVCache")
+    for cache_row in AllPurposeCSVCache.objects.all():
+        cache_row.params_hash = canonical_params_key(
+            cache_row.cache_function_name, cache_row.key_params_json)
+        cache_row.save(update_fields=["params_hash"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('load_shifting', '0007_cache_key_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='allpurposecsvcache',
+            name='params_hash',
+            field=models.CharField(db_index=True, max_length=64, null=True),
+        ),
+        migrations.RunPython(backfill_params_hashes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2 on 2026-10-18 01:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('load_shifting', '0008_cache_params_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheFillLock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lock_key', models.CharField(max_length=64, unique=True)),
+                ('owner', models.CharField(max_length=128)),
+                ('acquired_at', models.DateTimeField()),
+            ],
+        ),
+    ]
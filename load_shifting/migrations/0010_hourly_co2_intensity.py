@@ -0,0 +1,49 @@
+# Generated by Django 4.2 on 2026-10-18 01:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('load_shifting', '0009_cache_fill_lock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HourlyCO2Intensity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ba', models.CharField(max_length=16)),
+                ('timestamp', models.DateTimeField()),
+                ('utc_offset_minutes', models.SmallIntegerField()),
+                ('local_date', models.DateField()),
+                ('usage_mwh', models.FloatField()),
+                ('emissions', models.FloatField()),
+                ('pounds_co2_per_kwh', models.FloatField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MaterializedDateRange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table_name', models.CharField(max_length=64)),
+                ('ba', models.CharField(max_length=16)),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField()),
+                ('materialized_date', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='materializeddaterange',
+            index=models.Index(fields=['table_name', 'ba', 'start_date'], name='load_shifti_table_n_fc42b2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='hourlyco2intensity',
+            index=models.Index(fields=['ba', 'local_date'], name='load_shifti_ba_c81212_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='hourlyco2intensity',
+            constraint=models.UniqueConstraint(fields=('ba', 'timestamp'), name='unique_hourly_co2_intensity'),
+        ),
+    ]
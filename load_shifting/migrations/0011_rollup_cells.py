@@ -0,0 +1,36 @@
+# Generated by Django 4.2 on 2026-10-18 01:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('load_shifting', '0010_hourly_co2_intensity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupCell',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('series', models.CharField(max_length=32)),
+                ('ba', models.CharField(max_length=16)),
+                ('fuel', models.CharField(blank=True, default='', max_length=32)),
+                ('period', models.CharField(max_length=8)),
+                ('period_start', models.DateField()),
+                ('hour_of_day', models.SmallIntegerField()),
+                ('hours', models.IntegerField()),
+                ('value_sum', models.FloatField()),
+                ('value_min', models.FloatField(null=True)),
+                ('value_max', models.FloatField(null=True)),
+                ('usage_mwh', models.FloatField()),
+                ('emissions', models.FloatField()),
+                ('histogram', models.BinaryField(null=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='rollupcell',
+            constraint=models.UniqueConstraint(fields=('series', 'ba', 'fuel', 'period', 'period_start', 'hour_of_day'), name='unique_rollup_cell'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2 on 2026-10-18 01:50
+
+from django.db import migrations, models
+
+
+def forget_co2_intensity_rollups(apps, schema_editor):
+    # Existing CO2 intensity cells have no sketch. Forgetting which days were materialized
+    # makes the next read recompute the hourly rows, and with them the cells.
+    apps.get_model("load_shifting", "RollupCell").objects.filter(series="co2_intensity").delete()
+    apps.get_model("load_shifting", "MaterializedDateRange").objects.filter(table_name="hourly_co2_intensity").delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('load_shifting', '0011_rollup_cells'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='rollupcell',
+            name='histogram',
+        ),
+        migrations.AddField(
+            model_name='rollupcell',
+            name='sketch',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(forget_co2_intensity_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 4.2 on 2026-10-18 01:52
+
+from django.db import migrations, models
+
+
+def label_existing_co2_rows(apps, schema_editor):
+    # Everything materialized so far used the EIA factors
+    apps.get_model("load_shifting", "MaterializedDateRange").objects.filter(
+        table_name="hourly_co2_intensity").update(emission_factors="eia-faq-74-v1")
+    apps.get_model("load_shifting", "RollupCell").objects.filter(
+        series="co2_intensity").update(emission_factors="eia-faq-74-v1")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('load_shifting', '0012_rollup_cell_sketches'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='hourlyco2intensity',
+            name='unique_hourly_co2_intensity',
+        ),
+        migrations.RemoveConstraint(
+            model_name='rollupcell',
+            name='unique_rollup_cell',
+        ),
+        migrations.RemoveIndex(
+            model_name='hourlyco2intensity',
+            name='load_shifti_ba_c81212_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='materializeddaterange',
+            name='load_shifti_table_n_fc42b2_idx',
+        ),
+        migrations.AddField(
+            model_name='hourlyco2intensity',
+            name='emission_factors',
+            field=models.CharField(default='eia-faq-74-v1', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='materializeddaterange',
+            name='emission_factors',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='rollupcell',
+            name='emission_factors',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.RunPython(label_existing_co2_rows, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='hourlyco2intensity',
+            index=models.Index(fields=['ba', 'emission_factors', 'local_date'], name='load_shifti_ba_3611d8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='materializeddaterange',
+            index=models.Index(fields=['table_name', 'ba', 'emission_factors', 'start_date'], name='load_shifti_table_n_75cefa_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='hourlyco2intensity',
+            constraint=models.UniqueConstraint(fields=('ba', 'emission_factors', 'timestamp'), name='unique_hourly_co2_intensity'),
+        ),
+        migrations.AddConstraint(
+            model_name='rollupcell',
+            constraint=models.UniqueConstraint(fields=('series', 'ba', 'fuel', 'emission_factors', 'period', 'period_start', 'hour_of_day'), name='unique_rollup_cell'),
+        ),
+    ]
@@ -7,8 +7,103 @@ class AllPurposeCSVCache(models.Model):
     key_params_json = models.TextField()
     start_date = models.DateTimeField()
     end_date = models.DateTimeField()
-    raw_csv = models.TextField()
-    
+    # Legacy storage: rows written before frame_data existed hold the frame as CSV text.
+    # They get converted to frame_data the first time they're read (see caching.read_cache_row)
+    raw_csv = models.TextField(blank=True, default="")
+    # Data frame in the binary columnar format from caching.serialize_frame
+    frame_data = models.BinaryField(null=True)
+    # caching.canonical_cache_key() of (function name, params, start date, end date).
+    # Unique, so lookups are a single indexed query and writes can upsert.
+    key_hash = models.CharField(max_length=64, unique=True, null=True)
+    # caching.canonical_params_key() of (function name, params), i.e. ignoring the dates.
+    # Used to find entries covering other date ranges of the same series.
+    params_hash = models.CharField(max_length=64, db_index=True, null=True)
 
+    def save(self, *args, **kwargs):
+        from .caching import canonical_cache_key, canonical_params_key
+        if self.key_hash is None:
+            self.key_hash = canonical_cache_key(
+                self.cache_function_name, self.key_params_json, self.start_date, self.end_date)
+        if self.params_hash is None:
+            self.params_hash = canonical_params_key(self.cache_function_name, self.key_params_json)
+        super().save(*args, **kwargs)
 
 
+class CacheFillLock(models.Model):
+    # One row per cache entry that some process is currently computing (see
+    # caching.run_single_flight). Other processes wanting the same entry wait for the row
+    # to go away instead of doing the same work.
+    lock_key = models.CharField(max_length=64, unique=True)
+    owner = models.CharField(max_length=128)
+    # When the lock was taken, then refreshed by the owner's heartbeat while it computes
+    acquired_at = models.DateTimeField()
+
+
+class HourlyCO2Intensity(models.Model):
+    # One row per (BA, hour) with the totals of cache_wrapped_hourly_gen_mix_by_ba_and_type's
+    # usage frame, so views can read a BA's intensity with an indexed range scan instead
+    # of loading and regrouping the whole BA x fuel x hour frame.
+    # Filled in by utils.get_hourly_co2_intensity as date ranges are requested.
+    ba = models.CharField(max_length=16)
+    # Name of the emission factor table the emissions were worked out with (emission_factors.py)
+    emission_factors = models.CharField(max_length=64)
+    # Start of the hour. Stored in UTC like all DateTimeFields; utc_offset_minutes is the
+    # offset of the local time EIA reported it in, so we can give back the same timestamps.
+    timestamp = models.DateTimeField()
+    utc_offset_minutes = models.SmallIntegerField()
+    local_date = models.DateField()
+    usage_mwh = models.FloatField()
+    emissions = models.FloatField()
+    pounds_co2_per_kwh = models.FloatField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["ba", "emission_factors", "timestamp"], name="unique_hourly_co2_intensity"),
+        ]
+        indexes = [
+            models.Index(fields=["ba", "emission_factors", "local_date"]),
+        ]
+
+
+class MaterializedDateRange(models.Model):
+    # Which days of a materialized table (e.g. "hourly_co2_intensity") have been filled in
+    # for a BA. Needed because some hours legitimately have no rows.
+    table_name = models.CharField(max_length=64)
+    ba = models.CharField(max_length=16)
+    # Emission factor table, for tables that depend on one
+    emission_factors = models.CharField(max_length=64, blank=True, default="")
+    start_date = models.DateField()
+    end_date = models.DateField()
+    materialized_date = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["table_name", "ba", "emission_factors", "start_date"]),
+        ]
+
+
+class RollupCell(models.Model):
+    # Mergeable aggregates of an hourly series (e.g. "co2_intensity", "generation") for one
+    # BA, fuel and calendar period, for one clock hour or all of them. See rollups.py.
+    series = models.CharField(max_length=32)
+    ba = models.CharField(max_length=16)
+    fuel = models.CharField(max_length=32, blank=True, default="")
+    # Emission factor table, for series that depend on one
+    emission_factors = models.CharField(max_length=64, blank=True, default="")
+    period = models.CharField(max_length=8)  # "day" or "month"
+    period_start = models.DateField()
+    hour_of_day = models.SmallIntegerField()  # 0-23, or rollups.ALL_HOURS
+    hours = models.IntegerField()
+    value_sum = models.FloatField()
+    value_min = models.FloatField(null=True)
+    value_max = models.FloatField(null=True)
+    usage_mwh = models.FloatField()
+    emissions = models.FloatField()
+    # Mergeable quantile sketch of the values, see quantile_sketch.py
+    sketch = models.BinaryField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["series", "ba", "fuel", "emission_factors", "period", "period_start", "hour_of_day"], name="unique_rollup_cell"),
+        ]
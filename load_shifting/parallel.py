@@ -0,0 +1,76 @@
+"""
+Run a function for each of a list of balancing authorities in a pool of worker
+processes, e.g. to fetch and crunch the EIA data of many BAs at once.
+
+Workers are started with "spawn" rather than forked, so they don't inherit the parent's
+database connections (which aren't safe to share across processes); each one sets up
+Django and opens its own, to the same databases the parent is using (so under tests,
+the test database). So functions passed in must be importable module-level functions,
+and their arguments and results picklable.
+
+Functions run in workers shouldn't read or write the database, though: SQLite allows one
+writer at a time, so several workers filling caches at once would mostly wait on each
+other or fail with "database is locked", and an in-memory test database can't be seen
+from another process at all. Have them return frames and store those in the calling
+process instead, like utils.prefetch_hourly_gen_mix does.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+
+
+def _setup_worker(databases=None):
+    import django
+    if databases is not None:
+        settings.DATABASES = databases
+    django.setup()
+
+
+def worker_databases():
+    # The parent's database settings as its connections see them (e.g. with the test
+    # database's NAME), for workers to connect to the same place
+    return {alias: dict(connections[alias].settings_dict) for alias in connections}
+
+
+def run_per_ba(function, ba_names, max_workers=None, skip_exceptions=(), **kwargs):
+    """
+    Call function(ba_name, **kwargs) for each BA, in up to max_workers processes (default
+    settings.LOAD_SHIFTING_MAX_WORKERS; 1 runs everything in this process).
+
+    A BA whose call raises one of skip_exceptions (e.g. (EIAAPIExeption,) for a BA without
+    data) is printed and left out, without affecting the others; any other exception is
+    raised. Returns [(ba_name, result), ...] in the order of ba_names, however the work was
+    scheduled.
+    """
+    if max_workers is None:
+        max_workers = getattr(settings, "LOAD_SHIFTING_MAX_WORKERS", 4)
+    ba_names = list(dict.fromkeys(ba_names))
+    results = {}
+
+    def skip(ba_name, error):
+        print("Couldn't compute {} for {}: {!r}".format(function.__name__, ba_name, error))
+
+    if max_workers <= 1 or len(ba_names) <= 1:
+        for ba_name in ba_names:
+            try:
+                results[ba_name] = function(ba_name, **kwargs)
+            except skip_exceptions as e:
+                skip(ba_name, e)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=min(max_workers, len(ba_names)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_setup_worker,
+            initargs=(worker_databases(),),
+        ) as executor:
+            futures = {ba_name: executor.submit(function, ba_name, **kwargs) for ba_name in ba_names}
+            for ba_name, future in futures.items():
+                try:
+                    results[ba_name] = future.result()
+                except skip_exceptions as e:
+                    skip(ba_name, e)
+
+    return [(ba_name, results[ba_name]) for ba_name in ba_names if ba_name in results]
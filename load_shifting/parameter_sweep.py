@@ -0,0 +1,172 @@
+"""
+Parameter sweeps over home characteristics, for retrofit studies: what do better
+insulation, a tighter envelope, a heat pump, different setpoints or windows do to a
+home's annual kWh, CO2 and comfort?
+
+A sweep is a base HomeCharacteristics plus a list of scenarios, each a dict of the
+fields to change ({"wall_insulation_r_value_imperial": 27, "ach50": 3}), made with
+grid_scenarios (every combination) or sampled_scenarios (random draws).
+
+run_sweep splits the scenarios into chunks and runs each chunk as one batch of homes
+with house_simulation.simulate_houses, in a pool of worker processes (see parallel.py).
+The weather and CO2 inputs are the same for every scenario, so they're handed to each
+worker once, when it starts, rather than pickled again with every chunk; a task is just
+a chunk's scenario numbers and changes. Result rows are appended to a CSV file as each
+chunk finishes, so if a sweep is interrupted, running it again with the same scenarios
+and output file picks up with the chunks that aren't there yet.
+"""
+
+import csv
+import dataclasses
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from django.conf import settings
+
+from .house_simulation import simulation_inputs, simulate_houses
+from .parallel import _setup_worker
+
+
+DEFAULT_CHUNK_SIZE = 100
+
+RESULT_COLUMNS = [
+    "annual_hvac_kwh",
+    "pounds_co2",
+    "comfort_violation_hours",          # hours ending outside the setpoints
+    "comfort_violation_degree_hours",   # and by how much
+]
+
+
+def grid_scenarios(grids):
+    """
+    Every combination of {field: [values]}, as a list of {field: value} dicts.
+    """
+    fields = list(grids)
+    return [dict(zip(fields, values)) for values in itertools.product(*[grids[field] for field in fields])]
+
+
+def sampled_scenarios(distributions, count, seed=0):
+    """
+    count random scenarios. distributions maps each field to (low, high) for uniform
+    draws, or to a list of values to choose from.
+    """
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for field, distribution in distributions.items():
+        if isinstance(distribution, tuple):
+            columns[field] = rng.uniform(distribution[0], distribution[1], count).tolist()
+        else:
+            columns[field] = [distribution[i] for i in rng.integers(0, len(distribution), count)]
+    return [{field: columns[field][i] for field in distributions} for i in range(count)]
+
+
+def check_scenarios(base_home, scenarios):
+    # ValueError for a field HomeCharacteristics doesn't have, before any work starts
+    fields = {field.name for field in dataclasses.fields(base_home)}
+    unknown = sorted({field for scenario in scenarios for field in scenario} - fields)
+    if unknown:
+        raise ValueError("HomeCharacteristics has no {}".format(", ".join(unknown)))
+
+
+def scenario_results(homes, inputs, solver="euler"):
+    """
+    One dict of RESULT_COLUMNS per home, from one simulate_houses batch.
+    """
+    outputs = simulate_houses(homes, inputs, solver=solver)
+    heating_setpoint_c = np.array([home.heating_setpoint_c for home in homes], dtype=np.float64)
+    cooling_setpoint_c = np.array([home.cooling_setpoint_c for home in homes], dtype=np.float64)
+    hours_per_step = inputs.dt_seconds / 3600
+
+    annual_hvac_kwh = outputs.hvac_energy_use_kwh.sum(axis=0)
+    pounds_co2 = inputs.co2_intensity @ outputs.hvac_energy_use_kwh
+    outside = np.maximum(heating_setpoint_c - outputs.indoor_temperature_c, 0) + \
+        np.maximum(outputs.indoor_temperature_c - cooling_setpoint_c, 0)
+    violation_hours = (outside > 0).sum(axis=0) * hours_per_step
+    violation_degree_hours = outside.sum(axis=0) * hours_per_step
+    return [dict(zip(RESULT_COLUMNS, values)) for values in
+            zip(annual_hvac_kwh, pounds_co2, violation_hours, violation_degree_hours)]
+
+
+# Set in each worker process by _setup_sweep_worker
+_worker_state = {}
+
+
+def _setup_sweep_worker(base_home_fields, inputs, solver):
+    # The home comes as a dict: unpickling a HomeCharacteristics would import utils (and
+    # the models) before Django is set up
+    _setup_worker()
+    from .utils import HomeCharacteristics
+    _worker_state.update(base_home=HomeCharacteristics(**base_home_fields), inputs=inputs, solver=solver)
+
+
+def _run_chunk(chunk):
+    # chunk is [(scenario number, scenario), ...]; returns [(scenario number, results), ...]
+    homes = [dataclasses.replace(_worker_state["base_home"], **scenario) for _, scenario in chunk]
+    results = scenario_results(homes, _worker_state["inputs"], _worker_state["solver"])
+    return [(scenario_number, result) for (scenario_number, _), result in zip(chunk, results)]
+
+
+def finished_scenarios(output_path):
+    """
+    Scenario numbers already in output_path, from an earlier (maybe interrupted) run. A
+    last row that was cut off part way through writing is removed.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, "rb+") as f:
+        contents = f.read()
+        if contents and not contents.endswith(b"\n"):
+            f.truncate(contents.rfind(b"\n") + 1)
+    with open(output_path, newline="") as f:
+        return {int(row["scenario"]) for row in csv.DictReader(f)}
+
+
+def run_sweep(base_home, scenarios, weather_with_co2_timeseries, output_path, chunk_size=DEFAULT_CHUNK_SIZE,
+              max_workers=None, solver="euler", lookahead_kernel=None):
+    """
+    Simulate base_home changed by each of scenarios over weather_with_co2_timeseries, and
+    write a row per scenario to the CSV file output_path: scenario (its number in
+    scenarios), the swept fields, and RESULT_COLUMNS. Rows are written as chunks
+    finish, so they're in no particular order; scenarios already in output_path are
+    skipped. max_workers defaults to settings.LOAD_SHIFTING_MAX_WORKERS, and 1 runs
+    everything in this process. Returns the number of scenarios run.
+    """
+    check_scenarios(base_home, scenarios)
+    if max_workers is None:
+        max_workers = getattr(settings, "LOAD_SHIFTING_MAX_WORKERS", 4)
+    inputs = simulation_inputs(weather_with_co2_timeseries, lookahead_kernel)
+
+    done = finished_scenarios(output_path)
+    to_run = [(scenario_number, scenario) for scenario_number, scenario in enumerate(scenarios) if not scenario_number in done]
+    chunks = [to_run[start:start + chunk_size] for start in range(0, len(to_run), chunk_size)]
+    fields = list(dict.fromkeys(field for scenario in scenarios for field in scenario))
+
+    with open(output_path, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["scenario"] + fields + RESULT_COLUMNS)
+        if f.tell() == 0:
+            writer.writeheader()
+
+        def write(chunk_results):
+            for scenario_number, result in chunk_results:
+                writer.writerow({"scenario": scenario_number, **scenarios[scenario_number], **result})
+            f.flush()
+
+        if max_workers <= 1 or len(chunks) <= 1:
+            _worker_state.update(base_home=base_home, inputs=inputs, solver=solver)
+            for chunk in chunks:
+                write(_run_chunk(chunk))
+        else:
+            with ProcessPoolExecutor(
+                max_workers=min(max_workers, len(chunks)),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_setup_sweep_worker,
+                initargs=(dataclasses.asdict(base_home), inputs, solver),
+            ) as executor:
+                futures = [executor.submit(_run_chunk, chunk) for chunk in chunks]
+                for future in as_completed(futures):
+                    write(future.result())
+
+    return len(to_run)
@@ -0,0 +1,141 @@
+"""
+Mergeable quantile sketches, in the style of the merging t-digest (Dunning & Ertl).
+
+A sketch is a short sorted array of centroids, (mean, weight) pairs, each summarizing
+weight values that sit next to each other in sorted order. Two sketches merge by pooling
+their centroids and compressing again, so the sketch of a month is the merge of the
+sketches of its days, and any range is a handful of merges no matter how many hours it
+covers.
+
+Compression uses the k1 scale function k(q) = compression / (2 pi) * asin(2q - 1):
+centroids whose middle falls in the same unit interval of k are combined. Near the
+median a centroid can hold about 2 pi sqrt(q (1 - q)) / compression of all the values,
+towards the tails much less, and the very first and last values stay as single-value
+centroids. The default compression of 200 keeps at most about 100 centroids (1.2 kB
+stored) per sketch.
+
+Error bounds: quantiles are interpolated between centroid middles, so for a sketch
+compressed once the estimate of quantile q is off by at most
+
+    2 pi sqrt(q (1 - q)) / compression
+
+in rank, i.e. it falls between the exact q - e and q + e quantiles: e = 0.016 at the
+median and 0.014 at the quartiles with the default compression. Merging sketches that
+were themselves compressed can in theory let errors add up (unlike KLL, t-digest has no
+hard guarantee under merges), but with the bucket-by-k compression used here the error
+of merged day sketches stays within the same bound in practice; that's what the tests
+check against pandas' describe(). Count, min and max are exact, as they're kept in the
+cells next to the sketch.
+"""
+
+import numpy as np
+
+
+DEFAULT_COMPRESSION = 200
+
+# How sketches are stored: 12 bytes per centroid
+CENTROID_DTYPE = np.dtype([("mean", "<f8"), ("weight", "<u4")])
+
+
+def rank_error_bound(quantile, compression=DEFAULT_COMPRESSION):
+    # The documented bound above, as a fraction of the number of values
+    return 2 * np.pi * np.sqrt(quantile * (1 - quantile)) / compression
+
+
+def _scale(quantiles, compression):
+    return compression / (2 * np.pi) * np.arcsin(2 * np.clip(quantiles, 0, 1) - 1)
+
+
+def compress_centroids(groups, means, weights, compression=DEFAULT_COMPRESSION):
+    """
+    Compress centroids (or raw values, with weight 1) for many sketches at once. groups
+    holds each centroid's sketch number. Returns (groups, means, weights) of the
+    compressed centroids, sorted by group and mean.
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    means = np.asarray(means, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    keep = ~np.isnan(means) & (weights > 0)
+    groups, means, weights = groups[keep], means[keep], weights[keep]
+    if len(means) == 0:
+        return groups, means, weights.astype(np.int64)
+
+    order = np.lexsort((means, groups))
+    groups, means, weights = groups[order], means[order], weights[order]
+
+    # Weight before each centroid within its own group, and each group's total
+    cumulative = np.cumsum(weights)
+    group_starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    group_ends = np.r_[group_starts[1:], len(groups)]
+    weight_before_group = np.repeat(cumulative[group_starts] - weights[group_starts], group_ends - group_starts)
+    group_totals = np.repeat(cumulative[group_ends - 1], group_ends - group_starts) - weight_before_group
+    middle_quantiles = (cumulative - weights - weight_before_group + weights / 2) / group_totals
+
+    # New centroid wherever the group or the unit interval of k changes
+    buckets = np.floor(_scale(middle_quantiles, compression))
+    starts_centroid = np.r_[True, (groups[1:] != groups[:-1]) | (buckets[1:] != buckets[:-1])]
+    centroid_ids = np.cumsum(starts_centroid) - 1
+    new_weights = np.bincount(centroid_ids, weights=weights)
+    new_means = np.bincount(centroid_ids, weights=means * weights) / new_weights
+    return groups[starts_centroid], new_means, np.rint(new_weights).astype(np.int64)
+
+
+def _split_by_group(groups, means, weights, group_count):
+    boundaries = np.cumsum(np.bincount(groups, minlength=group_count))[:-1]
+    sketches = []
+    for group_means, group_weights in zip(np.split(means, boundaries), np.split(weights, boundaries)):
+        sketch = np.empty(len(group_means), dtype=CENTROID_DTYPE)
+        sketch["mean"] = group_means
+        sketch["weight"] = group_weights
+        sketches.append(sketch)
+    return sketches
+
+
+def sketches_by_group(groups, values, group_count, compression=DEFAULT_COMPRESSION):
+    """
+    One sketch for each group number 0..group_count - 1 of the values (NaNs are left out).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return _split_by_group(*compress_centroids(groups, values, np.ones(len(values)), compression), group_count)
+
+
+def merge_sketches(sketch_lists, compression=DEFAULT_COMPRESSION):
+    """
+    sketch_lists is a list of lists of sketches; each inner list is merged into one.
+    """
+    groups = np.concatenate([np.full(len(sketch), group) for group, sketches in enumerate(sketch_lists)
+                             for sketch in sketches] + [np.empty(0, dtype=np.int64)]).astype(np.int64)
+    centroids = np.concatenate([sketch for sketches in sketch_lists for sketch in sketches]
+                               + [np.empty(0, dtype=CENTROID_DTYPE)])
+    return _split_by_group(*compress_centroids(groups, centroids["mean"], centroids["weight"], compression), len(sketch_lists))
+
+
+def sketch_quantiles(sketch, quantiles, minimum=None, maximum=None):
+    """
+    Estimates of the quantiles, with the same (linear interpolation) definition as pandas'
+    Series.quantile. minimum and maximum, the exact extremes if known, pin down the ends.
+    """
+    quantiles = np.asarray(quantiles, dtype=np.float64)
+    weights = sketch["weight"].astype(np.float64)
+    total = weights.sum()
+    if total == 0:
+        return np.full(quantiles.shape, np.nan)
+    means = sketch["mean"]
+    if minimum is None:
+        minimum = means[0]
+    if maximum is None:
+        maximum = means[-1]
+    # Value number i (0-based, in sorted order) sits at rank i + 0.5, like a centroid of
+    # weight 1 would, so a sketch of single values gives exactly pandas' answer
+    middles = np.cumsum(weights) - weights / 2
+    ranks = np.r_[0.5, middles, total - 0.5]
+    values = np.r_[minimum, means, maximum]
+    return np.interp(quantiles * (total - 1) + 0.5, ranks, values)
+
+
+def sketch_to_bytes(sketch):
+    return sketch.astype(CENTROID_DTYPE).tobytes()
+
+
+def sketch_from_bytes(data):
+    return np.frombuffer(data, dtype=CENTROID_DTYPE)
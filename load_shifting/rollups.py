@@ -0,0 +1,138 @@
+"""
+Pre-aggregated "rollup" cells of hourly series, so that clock-hour averages and daily or
+monthly totals over a date range can be answered from a handful of cells instead of
+every hourly row.
+
+A cell summarizes the hours of one BA (and optionally one fuel) in one calendar period,
+either a day or a month, either for all hours or for one clock hour (hour_of_day 0-23, or
+ALL_HOURS). Every field of a cell is mergeable: sums and counts add up, mins and maxes
+combine, and quantile sketches of the values merge (see quantile_sketch.py). So any range is
+answered by merging the month cells of the whole months in it with cells computed on the
+fly for the days at either end.
+
+From a merged cell we get:
+ - the "all hours weighted equally" mean: value_sum / hours
+ - the "all kWh weighted equally" mean: emissions / (usage_mwh * 1000)
+ - min and max, and quantiles from the merged sketch
+"""
+
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from .quantile_sketch import sketches_by_group, merge_sketches, sketch_quantiles
+
+
+ALL_HOURS = -1
+
+CELL_COLUMNS = ["hours", "value_sum", "value_min", "value_max", "usage_mwh", "emissions", "sketch"]
+
+
+def _aggregate(frame, keys, sketches):
+    """
+    One cell per distinct combination of keys in frame (which has value, usage_mwh and
+    emissions columns).
+    """
+    grouped = frame.groupby(keys, observed=True, sort=True)
+    cells = grouped.agg(
+        hours=("value", "count"),
+        value_sum=("value", "sum"),
+        value_min=("value", "min"),
+        value_max=("value", "max"),
+        usage_mwh=("usage_mwh", "sum"),
+        emissions=("emissions", "sum"),
+    ).reset_index()
+
+    if not sketches:
+        cells["sketch"] = None
+        return cells
+
+    # The sketches of all the cells are built in one go
+    cells["sketch"] = sketches_by_group(grouped.ngroup().to_numpy(), frame["value"].to_numpy(dtype=np.float64), len(cells))
+    return cells
+
+
+def rollup_cells(hourly_frame, extra_keys=[], sketches=True):
+    """
+    hourly_frame has local_date (datetime.date), hour (local clock hour), value, usage_mwh,
+    emissions and any extra_keys (e.g. fuel) columns. sketches=False leaves out the
+    quantile sketches, for series whose quantiles we don't need. Returns the day cells (all hours),
+    month cells for each clock hour and month cells for all hours, with columns period
+    ("day" or "month"), period_start, hour_of_day, extra_keys and CELL_COLUMNS.
+    """
+    frame = hourly_frame.copy()
+    for column in ["usage_mwh", "emissions"]:
+        if not column in frame.columns:
+            frame[column] = 0.0
+    local_dates = pd.to_datetime(frame["local_date"])
+    frame["day"] = local_dates.dt.date
+    frame["month"] = local_dates.dt.to_period("M").dt.start_time.dt.date
+
+    day_cells = _aggregate(frame, ["day"] + extra_keys, sketches).rename(columns={"day": "period_start"})
+    day_cells["period"] = "day"
+    day_cells["hour_of_day"] = ALL_HOURS
+
+    hour_cells = _aggregate(frame, ["month", "hour"] + extra_keys, sketches).rename(
+        columns={"month": "period_start", "hour": "hour_of_day"})
+    hour_cells["period"] = "month"
+
+    month_cells = _aggregate(frame, ["month"] + extra_keys, sketches).rename(columns={"month": "period_start"})
+    month_cells["period"] = "month"
+    month_cells["hour_of_day"] = ALL_HOURS
+
+    cells = pd.concat([day_cells, hour_cells, month_cells], ignore_index=True)
+    cells["hour_of_day"] = cells["hour_of_day"].astype(int)
+    return cells[["period", "period_start", "hour_of_day"] + extra_keys + CELL_COLUMNS]
+
+
+def merge_cells(cells, by):
+    """
+    Merge cells that share the by columns into one each, and add the derived statistics:
+    hours_weighted_mean, kwh_weighted_mean, and the merged sketch and its 25%/50%/75%
+    quantiles when the cells have sketches.
+    """
+    if len(cells) == 0:
+        return pd.DataFrame(columns=by + CELL_COLUMNS)
+    grouped = cells.groupby(by, observed=True, sort=True)
+    merged = grouped.agg(
+        hours=("hours", "sum"),
+        value_sum=("value_sum", "sum"),
+        value_min=("value_min", "min"),
+        value_max=("value_max", "max"),
+        usage_mwh=("usage_mwh", "sum"),
+        emissions=("emissions", "sum"),
+    ).reset_index()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        merged["hours_weighted_mean"] = merged["value_sum"] / merged["hours"].where(merged["hours"] > 0)
+        merged["kwh_weighted_mean"] = merged["emissions"] / (merged["usage_mwh"].where(merged["usage_mwh"] > 0) * 1000)
+
+    if cells["sketch"].notna().all():
+        sketches = merge_sketches(grouped["sketch"].apply(list).to_list())
+        quantiles = [sketch_quantiles(sketch, [0.25, 0.5, 0.75], minimum, maximum)
+                     for sketch, minimum, maximum in zip(sketches, merged["value_min"], merged["value_max"])]
+        merged[["25%", "50%", "75%"]] = np.array(quantiles).reshape(len(merged), 3)
+        merged["sketch"] = sketches
+    return merged
+
+
+def split_into_months(start_day, end_day):
+    """
+    Split start_day..end_day (inclusive dates) into the whole calendar months inside it
+    and the (start, end) day ranges left over at either end.
+    """
+    first_whole_month = start_day if start_day.day == 1 else (pd.Timestamp(start_day) + pd.offsets.MonthBegin(1)).date()
+    after_last_whole_month = (pd.Timestamp(end_day) + pd.Timedelta(days=1))
+    after_last_whole_month = after_last_whole_month.date() if after_last_whole_month.day == 1 \
+        else (after_last_whole_month - pd.offsets.MonthBegin(1)).date()
+
+    if first_whole_month >= after_last_whole_month:
+        return [], [(start_day, end_day)]
+
+    whole_months = [month.date() for month in pd.date_range(first_whole_month, after_last_whole_month, freq="MS", inclusive="left")]
+    edge_ranges = []
+    if start_day < first_whole_month:
+        edge_ranges.append((start_day, first_whole_month - datetime.timedelta(days=1)))
+    if after_last_whole_month <= end_day:
+        edge_ranges.append((after_last_whole_month, end_day))
+    return whole_months, edge_ranges
@@ -0,0 +1,132 @@
+"""
+Cache of house simulation results (the frames model_one_house returns), so that a page
+like home_simulation_json doesn't re-run the same year of simulation for the same
+homes on every load.
+
+An entry is keyed by a sha256 (caching.canonical_cache_key) of:
+
+    every HomeCharacteristics field
+    the solver ("euler", "exact" or "three-node")
+    a fingerprint of the SimulationInputs: the timestamps, weather, CO2 intensity and
+        smart HVAC look-ahead arrays the simulation actually reads
+    SIMULATION_CACHE_VERSION
+
+so any change to the home, the algorithm, the weather or the intensity data (a refilled
+cache, another emission factor table, another look-ahead kernel) is a different key, and
+stale entries are never read, just eventually evicted. Bump SIMULATION_CACHE_VERSION when
+the model itself changes.
+
+Entries are stored like the other cached frames: in the per-process frame_memory_cache,
+and as AllPurposeCSVCache rows in the binary frame format (see caching.py). Only the
+newest LOAD_SHIFTING_SIMULATION_CACHE_MAX_ENTRIES rows are kept, a hit counting as new.
+"""
+
+import dataclasses
+import hashlib
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.utils import timezone
+
+from .caching import canonical_cache_key, frame_memory_cache, lookup_cached_frame, store_cached_frame
+from .models import AllPurposeCSVCache
+
+
+SIMULATION_CACHE_FUNCTION = "simulate_house"
+SIMULATION_CACHE_VERSION = 1
+
+_FINGERPRINTED_ARRAYS = ["temp_air", "irradiance", "co2_intensity", "future_temp_air", "future_co2_intensity",
+                         "lookahead_status"]
+
+
+def max_cached_simulations():
+    return getattr(settings, "LOAD_SHIFTING_SIMULATION_CACHE_MAX_ENTRIES", 200)
+
+
+def inputs_fingerprint(inputs):
+    """
+    sha256 hex digest of everything in inputs (a house_simulation.SimulationInputs) that
+    a simulation result depends on.
+    """
+    digest = hashlib.sha256()
+    timestamps = pd.Index(inputs.timestamps)
+    digest.update(str(timestamps.dtype).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(timestamps, index=False).to_numpy().tobytes())
+    for name in _FINGERPRINTED_ARRAYS:
+        values = np.ascontiguousarray(getattr(inputs, name))
+        digest.update("{}:{}:{}".format(name, values.dtype.str, values.shape).encode("utf-8"))
+        digest.update(values.tobytes())
+    digest.update(str(inputs.dt_seconds).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def simulation_cache_key(home, fingerprint, solver, start_date, end_date):
+    # (key_params, key_hash) of one home's simulation
+    key_params = {
+        "home": dataclasses.asdict(home),
+        "solver": solver,
+        "inputs": fingerprint,
+        "version": SIMULATION_CACHE_VERSION,
+    }
+    return key_params, canonical_cache_key(SIMULATION_CACHE_FUNCTION, key_params, start_date, end_date)
+
+
+def _memory_key(key_hash):
+    return (SIMULATION_CACHE_FUNCTION, key_hash)
+
+
+def lookup_simulation(key_hash):
+    """
+    The cached simulation frame for key_hash, or None.
+    """
+    cached_df = frame_memory_cache.get(_memory_key(key_hash))
+    if cached_df is not None:
+        return cached_df
+    cached_df = lookup_cached_frame(key_hash)
+    if cached_df is not None:
+        # Counts as recently used, so it's not the next to be evicted
+        AllPurposeCSVCache.objects.filter(key_hash=key_hash).update(cached_date=timezone.now())
+        frame_memory_cache.put(_memory_key(key_hash), cached_df)
+    return cached_df
+
+
+def evict_simulations(max_entries=None):
+    """
+    Delete all but the max_entries most recently used cached simulations.
+    """
+    if max_entries is None:
+        max_entries = max_cached_simulations()
+    rows = AllPurposeCSVCache.objects.filter(cache_function_name=SIMULATION_CACHE_FUNCTION)
+    stale_ids = list(rows.order_by("-cached_date", "-id").values_list("id", flat=True)[max_entries:])
+    if stale_ids:
+        stale_rows = AllPurposeCSVCache.objects.filter(id__in=stale_ids)
+        for key_hash in stale_rows.values_list("key_hash", flat=True):
+            frame_memory_cache.discard(_memory_key(key_hash))
+        stale_rows.delete()
+
+
+def store_simulation(key_params, key_hash, start_date, end_date, df):
+    store_cached_frame(SIMULATION_CACHE_FUNCTION, key_params, start_date, end_date, df, key_hash=key_hash)
+    frame_memory_cache.put(_memory_key(key_hash), df)
+    evict_simulations()
+
+
+def cached_simulation_frames(homes, inputs, solver, simulate):
+    """
+    One simulation frame per home, from the cache where possible. simulate(homes) runs
+    the homes that aren't cached and returns their frames, in order; they're cached for
+    next time.
+    """
+    fingerprint = inputs_fingerprint(inputs)
+    start_date, end_date = inputs.timestamps[0], inputs.timestamps[-1]
+    keys = [simulation_cache_key(home, fingerprint, solver, start_date, end_date) for home in homes]
+
+    frames = [lookup_simulation(key_hash) for _, key_hash in keys]
+    missing = [home_number for home_number, frame in enumerate(frames) if frame is None]
+    if missing:
+        for home_number, frame in zip(missing, simulate([homes[home_number] for home_number in missing])):
+            key_params, key_hash = keys[home_number]
+            store_simulation(key_params, key_hash, start_date, end_date, frame)
+            frames[home_number] = frame
+    return frames
@@ -0,0 +1,91 @@
+"""
+Synthetic weather, example homes and the old per-row model_one_house, shared by the
+tests and the benchmark and sweep management commands.
+"""
+
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from .utils import HomeCharacteristics, calculate_next_timestep
+
+
+def legacy_model_one_house(home, weather_with_co2_timeseries):
+    # The one-calculate_next_timestep-per-row version of model_one_house, kept here to
+    # compare against.
+    previous_indoor_temperature_c = home.heating_setpoint_c
+
+    timesteps = []
+    delta_t = weather_with_co2_timeseries.index[1] - weather_with_co2_timeseries.index[0]
+
+    for timestamp in weather_with_co2_timeseries.index:
+        new_timestep = calculate_next_timestep(
+            timestamp=timestamp,
+            indoor_temperature_c=previous_indoor_temperature_c,
+            outdoor_temperature_c=weather_with_co2_timeseries.loc[timestamp].temp_air,
+            irradiance=weather_with_co2_timeseries.loc[timestamp].poa_direct,
+            home=home,
+            lookahead_df = weather_with_co2_timeseries,
+            dt = delta_t
+        )
+
+        timesteps.append(new_timestep)
+        previous_indoor_temperature_c = new_timestep["Indoor Temperature (C)"]
+
+    house_simulation = pd.DataFrame(timesteps)
+
+    house_simulation["pounds_co2"] = house_simulation["HVAC energy use (kWh)"] * house_simulation["pounds_co2_per_kwh"]
+    house_simulation["heat_xfer_from_outside"] = house_simulation['Conductive energy (J)'] + \
+        house_simulation['Air change energy (J)'] + house_simulation['Radiant energy (J)']
+
+    return house_simulation
+
+
+def synthetic_weather_with_co2(year, seed=0):
+    """
+    A year of hourly temp_air, poa_direct and pounds_co2_per_kwh, with daily and seasonal
+    cycles, shaped like home_simulation_json's weather_with_co2 frame.
+    """
+    rng = np.random.default_rng(seed)
+    timestamps = pd.date_range(
+        datetime.datetime(year, 1, 1), datetime.datetime(year, 12, 31, 23), freq="h",
+        tz=datetime.timezone(datetime.timedelta(hours=-5)))
+    day_of_year = timestamps.dayofyear.to_numpy()
+    hour = timestamps.hour.to_numpy()
+    seasonal = -np.cos(2 * np.pi * (day_of_year - 15) / 365)
+    daily = -np.cos(2 * np.pi * (hour - 3) / 24)
+    return pd.DataFrame({
+        "temp_air": 8 + 15 * seasonal + 5 * daily + rng.normal(0, 2, len(timestamps)),
+        "poa_direct": np.clip(400 * np.sin(np.pi * (hour - 6) / 12), 0, None) * rng.uniform(0.3, 1, len(timestamps)),
+        "pounds_co2_per_kwh": 0.5 + 0.3 * np.cos(2 * np.pi * (hour - 13) / 24) + rng.normal(0, 0.05, len(timestamps)),
+    }, index=pd.Index(timestamps, name="timestamp"))
+
+
+def example_home(smart_hvac_algorithm):
+    return HomeCharacteristics(
+        latitude=44.6, longitude=-72.8,
+        heating_setpoint_c=20, cooling_setpoint_c=24,
+        hvac_capacity_w=10000, hvac_overall_system_efficiency=1,
+        conditioned_floor_area_sq_m=200, ceiling_height_m=3,
+        wall_insulation_r_value_imperial=15, ach50=10,
+        south_facing_window_size_sq_m=20, window_solar_heat_gain_coefficient=0.5,
+        can_close_curtains=smart_hvac_algorithm, smart_hvac_algorithm=smart_hvac_algorithm)
+
+
+def home_variants(count, seed=0):
+    # count homes with random setpoints, size, insulation, HVAC and algorithm
+    rng = np.random.default_rng(seed)
+    homes = []
+    for _ in range(count):
+        heating_setpoint_c = int(rng.integers(17, 22))
+        smart = bool(rng.random() < 0.5)
+        homes.append(HomeCharacteristics(
+            latitude=44.6, longitude=-72.8,
+            heating_setpoint_c=heating_setpoint_c, cooling_setpoint_c=heating_setpoint_c + int(rng.integers(2, 7)),
+            hvac_capacity_w=int(rng.integers(5, 20)) * 1000, hvac_overall_system_efficiency=float(rng.uniform(0.8, 3.5)),
+            conditioned_floor_area_sq_m=int(rng.integers(80, 400)), ceiling_height_m=3,
+            wall_insulation_r_value_imperial=int(rng.integers(8, 40)), ach50=float(rng.uniform(1, 15)),
+            south_facing_window_size_sq_m=int(rng.integers(2, 30)), window_solar_heat_gain_coefficient=float(rng.uniform(0.2, 0.8)),
+            can_close_curtains=bool(rng.random() < 0.5), smart_hvac_algorithm=smart))
+    return homes
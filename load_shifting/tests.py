@@ -1,18 +1,51 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+import dataclasses
 import datetime
 import json
+import gzip
+import io
 import os
+import tempfile
+import threading
+import time
+import requests
+import numpy as np
+import pandas as pd
 # Create your tests here.
 
 
 # Write a test that asserts we can fill the db cache of the EIA data.
 
 from .utils import get_hourly_eia_grid_mix, compute_hourly_consumption_by_source_ba, compute_hourly_fuel_mix_after_import_export, cache_wrapped_hourly_gen_mix_by_ba_and_type
-from .models import AllPurposeCSVCache
+from .models import AllPurposeCSVCache, CacheFillLock, HourlyCO2Intensity, MaterializedDateRange, RollupCell
+from .caching import serialize_frame, deserialize_frame, read_cache_row, FrameMemoryCache, frame_memory_cache
+from .caching import canonical_cache_key, lookup_cached_frame, store_cached_frame, missing_date_ranges
+from .caching import run_single_flight, CACHE_FILL_LOCK_STALE_SECONDS
+from .utils import cache_csv, cache_csv_date_range, EIAAPIExeption
+from .utils import get_eia_timeseries, EIA_MAX_ROWS_PER_PAGE, parse_eia_period, categorize_eia_key_columns
+from .utils import get_hourly_co2_intensity, hourly_co2_intensity_from_usage, model_one_house, model_houses
+from .utils import rollup_co2_intensity_by_clock_hour, rollup_co2_intensity_totals, rollup_generation_by_clock_hour, rollup_co2_intensity_statistics
+from .utils import EMISSIONS_BY_FUEL, consumption_by_source_ba_from_frames, fuel_mix_after_import_export_from_frames
+from django_framework import http_client
+from .grid_flow_tracing import grid_co2_intensity
+from .parallel import run_per_ba
+from .parameter_sweep import grid_scenarios, sampled_scenarios, run_sweep
+from .simulation_cache import SIMULATION_CACHE_FUNCTION, evict_simulations
+from .utils import cached_model_houses, cache_wrapped_co2_boxplot_all_bas, hourly_gen_mix_from_eia, prefetch_hourly_gen_mix
+from .api_fixtures import write_eia_fixture, write_nrel_fixture, record_api_fixtures, replay_api_fixtures, FixtureStore
+from .rollups import split_into_months, rollup_cells, merge_cells
+from .synthetic_data import legacy_model_one_house, synthetic_weather_with_co2, example_home, home_variants
+from .emission_factors import apply_emission_factors, UnknownEmissionFactors
+from .house_simulation import simulation_inputs, simulate_house, simulate_houses, PAST_THE_END, LOOKAHEAD_OK
+from .thermal_network import three_node_parameters, step_matrices, simulate_house_three_node
+from .quantile_sketch import sketches_by_group, merge_sketches, sketch_quantiles, sketch_to_bytes, sketch_from_bytes, rank_error_bound
 
 class EIACacheTestCase(TestCase):
     def setUp(self):
-        pass
+        frame_memory_cache.clear()
     
     def test_eia_cache(self):
         ba = "CISO"
@@ -50,14 +83,138 @@ class CO2CalculationTestCase(TestCase):
 
 class HouseModelingTestCase(TestCase):
     def setUp(self):
-        pass
+        # Two weeks of January and two of July, for heating and cooling
+        weather = synthetic_weather_with_co2(2022)
+        self.winter = weather.iloc[:24 * 14]
+        self.summer = weather.iloc[24 * 190:24 * 204]
 
     def test_house_simulation(self):
         pass
 
+    def test_array_simulation_matches_per_timestep_simulation(self):
+        for weather in [self.winter, self.summer]:
+            for smart in [False, True]:
+                home = example_home(smart)
+                expected = legacy_model_one_house(home, weather).infer_objects()
+                result = model_one_house(home, weather)
+                pd.testing.assert_frame_equal(expected, result, check_dtype=False)
+                self.assertGreater(result["hvac_mode"].nunique(), 1)
+
+    def test_smart_lookahead_needs_the_timestamp_two_hours_ahead(self):
+        with_gap = self.winter.drop(self.winter.index[5])
+        # Basic HVAC never looks ahead
+        model_one_house(example_home(False), with_gap)
+        with self.assertRaises(KeyError):
+            model_one_house(example_home(True), with_gap)
+
+    def test_weighted_lookahead_kernel(self):
+        inputs = simulation_inputs(self.winter, "1-4h-weighted")
+        co2 = self.winter["pounds_co2_per_kwh"]
+        expected = (0.4 * co2.shift(-1) + 0.3 * co2.shift(-2) + 0.2 * co2.shift(-3) + 0.1 * co2.shift(-4)).to_numpy()
+        np.testing.assert_allclose(inputs.future_co2_intensity, expected)
+        np.testing.assert_allclose(inputs.co2_delta, expected - co2.to_numpy())
+        # The last four hours can't see 4 hours ahead, so they fall back to basic HVAC
+        self.assertEqual(list(inputs.lookahead_status[-5:]), [LOOKAHEAD_OK] + [PAST_THE_END] * 4)
+
+        # A one-point kernel is the same as the default, and the weighted one decides differently
+        home = example_home(True)
+        default = model_one_house(home, self.winter)
+        pd.testing.assert_frame_equal(default, model_one_house(home, self.winter, {2: 3.0}))
+        weighted = model_one_house(home, self.winter, "1-4h-weighted")
+        self.assertFalse((default["hvac_mode"] == weighted["hvac_mode"]).all())
+        with self.assertRaises(ValueError):
+            model_one_house(home, self.winter, "5h")
+
+    def test_exact_solver_is_accurate_at_coarse_timesteps(self):
+        # With the HVAC off, the exact hourly and 3-hourly steps should agree with Euler
+        # at 1-minute steps over the same (hourly, held constant) weather
+        passive_home = dataclasses.replace(example_home(False), hvac_capacity_w=0)
+        by_minute = self.winter.reindex(pd.date_range(
+            self.winter.index[0], self.winter.index[-1] + pd.Timedelta(minutes=59), freq="min", name="timestamp"), method="ffill")
+        fine = model_one_house(passive_home, by_minute)["Indoor Temperature (C)"].to_numpy()[59::60]
+
+        hourly_euler = model_one_house(passive_home, self.winter)["Indoor Temperature (C)"].to_numpy()
+        hourly_exact = model_one_house(passive_home, self.winter, solver="exact")["Indoor Temperature (C)"].to_numpy()
+        self.assertLess(np.abs(hourly_exact - fine).max(), 0.005)
+        self.assertGreater(np.abs(hourly_euler - fine).max(), 10 * np.abs(hourly_exact - fine).max())
+
+        # Constant outdoor temperature: three 1-hour steps are the same as one 3-hour one
+        constant = self.winter.iloc[:24].assign(temp_air=-5.0, poa_direct=0.0)
+        hourly = model_one_house(passive_home, constant, solver="exact")["Indoor Temperature (C)"].to_numpy()
+        three_hourly = model_one_house(passive_home, constant.iloc[::3], solver="exact")["Indoor Temperature (C)"].to_numpy()
+        np.testing.assert_allclose(hourly[2::3], three_hourly)
+
+        # And the batched version steps the same way
+        homes = [example_home(False), example_home(True)]
+        inputs = simulation_inputs(self.summer)
+        batch = simulate_houses(homes, inputs, solver="exact")
+        for home_number, home in enumerate(homes):
+            single = simulate_house(home, inputs, solver="exact")
+            np.testing.assert_array_equal(single.indoor_temperature_c, batch.for_home(home_number).indoor_temperature_c)
+        with self.assertRaises(ValueError):
+            simulate_house(homes[0], inputs, solver="rk4")
+
+    def test_three_node_model(self):
+        home = example_home(False)
+        parameters = three_node_parameters(home)
+        capacities = np.array([parameters.air_heat_capacity, parameters.envelope_heat_capacity, parameters.mass_heat_capacity])
+        self.assertAlmostEqual(capacities.sum(), home.building_heat_capacity)
+
+        # Over a step, whatever comes in ends up in the air, envelope and mass
+        dt_seconds = 3 * 3600
+        matrices = step_matrices(parameters, dt_seconds)
+        temperatures = np.array([20.0, 10.0, 19.0])
+        step_inputs = np.array([-5.0, 2000.0, 10000.0])
+        new_temperatures = matrices.state @ temperatures + matrices.input @ step_inputs
+        integrals = matrices.integral_state @ temperatures + matrices.integral_input @ step_inputs
+        energy_in_j = parameters.envelope_conductance_w_per_k * (step_inputs[0] * dt_seconds - integrals[1]) + \
+            parameters.air_change_w_per_k * (step_inputs[0] * dt_seconds - integrals[0]) + \
+            (step_inputs[1] + step_inputs[2]) * dt_seconds
+        self.assertAlmostEqual(capacities @ (new_temperatures - temperatures) / energy_in_j, 1)
+
+        # With no HVAC, three 1-hour steps are the same as one 3-hour one
+        constant = self.winter.iloc[:48].assign(temp_air=-5.0, poa_direct=100.0)
+        passive_home = dataclasses.replace(home, hvac_capacity_w=0)
+        hourly = simulate_house_three_node(passive_home, simulation_inputs(constant))
+        three_hourly = simulate_house_three_node(passive_home, simulation_inputs(constant.iloc[::3]))
+        self.assertAlmostEqual(hourly.indoor_temperature_c[2], three_hourly.indoor_temperature_c[0])
+
+        frame = model_one_house(example_home(True), self.winter, solver="three-node")
+        self.assertGreater(frame["hvac_mode"].nunique(), 1)
+        self.assertTrue(frame["Indoor Temperature (C)"].between(home.heating_setpoint_c - 4, home.cooling_setpoint_c + 4).all())
+
+    def test_optimal_hvac_schedule(self):
+        optimal_home = dataclasses.replace(example_home(False), optimal_hvac_algorithm=True)
+        for weather in [self.winter, self.summer]:
+            optimal = model_one_house(optimal_home, weather)
+            self.assertTrue(optimal["Indoor Temperature (C)"].between(
+                optimal_home.heating_setpoint_c - 0.05, optimal_home.cooling_setpoint_c + 0.05).all())
+            for home in [example_home(False), example_home(True)]:
+                self.assertLess(optimal["pounds_co2"].sum(), model_one_house(home, weather)["pounds_co2"].sum())
+
+            # Same decisions through calculate_next_timestep, and batched with other homes
+            expected = legacy_model_one_house(optimal_home, weather).infer_objects()
+            pd.testing.assert_frame_equal(expected, optimal, check_dtype=False)
+            batch = model_houses([example_home(True), optimal_home], weather)
+            pd.testing.assert_frame_equal(optimal, batch[1])
+
+        # The three-node model has no optimal schedule, and shouldn't quietly run basic HVAC
+        with self.assertRaises(ValueError):
+            model_one_house(optimal_home, self.winter, solver="three-node")
+        with self.assertRaises(ValueError):
+            cached_model_houses([example_home(True), optimal_home], self.winter, solver="three-node")
+        self.assertEqual(AllPurposeCSVCache.objects.count(), 0)
+
+    def test_batched_homes_match_one_at_a_time(self):
+        homes = [example_home(False), example_home(True)] + home_variants(6)
+        for weather in [self.winter, self.summer]:
+            for home, result in zip(homes, model_houses(homes, weather)):
+                pd.testing.assert_frame_equal(model_one_house(home, weather), result)
+
 
 class ImportExportBATestCase(TestCase):
     def setUp(self):
+        frame_memory_cache.clear()
         # Pre-load some saved JSON into the cache so we don't actually hit EIA API when testing:
         cache_metadatas = {
             "fuel-type-data_1_respondents.csv": {
@@ -143,3 +300,1134 @@ class ImportExportBATestCase(TestCase):
 
         # TODO: test that the DF read out of cache has same timeseries index as original DF!!!
         
+
+
+class CacheFrameFormatTestCase(TestCase):
+    def test_round_trip_keeps_dtypes_and_index(self):
+        timestamps = pd.date_range("2024-03-09", periods=48, freq="h", tz="US/Pacific")
+        df = pd.DataFrame({
+            "Generation (MWh)": np.arange(48, dtype=float),
+            "respondent": ["CISO", "PACW"] * 24,
+            "type-name": pd.Categorical(["Solar", "Wind", "Natural gas"] * 16),
+            "flag": [True, False] * 24,
+            "label": ["a", None] * 24,
+            "timestamp": timestamps.tz_convert("UTC"),
+        }, index=timestamps)
+        df.index.name = "time"
+
+        result = deserialize_frame(serialize_frame(df))
+        pd.testing.assert_frame_equal(result, df)
+
+        # Duplicate integer index (what paginated EIA results look like)
+        paged = pd.concat([df.reset_index(drop=True), df.reset_index(drop=True)])
+        pd.testing.assert_frame_equal(deserialize_frame(serialize_frame(paged)), paged)
+
+    def test_legacy_csv_rows_are_upgraded(self):
+        df = pd.DataFrame({"a": [1.0, 2.0], "b": ["x", "y"]})
+        row = AllPurposeCSVCache.objects.create(
+            cache_function_name = "legacy_function",
+            cached_date = datetime.datetime.now(),
+            key_params_json = json.dumps({}),
+            start_date = datetime.datetime(year=2024, month=4, day=1),
+            end_date = datetime.datetime(year=2024, month=4, day=30),
+            raw_csv = df.to_csv())
+
+        first_read = read_cache_row(row)
+        row.refresh_from_db()
+        self.assertEqual(row.raw_csv, "")
+        self.assertIsNotNone(row.frame_data)
+        pd.testing.assert_frame_equal(read_cache_row(row), first_read)
+        self.assertIn("Unnamed: 0", first_read.columns)
+
+
+@cache_csv
+def cache_wrapped_test_frame(start_date=None, end_date=None, size=10):
+    return pd.DataFrame({"value": np.arange(size, dtype=float)})
+
+
+class FrameMemoryCacheTestCase(TestCase):
+    def setUp(self):
+        frame_memory_cache.clear()
+
+    def test_lru_eviction_and_hit_rate(self):
+        df = pd.DataFrame({"value": np.arange(100, dtype=float)})
+        size = FrameMemoryCache.frame_size(df)
+        memory_cache = FrameMemoryCache(max_bytes=size * 2)
+        memory_cache.put("a", df)
+        memory_cache.put("b", df)
+        self.assertIsNotNone(memory_cache.get("a"))  # "b" is now least recently used
+        memory_cache.put("c", df)
+        self.assertIsNone(memory_cache.get("b"))
+        self.assertIsNotNone(memory_cache.get("c"))
+
+        stats = memory_cache.stats()
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertAlmostEqual(stats["hit_rate"], 2 / 3)
+
+    def test_callers_cannot_corrupt_cached_frames(self):
+        memory_cache = FrameMemoryCache(max_bytes=1024 * 1024)
+        memory_cache.put("a", pd.DataFrame({"value": [1.0, 2.0]}))
+        result = memory_cache.get("a")
+        result.loc[0, "value"] = 100
+        result.rename(columns={"value": "other"}, inplace=True)
+        pd.testing.assert_frame_equal(memory_cache.get("a"), pd.DataFrame({"value": [1.0, 2.0]}))
+
+    def test_cache_csv_repeat_calls_skip_the_database(self):
+        start_date = datetime.datetime(year=2024, month=4, day=1)
+        end_date = datetime.datetime(year=2024, month=4, day=30)
+        first = cache_wrapped_test_frame(start_date=start_date, end_date=end_date, size=5)
+        with self.assertNumQueries(0):
+            second = cache_wrapped_test_frame(start_date=start_date, end_date=end_date, size=5)
+        pd.testing.assert_frame_equal(first, second)
+
+
+class CacheKeyHashTestCase(TestCase):
+    def setUp(self):
+        frame_memory_cache.clear()
+
+    def test_key_hash_is_canonical(self):
+        params = {"url_segment": "fuel-type-data", "facets": {"respondent": ["CISO"]}}
+        reordered = {"facets": {"respondent": ["CISO"]}, "url_segment": "fuel-type-data"}
+        self.assertEqual(
+            canonical_cache_key("f", params, datetime.date(2024, 4, 1), datetime.datetime(2024, 4, 30)),
+            canonical_cache_key("f", json.dumps(reordered), datetime.datetime(2024, 4, 1, tzinfo=datetime.timezone.utc),
+                                "2024-04-30T00:00:00+00:00"))
+        self.assertNotEqual(
+            canonical_cache_key("f", params, datetime.date(2024, 4, 1), datetime.date(2024, 4, 30)),
+            canonical_cache_key("g", params, datetime.date(2024, 4, 1), datetime.date(2024, 4, 30)))
+
+    def test_rows_created_directly_get_a_key_hash(self):
+        row = AllPurposeCSVCache.objects.create(
+            cache_function_name = "cache_wrapped_test_frame",
+            cached_date = datetime.datetime.now(datetime.timezone.utc),
+            key_params_json = json.dumps({"size": 3}),
+            start_date = datetime.datetime(year=2024, month=4, day=1, tzinfo=datetime.timezone.utc),
+            end_date = datetime.datetime(year=2024, month=4, day=30, tzinfo=datetime.timezone.utc),
+            raw_csv = pd.DataFrame({"value": [7.0, 8.0, 9.0]}).to_csv(index=False))
+        self.assertIsNotNone(row.key_hash)
+        result = cache_wrapped_test_frame(
+            start_date=datetime.datetime(year=2024, month=4, day=1),
+            end_date=datetime.datetime(year=2024, month=4, day=30), size=3)
+        self.assertEqual(list(result["value"]), [7.0, 8.0, 9.0])
+
+    def test_store_is_an_upsert(self):
+        start_date = datetime.datetime(year=2024, month=4, day=1)
+        end_date = datetime.datetime(year=2024, month=4, day=30)
+        key_hash = store_cached_frame("f", {"ba_name": "CISO"}, start_date, end_date, pd.DataFrame({"a": [1]}))
+        store_cached_frame("f", {"ba_name": "CISO"}, start_date, end_date, pd.DataFrame({"a": [2]}))
+        self.assertEqual(AllPurposeCSVCache.objects.filter(key_hash=key_hash).count(), 1)
+        with self.assertNumQueries(1):
+            result = lookup_cached_frame(key_hash)
+        self.assertEqual(list(result["a"]), [2])
+
+
+fake_timeseries_calls = []
+
+@cache_csv_date_range("period")
+def cache_wrapped_fake_timeseries(start_date=None, end_date=None, respondent="CISO"):
+    fake_timeseries_calls.append((start_date.date(), end_date.date()))
+    periods = pd.date_range(start_date, end_date + datetime.timedelta(hours=23), freq="h")[::-1]
+    return pd.DataFrame({
+        "period": periods.strftime("%Y-%m-%dT%H-07"),
+        "respondent": respondent,
+        "value": np.arange(len(periods), dtype=float),
+    })
+
+
+class DateRangeCacheTestCase(TestCase):
+    def setUp(self):
+        frame_memory_cache.clear()
+        fake_timeseries_calls.clear()
+
+    def test_sub_ranges_and_gaps(self):
+        april = cache_wrapped_fake_timeseries(
+            start_date=datetime.datetime(2024, 4, 1), end_date=datetime.datetime(2024, 4, 30))
+        self.assertEqual(len(april), 30 * 24)
+
+        # Inside the cached range: sliced out of the cache, no fetch
+        mid_april = cache_wrapped_fake_timeseries(
+            start_date=datetime.datetime(2024, 4, 10), end_date=datetime.datetime(2024, 4, 20))
+        self.assertEqual(len(mid_april), 11 * 24)
+        self.assertEqual(mid_april["period"].iloc[0], "2024-04-20T23-07")
+        self.assertEqual(mid_april["period"].iloc[-1], "2024-04-10T00-07")
+
+        # Partly cached: only the missing days get fetched, then merged with the cache
+        spanning = cache_wrapped_fake_timeseries(
+            start_date=datetime.datetime(2024, 3, 25), end_date=datetime.datetime(2024, 4, 5))
+        self.assertEqual(len(spanning), 12 * 24)
+        self.assertEqual(fake_timeseries_calls, [
+            (datetime.date(2024, 4, 1), datetime.date(2024, 4, 30)),
+            (datetime.date(2024, 3, 25), datetime.date(2024, 3, 31)),
+        ])
+
+        series_rows = AllPurposeCSVCache.objects.filter(cache_function_name="cache_wrapped_fake_timeseries")
+        self.assertEqual(series_rows.count(), 1)
+        self.assertEqual(series_rows[0].start_date.date(), datetime.date(2024, 3, 25))
+        self.assertEqual(series_rows[0].end_date.date(), datetime.date(2024, 4, 30))
+
+        # Other params are a different series
+        cache_wrapped_fake_timeseries(
+            start_date=datetime.datetime(2024, 4, 10), end_date=datetime.datetime(2024, 4, 20), respondent="PACW")
+        self.assertEqual(len(fake_timeseries_calls), 3)
+
+    def test_extended_range_matches_a_cold_fetch(self):
+        # Ten days of hourly rows from the EIA stand-in. Extending or slicing a cached range
+        # has to give the same rows as asking for that range with nothing cached.
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        hours = pd.date_range("2024-04-01", "2024-04-10 23:00", freq="h")
+        write_eia_fixture(directory.name, "fuel-type-data", {"frequency": "local-hourly"}, [
+            {"period": hour.strftime("%Y-%m-%dT%H-07"), "respondent": "CISO", "fueltype": "SUN",
+             "type-name": "Solar", "value": str(number)} for number, hour in enumerate(hours)])
+
+        def fuel_mix(start_day, end_day):
+            return get_hourly_eia_grid_mix(
+                ["CISO"], start_date=datetime.datetime(2024, 4, start_day), end_date=datetime.datetime(2024, 4, end_day))
+
+        def clear_caches():
+            AllPurposeCSVCache.objects.all().delete()
+            frame_memory_cache.clear()
+
+        with replay_api_fixtures(directory.name):
+            fuel_mix(4, 6)
+            extended = fuel_mix(2, 8)
+            sliced = fuel_mix(3, 7)
+            clear_caches()
+            cold_extended = fuel_mix(2, 8)
+            clear_caches()
+            cold_sliced = fuel_mix(3, 7)
+
+        self.assertEqual(len(extended), 7 * 24)
+        self.assertEqual((extended["period"].iloc[0], extended["period"].iloc[-1]), ("2024-04-08T23-07", "2024-04-02T00-07"))
+        pd.testing.assert_frame_equal(extended, cold_extended)
+        pd.testing.assert_frame_equal(sliced.reset_index(drop=True), cold_sliced)
+
+    def test_missing_date_ranges(self):
+        gaps = missing_date_ranges(
+            datetime.date(2024, 1, 1), datetime.date(2024, 1, 31),
+            [(datetime.date(2024, 1, 5), datetime.date(2024, 1, 10)),
+             (datetime.date(2024, 1, 11), datetime.date(2024, 1, 20))])
+        self.assertEqual(gaps, [
+            (datetime.date(2024, 1, 1), datetime.date(2024, 1, 4)),
+            (datetime.date(2024, 1, 21), datetime.date(2024, 1, 31)),
+        ])
+
+
+class SingleFlightTestCase(TestCase):
+    def setUp(self):
+        frame_memory_cache.clear()
+        self.start_date = datetime.datetime(year=2024, month=4, day=1)
+        self.end_date = datetime.datetime(year=2024, month=4, day=30)
+        self.key_hash = canonical_cache_key(
+            "cache_wrapped_test_frame", {"size": 4}, self.start_date, self.end_date)
+
+    def test_follower_waits_for_the_leaders_result(self):
+        CacheFillLock.objects.create(lock_key=self.key_hash, owner="other worker", acquired_at=timezone.now())
+
+        def leader_finishes(seconds):
+            store_cached_frame("cache_wrapped_test_frame", {"size": 4}, self.start_date, self.end_date,
+                               pd.DataFrame({"value": [42.0]}))
+            CacheFillLock.objects.filter(lock_key=self.key_hash).delete()
+
+        with mock.patch("load_shifting.caching.time.sleep", side_effect=leader_finishes) as sleep:
+            result = cache_wrapped_test_frame(start_date=self.start_date, end_date=self.end_date, size=4)
+        self.assertEqual(sleep.call_count, 1)
+        # We got the leader's frame rather than computing our own
+        self.assertEqual(list(result["value"]), [42.0])
+
+    def test_stale_lock_is_taken_over(self):
+        CacheFillLock.objects.create(
+            lock_key=self.key_hash, owner="crashed worker",
+            acquired_at=timezone.now() - datetime.timedelta(seconds=CACHE_FILL_LOCK_STALE_SECONDS + 1))
+        result = cache_wrapped_test_frame(start_date=self.start_date, end_date=self.end_date, size=4)
+        self.assertEqual(len(result), 4)
+        self.assertEqual(CacheFillLock.objects.count(), 0)
+
+    def test_lock_is_released_when_compute_fails(self):
+        def fail():
+            raise EIAAPIExeption("no data rows")
+        with self.assertRaises(EIAAPIExeption):
+            run_single_flight(self.key_hash, lambda: None, fail)
+        self.assertEqual(CacheFillLock.objects.count(), 0)
+
+
+class FillLockHeartbeatTestCase(TransactionTestCase):
+    # A TransactionTestCase so that the heartbeat thread sees the lock row
+    def test_lock_is_renewed_while_computing(self):
+        acquired_times = []
+
+        def slow_compute():
+            acquired_times.append(CacheFillLock.objects.get(lock_key="slow").acquired_at)
+            time.sleep(0.5)
+            acquired_times.append(CacheFillLock.objects.get(lock_key="slow").acquired_at)
+            return pd.DataFrame({"value": [1.0]})
+
+        with mock.patch("load_shifting.caching.CACHE_FILL_LOCK_HEARTBEAT_SECONDS", 0.05):
+            run_single_flight("slow", lambda: None, slow_compute)
+        self.assertGreater(acquired_times[1], acquired_times[0])
+        self.assertEqual(CacheFillLock.objects.count(), 0)
+
+
+def fake_eia_page(url_segment, facets, start_date, end_date, frequency, offset, total=12345):
+    # Rows numbered by their position in the full (desc-sorted) result
+    rows = range(offset, min(offset + EIA_MAX_ROWS_PER_PAGE, total))
+    return {
+        "total": str(total),
+        "data": [{"period": "2024-04-01T00-07", "respondent": "CISO", "value": str(row)} for row in rows],
+    }
+
+
+class EIAPaginationTestCase(TestCase):
+    def test_pages_are_fetched_concurrently_and_kept_in_order(self):
+        with mock.patch("load_shifting.utils.fetch_eia_page", side_effect=fake_eia_page) as fetch:
+            result = get_eia_timeseries(
+                "fuel-type-data", {"respondent": ["CISO"]}, value_column_name="Generation (MWh)",
+                start_date=datetime.datetime(2024, 4, 1), end_date=datetime.datetime(2024, 4, 30),
+                frequency="local-hourly", include_timezone=False, max_concurrent_requests=3)
+
+        self.assertEqual(sorted(call.args[5] for call in fetch.call_args_list), [0, 5000, 10000])
+        self.assertEqual(list(result["Generation (MWh)"]), [float(row) for row in range(12345)])
+        # Same index as the old recursive version: each page numbered from 0
+        self.assertEqual(list(result.index[4999:5001]), [4999, 0])
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so we can check that the client reuses its connection
+    protocol_version = "HTTP/1.1"
+    responses_to_send = []
+    client_ports = []
+
+    def do_GET(self):
+        FlakyHandler.client_ports.append(self.client_address[1])
+        status, headers = FlakyHandler.responses_to_send.pop(0) if FlakyHandler.responses_to_send else (200, {})
+        body = json.dumps({"status": status}).encode("utf-8")
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(HTTP_BACKOFF_BASE_SECONDS=0.01, HTTP_MAX_BACKOFF_SECONDS=0.05)
+class HttpClientTestCase(TestCase):
+    def setUp(self):
+        FlakyHandler.responses_to_send = []
+        FlakyHandler.client_ports = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}/data".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_retries_transient_errors(self):
+        FlakyHandler.responses_to_send = [(503, {"Retry-After": "0"}), (502, {})]
+        response = http_client.get("eia", self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(FlakyHandler.client_ports), 3)
+
+    def test_gives_up_after_max_retries(self):
+        FlakyHandler.responses_to_send = [(503, {})] * 3
+        response = http_client.get("eia", self.url, max_retries=2)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(FlakyHandler.client_ports), 3)
+
+    def test_does_not_retry_client_errors(self):
+        FlakyHandler.responses_to_send = [(404, {})]
+        self.assertEqual(http_client.get("google", self.url).status_code, 404)
+        self.assertEqual(len(FlakyHandler.client_ports), 1)
+
+    def test_connections_are_reused(self):
+        for i in range(3):
+            http_client.get("nrel", self.url)
+        self.assertEqual(len(set(FlakyHandler.client_ports)), 1)
+
+    def test_backoff_honors_retry_after(self):
+        response = requests.Response()
+        response.headers["Retry-After"] = "0.04"
+        self.assertGreaterEqual(http_client.backoff_seconds(0, response), 0.04)
+        self.assertLessEqual(http_client.backoff_seconds(10), 0.05)
+
+
+class EIAIngestionTestCase(TestCase):
+    def test_parse_period_matches_per_row_parsing(self):
+        for periods in [
+            ["2024-04-30T10-07", "2024-04-30T09-07"],
+            ["2024-03-10T03-07", "2024-03-10T01-08", "2024-03-10T00-08"],  # DST change
+            ["2024-04-30T17", "2024-04-30T16"],
+            ["2024-04-30", "2024-04-29"],
+        ]:
+            expected = pd.Series(periods).apply(pd.to_datetime)
+            pd.testing.assert_series_equal(parse_eia_period(pd.Series(periods)), expected)
+
+    def test_page_is_parsed_into_typed_columns(self):
+        page = {"total": "2", "data": [
+            {"period": "2024-04-30T10-07", "respondent": "CISO", "respondent-name": "California Independent System Operator",
+             "fueltype": "SUN", "type-name": "Solar", "value": "13111", "value-units": "megawatthours"},
+            {"period": "2024-04-30T10-07", "respondent": "CISO", "respondent-name": "California Independent System Operator",
+             "fueltype": "WND", "type-name": "Wind", "value": None, "value-units": "megawatthours"},
+        ]}
+        with mock.patch("load_shifting.utils.fetch_eia_page", return_value=page):
+            result = get_eia_timeseries(
+                "fuel-type-data", {"respondent": ["CISO"]}, value_column_name="Generation (MWh)",
+                start_date=datetime.datetime(2024, 4, 30), end_date=datetime.datetime(2024, 4, 30),
+                frequency="local-hourly", include_timezone=False)
+
+        self.assertEqual(list(result.columns),
+                         ["period", "respondent", "fueltype", "type-name", "Generation (MWh)", "timestamp"])
+        self.assertEqual(result["Generation (MWh)"].dtype, np.float64)
+        self.assertTrue(np.isnan(result["Generation (MWh)"].iloc[1]))
+        self.assertIsInstance(result["respondent"].dtype, pd.CategoricalDtype)
+        self.assertEqual(str(result["timestamp"].dtype), "datetime64[ns, UTC-07:00]")
+
+
+def fake_eia_fuel_mix_page(url_segment, facets, start_date, end_date, frequency, offset):
+    # One row per requested BA per hour, newest first, like the real API
+    data = []
+    for hour in [1, 0]:
+        for ba in facets["respondent"]:
+            data.append({"period": "2024-04-01T{:02d}-07".format(hour), "respondent": ba,
+                         "fueltype": "SUN", "type-name": "Solar", "value": str(hour)})
+    return {"total": str(len(data)), "data": data}
+
+
+class ShardedEIACacheTestCase(TestCase):
+    def setUp(self):
+        frame_memory_cache.clear()
+
+    def get_fuel_mix(self, bas):
+        return get_hourly_eia_grid_mix(
+            bas, start_date=datetime.datetime(2024, 4, 1), end_date=datetime.datetime(2024, 4, 1))
+
+    def test_uncached_bas_are_fetched_together_and_cached_separately(self):
+        with mock.patch("load_shifting.utils.fetch_eia_page", side_effect=fake_eia_fuel_mix_page) as fetch:
+            result = self.get_fuel_mix(["CISO", "PACW"])
+
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(fetch.call_args.args[1]["respondent"], ["CISO", "PACW"])
+        self.assertEqual(AllPurposeCSVCache.objects.count(), 2)
+        self.assertEqual(list(result["respondent"]), ["CISO", "PACW", "CISO", "PACW"])
+        self.assertEqual(list(result["period"]), ["2024-04-01T01-07"] * 2 + ["2024-04-01T00-07"] * 2)
+
+    def test_overlapping_ba_lists_share_cache_entries(self):
+        with mock.patch("load_shifting.utils.fetch_eia_page", side_effect=fake_eia_fuel_mix_page):
+            self.get_fuel_mix(["CISO", "PACW"])
+        frame_memory_cache.clear()
+
+        with mock.patch("load_shifting.utils.fetch_eia_page", side_effect=fake_eia_fuel_mix_page) as fetch:
+            result = self.get_fuel_mix(["PACW", "BPAT", "CISO"])
+
+        # Only the BA we hadn't seen yet is fetched
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(fetch.call_args.args[1]["respondent"], ["BPAT"])
+        self.assertEqual(AllPurposeCSVCache.objects.count(), 3)
+        self.assertEqual(sorted(result["respondent"].unique()), ["BPAT", "CISO", "PACW"])
+        self.assertEqual(len(result), 6)
+
+    def test_bas_without_rows_are_cached_too(self):
+        def page_without_nsb(*args, **kwargs):
+            page = fake_eia_fuel_mix_page(*args, **kwargs)
+            page["data"] = [row for row in page["data"] if row["respondent"] != "NSB"]
+            return page
+
+        with mock.patch("load_shifting.utils.fetch_eia_page", side_effect=page_without_nsb) as fetch:
+            self.get_fuel_mix(["CISO", "NSB"])
+            frame_memory_cache.clear()
+            result = self.get_fuel_mix(["NSB", "CISO"])
+            with self.assertRaises(EIAAPIExeption):
+                self.get_fuel_mix(["NSB"])
+            self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(list(result["respondent"].unique()), ["CISO"])
+
+    def test_concurrent_misses_wait_for_one_batch_fetch(self):
+        with mock.patch("load_shifting.utils.fetch_eia_page", side_effect=fake_eia_fuel_mix_page), \
+                mock.patch("load_shifting.utils.run_single_flight", wraps=run_single_flight) as single_flight:
+            expected = self.get_fuel_mix(["CISO", "PACW"])
+        lock_key = single_flight.call_args.args[0]
+        stored_rows = list(AllPurposeCSVCache.objects.all())
+        AllPurposeCSVCache.objects.all().delete()
+        frame_memory_cache.clear()
+
+        # Another worker is fetching the same BAs; we wait for its shards instead of fetching
+        CacheFillLock.objects.create(lock_key=lock_key, owner="other worker", acquired_at=timezone.now())
+
+        def other_worker_finishes(seconds):
+            AllPurposeCSVCache.objects.bulk_create(stored_rows)
+            CacheFillLock.objects.filter(lock_key=lock_key).delete()
+
+        with mock.patch("load_shifting.utils.fetch_eia_page", side_effect=fake_eia_fuel_mix_page) as fetch, \
+                mock.patch("load_shifting.caching.time.sleep", side_effect=other_worker_finishes):
+            result = self.get_fuel_mix(["CISO", "PACW"])
+            fetch.assert_not_called()
+        pd.testing.assert_frame_equal(result, expected)
+
+
+class ApiFixtureReplayTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def fixture_rows(self, ba):
+        return [{"period": "2024-04-01T{:02d}-07".format(hour), "respondent": ba, "fueltype": "SUN",
+                 "type-name": "Solar", "value": str(hour)} for hour in range(6)]
+
+    def get_fuel_mix(self, bas):
+        return get_eia_timeseries(
+            "fuel-type-data", {"respondent": bas}, value_column_name="Generation (MWh)",
+            start_date=datetime.datetime(2024, 4, 1), end_date=datetime.datetime(2024, 4, 1),
+            frequency="local-hourly", include_timezone=False)
+
+    def test_recorded_eia_rows_are_replayed_for_any_subset_and_page_size(self):
+        upstream_directory = os.path.join(self.directory.name, "upstream")
+        recorded_directory = os.path.join(self.directory.name, "recorded")
+        # Rows recorded by two different queries are served together
+        write_eia_fixture(upstream_directory, "fuel-type-data", {"frequency": "local-hourly", "facets": {"respondent": ["CISO"]}}, self.fixture_rows("CISO"))
+        write_eia_fixture(upstream_directory, "fuel-type-data", {"frequency": "local-hourly", "facets": {"respondent": ["PACW"]}}, self.fixture_rows("PACW"))
+
+        with replay_api_fixtures(upstream_directory), record_api_fixtures(recorded_directory):
+            with mock.patch("load_shifting.utils.EIA_MAX_ROWS_PER_PAGE", 5):
+                both_bas = self.get_fuel_mix(["CISO", "PACW"])
+        self.assertEqual(len(both_bas), 12)
+        self.assertEqual(list(both_bas["period"].iloc[:2]), ["2024-04-01T05-07"] * 2)
+        # One fixture file per page
+        self.assertEqual(len(os.listdir(os.path.join(recorded_directory, "eia", "fuel-type-data", "local-hourly"))), 3)
+
+        with replay_api_fixtures(recorded_directory):
+            one_ba = self.get_fuel_mix(["PACW"])
+        expected = both_bas[(both_bas["respondent"] == "PACW").values].reset_index(drop=True)
+        pd.testing.assert_frame_equal(
+            one_ba.reset_index(drop=True), categorize_eia_key_columns(expected.astype({"respondent": str})))
+
+    def test_eia_start_and_end_are_compared_by_hour(self):
+        write_eia_fixture(self.directory.name, "fuel-type-data", {"frequency": "local-hourly"},
+                          self.fixture_rows("CISO") + [dict(row, period=row["period"].replace("04-01", "04-02")) for row in self.fixture_rows("CISO")])
+        store = FixtureStore(self.directory.name)
+
+        def periods(start, end):
+            _, rows = store.eia_query("fuel-type-data", {"frequency": "local-hourly", "start": start, "end": end,
+                                                         "sort": [{"column": "period", "direction": "asc"}]})
+            return [row["period"] for row in rows]
+
+        # A bare date is the first hour of that day
+        self.assertEqual(periods("2024-04-01", "2024-04-02"), ["2024-04-01T{:02d}-07".format(hour) for hour in range(6)] + ["2024-04-02T00-07"])
+        self.assertEqual(periods("2024-04-01T03", "2024-04-02T23")[:2], ["2024-04-01T03-07", "2024-04-01T04-07"])
+        self.assertEqual(len(periods("2024-04-01T00", "2024-04-02T23")), 12)
+
+    def test_psm3_is_replayed_without_recording_credentials(self):
+        params = {"api_key": "secret-key", "email": "someone@example.com", "wkt": "POINT(-122.4 37.8)", "names": "2024", "interval": 60}
+        write_nrel_fixture(self.directory.name, "https://developer.nrel.gov/api/nsrdb/v2/solar/psm3-2-2-download.csv", params, "Source,NSRDB\n")
+        for fixture_file in os.listdir(os.path.join(self.directory.name, "nrel")):
+            with gzip.open(os.path.join(self.directory.name, "nrel", fixture_file), "rt") as infile:
+                self.assertNotIn("secret-key", infile.read())
+
+        with replay_api_fixtures(self.directory.name):
+            psm3_url = os.environ["NREL_PSM3_URL"]
+            response = http_client.get("nrel", psm3_url, params=dict(params, api_key="other-key"))
+            self.assertEqual(response.text, "Source,NSRDB\n")
+            response = http_client.get("nrel", psm3_url, params=dict(params, names="2023"))
+            self.assertEqual(response.status_code, 404)
+        self.assertNotIn("NREL_PSM3_URL", os.environ)
+
+
+def fake_eia_page_across_dst(url_segment, facets, start_date, end_date, frequency, offset):
+    # Every hour of the requested Pacific days, newest first, with the UTC offset EIA gives
+    # local-hourly periods ("-08" before the spring daylight saving change, "-07" after)
+    hours = pd.date_range(pd.Timestamp(start_date.date()).tz_localize("America/Los_Angeles"),
+                          pd.Timestamp(end_date.date() + datetime.timedelta(days=1)).tz_localize("America/Los_Angeles"),
+                          freq="h", inclusive="left")
+    data = []
+    for hour in reversed(hours):
+        period = hour.strftime("%Y-%m-%dT%H") + "{:+03d}".format(int(hour.utcoffset().total_seconds() // 3600))
+        if url_segment == "region-data":
+            for ba in facets["respondent"]:
+                for eia_type, type_name, value in [("D", "Demand", 100), ("NG", "Net generation", 80), ("TI", "Total interchange", -20)]:
+                    if eia_type in facets["type"]:
+                        data.append({"period": period, "respondent": ba, "type": eia_type, "type-name": type_name, "value": str(value)})
+        elif url_segment == "interchange-data":
+            for ba in facets["toba"]:
+                data.append({"period": period, "fromba": "BPAT", "toba": ba, "value": "10"})
+        else:
+            for ba in facets["respondent"]:
+                data.append({"period": period, "respondent": ba, "fueltype": "SUN", "type-name": "Solar", "value": "30"})
+                data.append({"period": period, "respondent": ba, "fueltype": "NG", "type-name": "Natural gas", "value": "50"})
+    return {"total": str(len(data)), "data": data[offset:offset + EIA_MAX_ROWS_PER_PAGE]}
+
+
+class ConsumptionBySourceBATestCase(TestCase):
+    def test_local_consumption_is_min_of_demand_and_generation_with_gaps_as_zero(self):
+        periods = ["2024-04-10T03-07", "2024-04-10T02-07", "2024-04-10T01-07"]
+        demand_df = categorize_eia_key_columns(pd.DataFrame({
+            "period": [periods[0]] * 3 + [periods[1]] * 2 + [periods[2]],
+            "type-name": ["Demand", "Net generation", "Total interchange", "Demand", "Total interchange", "Total interchange"],
+            "Demand (MWh)": [100.0, 80.0, -20.0, 90.0, -10.0, 5.0],
+        }))
+        demand_df["timestamp"] = parse_eia_period(demand_df["period"]).array
+        interchange_df = categorize_eia_key_columns(pd.DataFrame({
+            "period": [periods[0], periods[0], periods[1]],
+            "fromba": ["BPAT", "PACW", "BPAT"],
+            "Interchange to local BA (MWh)": [15.0, -5.0, 7.0],
+        }))
+        interchange_df["timestamp"] = parse_eia_period(interchange_df["period"]).array
+
+        with mock.patch("builtins.print") as print_mock:
+            result = consumption_by_source_ba_from_frames("CISO", demand_df, interchange_df)
+        # One summary line for both gaps
+        self.assertEqual(print_mock.call_count, 1)
+        self.assertIn("2 of 3 timestamps", print_mock.call_args.args[0])
+
+        local = result[result["fromba"] == "CISO"]
+        self.assertEqual(list(local["Power consumed locally (MWh)"]), [0.0, 0.0, 80.0])
+        imported = result[result["fromba"] != "CISO"]
+        self.assertEqual(list(imported["fromba"].astype(str)), ["BPAT", "BPAT", "PACW"])
+        # Exports to a neighbor count as zero imports
+        self.assertEqual(list(imported["Power consumed locally (MWh)"]), [7.0, 15.0, 0.0])
+
+    def test_range_across_daylight_saving_change(self):
+        frame_memory_cache.clear()
+        start_date, end_date = datetime.datetime(2024, 3, 9), datetime.datetime(2024, 3, 11)
+        with mock.patch("load_shifting.utils.fetch_eia_page", side_effect=fake_eia_page_across_dst):
+            cold = compute_hourly_consumption_by_source_ba("CISO", start_date, end_date)
+        # Again from the cached EIA frames, whose timestamps come back as Timestamp objects
+        frame_memory_cache.clear()
+        with mock.patch("load_shifting.utils.fetch_eia_page", side_effect=fake_eia_page_across_dst) as fetch:
+            warm = compute_hourly_consumption_by_source_ba("CISO", start_date, end_date)
+            fetch.assert_not_called()
+        pd.testing.assert_frame_equal(warm, cold)
+
+        # Mar 10 has 23 hours, and every row keeps its own local clock
+        self.assertEqual(len(cold), 2 * 71)
+        timestamps = sorted(set(cold["timestamp"]))
+        self.assertEqual(timestamps[0], pd.Timestamp("2024-03-09 00:00-08:00"))
+        self.assertEqual(timestamps[-1], pd.Timestamp("2024-03-11 23:00-07:00"))
+        self.assertEqual({timestamp.utcoffset() for timestamp in cold["timestamp"]},
+                         {datetime.timedelta(hours=-8), datetime.timedelta(hours=-7)})
+        local = cold[cold["fromba"] == "CISO"]
+        self.assertTrue((local["Power consumed locally (MWh)"] == 80.0).all())
+
+
+class FuelMixTensorTestCase(TestCase):
+    def test_usage_is_consumption_split_by_generation_share(self):
+        hours = pd.to_datetime(["2024-04-01 01:00-07:00", "2024-04-01 00:00-07:00"])
+        generation_df = pd.DataFrame({
+            "timestamp": [hours[0], hours[0], hours[0], hours[1], hours[1]],
+            "fromba": pd.Categorical(["CISO", "CISO", "BPAT", "CISO", "CISO"]),
+            "generation_type": pd.Categorical(["Solar", "Natural gas", "Hydro", "Solar", "Natural gas"]),
+            "Generation (MWh)": [30.0, 10.0, 50.0, 0.0, np.nan],
+        })
+        consumption_df = pd.DataFrame({
+            "timestamp": [hours[0], hours[0], hours[1]],
+            "fromba": ["CISO", "BPAT", "CISO"],
+            "Power consumed locally (MWh)": [20.0, 5.0, 8.0],
+        })
+
+        result = fuel_mix_after_import_export_from_frames(generation_df, consumption_df)
+
+        self.assertEqual(list(result.columns),
+                         ["timestamp", "fromba", "generation_type", "Usage (MWh)", "emissions_per_kwh", "emissions"])
+        # Same order as the generation rows
+        self.assertEqual(list(result["generation_type"].astype(str)), ["Solar", "Natural gas", "Hydro", "Solar", "Natural gas"])
+        self.assertEqual(list(result["Usage (MWh)"].iloc[:3]), [15.0, 5.0, 5.0])
+        self.assertEqual(list(result["emissions"].iloc[:3]), [0.0, 0.97 * 5.0 * 1000, 0.0])
+        # No generation at all that hour: like the old join, 0/0 and NaN shares stay NaN
+        self.assertTrue(result["Usage (MWh)"].iloc[3:].isna().all())
+        self.assertEqual(result["timestamp"].dtype, generation_df["timestamp"].dtype)
+
+    def test_timestamps_across_daylight_saving_change_keep_their_offsets(self):
+        # Parsed like parse_eia_period does over a DST change: Timestamps with mixed offsets.
+        # The neighbor reports the same instant on another clock.
+        before, after = pd.Timestamp("2024-03-10 01:00-08:00"), pd.Timestamp("2024-03-10 03:00-07:00")
+        generation_df = pd.DataFrame({
+            "timestamp": pd.Series([after, after, before], dtype=object),
+            "fromba": ["CISO", "AZPS", "CISO"],
+            "generation_type": ["Solar", "Solar", "Solar"],
+            "Generation (MWh)": [10.0, 20.0, 30.0],
+        })
+        generation_df.loc[1, "timestamp"] = after.tz_convert("Etc/GMT+6")
+        consumption_df = pd.DataFrame({
+            "timestamp": pd.Series([after, after, before], dtype=object),
+            "fromba": ["CISO", "AZPS", "CISO"],
+            "Power consumed locally (MWh)": [5.0, 6.0, 7.0],
+        })
+
+        result = fuel_mix_after_import_export_from_frames(generation_df, consumption_df)
+
+        self.assertEqual(list(result["Usage (MWh)"]), [5.0, 6.0, 7.0])
+        # On the local BA's clock, one offset on each side of the change
+        self.assertEqual([timestamp.utcoffset() for timestamp in result["timestamp"]],
+                         [datetime.timedelta(hours=-7)] * 2 + [datetime.timedelta(hours=-8)])
+        self.assertEqual(list(result["timestamp"]), [after, after, before])
+
+
+class GridFlowTracingTestCase(TestCase):
+    def test_imports_are_traced_through_several_hops(self):
+        # AAA (coal) -> BBB (hydro) -> CCC (solar), all at the same UTC hour but reported
+        # in different time zones
+        generation_df = pd.DataFrame({
+            "period": ["2024-04-01T12-05", "2024-04-01T11-06", "2024-04-01T10-07"],
+            "respondent": ["AAA", "BBB", "CCC"],
+            "type-name": ["Coal", "Hydro", "Solar"],
+            "Generation (MWh)": [100.0, 50.0, 50.0],
+        })
+        interchange_df = pd.DataFrame({
+            "period": ["2024-04-01T12-05", "2024-04-01T11-06", "2024-04-01T11-06", "2024-04-01T10-07", "2024-04-01T10-07"],
+            "fromba": ["AAA", "BBB", "BBB", "CCC", "AESO"],
+            "toba": ["BBB", "AAA", "CCC", "BBB", "CCC"],
+            # Both ends report BBB -> CCC, slightly differently; AESO has no generation data
+            "Interchange to local BA (MWh)": [60.0, -60.0, 40.0, -38.0, 500.0],
+        })
+
+        result = grid_co2_intensity(generation_df, interchange_df, EMISSIONS_BY_FUEL).set_index("ba")
+
+        self.assertEqual(len(result["timestamp"].unique()), 1)
+        coal_share_at_bbb = 60 / 110
+        coal_share_at_ccc = 39 * coal_share_at_bbb / (50 + 39)
+        self.assertAlmostEqual(result.loc["AAA", "pounds_co2_per_kwh"], 2.30)
+        self.assertAlmostEqual(result.loc["BBB", "pounds_co2_per_kwh"], 2.30 * coal_share_at_bbb)
+        # A one hop calculation would give CCC BBB's generation mix, i.e. no coal at all
+        self.assertAlmostEqual(result.loc["CCC", "pounds_co2_per_kwh"], 2.30 * coal_share_at_ccc)
+        self.assertAlmostEqual(result.loc["CCC", "Throughput (MWh)"], 89.0)
+
+
+def ba_name_length_or_error(ba_name, multiplier=1):
+    # Module level, so worker processes can unpickle it
+    if ba_name == "BAD":
+        raise ValueError("no data")
+    return len(ba_name) * multiplier
+
+
+class RunPerBATestCase(TestCase):
+    def test_failures_are_skipped_and_order_is_kept(self):
+        for max_workers in [1, 2]:
+            with mock.patch("builtins.print") as print_mock:
+                results = run_per_ba(ba_name_length_or_error, ["CISO", "BAD", "IID", "PJM", "CISO"], max_workers=max_workers,
+                                     skip_exceptions=(ValueError,), multiplier=10)
+            self.assertEqual(results, [("CISO", 40), ("IID", 30), ("PJM", 30)])
+            self.assertIn("BAD", print_mock.call_args.args[0])
+
+    def test_unexpected_exceptions_are_raised(self):
+        for skip_exceptions in [(), (EIAAPIExeption,)]:
+            for max_workers in [1, 2]:
+                with self.assertRaises(ValueError):
+                    run_per_ba(ba_name_length_or_error, ["CISO", "BAD"], max_workers=max_workers, skip_exceptions=skip_exceptions)
+
+
+def write_eia_fixtures_across_dst(directory, bas, start_date, end_date):
+    # fake_eia_page_across_dst's rows for bas and their BPAT imports, as replayable fixtures
+    for url_segment, facets in [("region-data", {"respondent": bas, "type": ["D", "NG", "TI"]}),
+                                ("interchange-data", {"toba": bas}),
+                                ("fuel-type-data", {"respondent": bas + ["BPAT"]})]:
+        rows = fake_eia_page_across_dst(url_segment, facets, start_date, end_date, "local-hourly", 0)["data"]
+        write_eia_fixture(directory, url_segment, {"frequency": "local-hourly", "facets": facets}, rows)
+
+
+class BoxplotPrefetchTestCase(TestCase):
+    start_date = datetime.datetime(2024, 3, 9)
+    end_date = datetime.datetime(2024, 3, 11)
+
+    def setUp(self):
+        frame_memory_cache.clear()
+
+    def test_workers_compute_without_the_database(self):
+        with mock.patch("load_shifting.utils.fetch_eia_page", side_effect=fake_eia_page_across_dst), \
+                self.assertNumQueries(0):
+            frames = hourly_gen_mix_from_eia("CISO", {"CISO": [(self.start_date, self.end_date)]})
+        with mock.patch("load_shifting.utils.fetch_eia_page", side_effect=fake_eia_page_across_dst):
+            expected = cache_wrapped_hourly_gen_mix_by_ba_and_type(ba_name="CISO", start_date=self.start_date, end_date=self.end_date)
+        self.assertEqual(len(frames), 1)
+        pd.testing.assert_frame_equal(
+            hourly_co2_intensity_from_usage(frames[0]), hourly_co2_intensity_from_usage(expected))
+
+    @override_settings(LOAD_SHIFTING_MAX_WORKERS=1)
+    def test_boxplot_only_does_database_work_after_the_prefetch(self):
+        with mock.patch("load_shifting.utils.fetch_eia_page", side_effect=fake_eia_page_across_dst) as fetch, \
+                mock.patch("load_shifting.utils.run_per_ba", wraps=run_per_ba) as per_ba:
+            boxplot = cache_wrapped_co2_boxplot_all_bas(ba_names=["CISO", "PACW"], start_date=self.start_date, end_date=self.end_date)
+        # Region, interchange and fuel mix data once per BA, all of it by the prefetch
+        self.assertEqual(fetch.call_count, 6)
+        self.assertEqual(per_ba.call_args_list[0].args[0], hourly_gen_mix_from_eia)
+        self.assertEqual(list(boxplot["ba_names"]), ["CISO", "PACW"])
+        np.testing.assert_allclose(boxplot[["min", "50%", "max"]].to_numpy(), EMISSIONS_BY_FUEL["Natural gas"] * 50 / 80)
+
+        # Nothing left to prefetch the second time
+        with mock.patch("load_shifting.utils.run_per_ba", wraps=run_per_ba) as per_ba:
+            prefetch_hourly_gen_mix(["CISO", "PACW"], self.start_date, self.end_date)
+        self.assertEqual(per_ba.call_args.args[1], [])
+
+    def test_prefetch_in_worker_processes(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        write_eia_fixtures_across_dst(directory.name, ["CISO", "PACW"], self.start_date, self.end_date)
+
+        # The workers can't see this test's in-memory database, so they'd fail if they used it
+        with replay_api_fixtures(directory.name):
+            prefetch_hourly_gen_mix(["CISO", "PACW"], self.start_date, self.end_date, max_workers=2)
+        self.assertEqual(AllPurposeCSVCache.objects.filter(cache_function_name="cache_wrapped_hourly_gen_mix_by_ba_and_type").count(), 2)
+
+        frame_memory_cache.clear()
+        with mock.patch("load_shifting.utils.fetch_eia_page") as fetch:
+            intensity = get_hourly_co2_intensity("PACW", start_date=self.start_date, end_date=self.end_date)
+            fetch.assert_not_called()
+        self.assertEqual(len(intensity), 71)
+        np.testing.assert_allclose(intensity["pounds_co2_per_kwh"], EMISSIONS_BY_FUEL["Natural gas"] * 50 / 80)
+
+
+class ParameterSweepTestCase(TestCase):
+    def setUp(self):
+        self.weather = synthetic_weather_with_co2(2022).iloc[:24 * 14]
+        self.base_home = example_home(False)
+        self.scenarios = grid_scenarios({
+            "wall_insulation_r_value_imperial": [11, 27],
+            "ach50": [10, 1.5],
+            "hvac_overall_system_efficiency": [1, 3],
+        })
+        self.output_path = os.path.join(tempfile.mkdtemp(), "sweep.csv")
+
+    def test_scenarios(self):
+        self.assertEqual(len(self.scenarios), 8)
+        self.assertEqual(self.scenarios[1], {"wall_insulation_r_value_imperial": 11, "ach50": 10, "hvac_overall_system_efficiency": 3})
+        samples = sampled_scenarios({"ach50": (1, 10), "heating_setpoint_c": [18, 20]}, 50)
+        self.assertTrue(all(1 <= sample["ach50"] <= 10 and sample["heating_setpoint_c"] in [18, 20] for sample in samples))
+        with self.assertRaises(ValueError):
+            run_sweep(self.base_home, [{"r_value": 11}], self.weather, self.output_path)
+
+    def test_sweep_matches_model_one_house(self):
+        for max_workers in [1, 2]:
+            if os.path.exists(self.output_path):
+                os.remove(self.output_path)
+            self.assertEqual(run_sweep(self.base_home, self.scenarios, self.weather, self.output_path,
+                                       chunk_size=3, max_workers=max_workers), 8)
+            results = pd.read_csv(self.output_path).set_index("scenario").sort_index()
+            self.assertEqual(list(results.index), list(range(8)))
+            for scenario_number, scenario in enumerate(self.scenarios):
+                house_simulation = model_one_house(dataclasses.replace(self.base_home, **scenario), self.weather)
+                self.assertAlmostEqual(results.loc[scenario_number, "annual_hvac_kwh"], house_simulation["HVAC energy use (kWh)"].sum())
+                self.assertAlmostEqual(results.loc[scenario_number, "pounds_co2"], house_simulation["pounds_co2"].sum())
+                below = house_simulation["Indoor Temperature (C)"] < self.base_home.heating_setpoint_c
+                self.assertEqual(results.loc[scenario_number, "comfort_violation_hours"], below.sum())
+
+    def test_interrupted_sweep_carries_on(self):
+        run_sweep(self.base_home, self.scenarios, self.weather, self.output_path, chunk_size=3, max_workers=1)
+        with open(self.output_path) as f:
+            complete = f.read()
+        # Header, three rows, and part of the fourth
+        lines = complete.splitlines(keepends=True)
+        with open(self.output_path, "w") as f:
+            f.write("".join(lines[:4]) + lines[4][:10])
+
+        self.assertEqual(run_sweep(self.base_home, self.scenarios, self.weather, self.output_path, chunk_size=3, max_workers=1), 5)
+        pd.testing.assert_frame_equal(pd.read_csv(self.output_path).sort_values("scenario").reset_index(drop=True),
+                                      pd.read_csv(io.StringIO(complete)))
+
+
+class SimulationCacheTestCase(TestCase):
+    def setUp(self):
+        self.weather = synthetic_weather_with_co2(2022).iloc[:24 * 14]
+        self.homes = [example_home(False), example_home(True)]
+        frame_memory_cache.clear()
+
+    def cached_rows(self):
+        return AllPurposeCSVCache.objects.filter(cache_function_name=SIMULATION_CACHE_FUNCTION)
+
+    def test_repeat_runs_come_from_cache(self):
+        expected = model_houses(self.homes, self.weather)
+        first = cached_model_houses(self.homes, self.weather)
+        self.assertEqual(self.cached_rows().count(), 2)
+        with mock.patch("load_shifting.utils.simulate_houses") as simulate:
+            # From memory, then from the database as another process would
+            second = cached_model_houses(self.homes, self.weather)
+            frame_memory_cache.clear()
+            third = cached_model_houses(self.homes, self.weather)
+            simulate.assert_not_called()
+        for frames in [first, second, third]:
+            for house_simulation, expected_simulation in zip(frames, expected):
+                pd.testing.assert_frame_equal(house_simulation, expected_simulation)
+
+    def test_changed_inputs_miss(self):
+        cached_model_houses(self.homes, self.weather)
+        warmer = self.weather.copy()
+        warmer.iloc[5, warmer.columns.get_loc("temp_air")] += 0.1
+        cached_model_houses(self.homes, warmer)
+        cached_model_houses([dataclasses.replace(self.homes[0], ach50=3)], self.weather)
+        cached_model_houses(self.homes[:1], self.weather, solver="exact")
+        cached_model_houses(self.homes[1:], self.weather, lookahead_kernel="1-4h-weighted")
+        self.assertEqual(self.cached_rows().count(), 7)
+
+        pd.testing.assert_frame_equal(cached_model_houses(self.homes[1:], self.weather, lookahead_kernel="1-4h-weighted")[0],
+                                      model_houses(self.homes[1:], self.weather, lookahead_kernel="1-4h-weighted")[0])
+        self.assertEqual(self.cached_rows().count(), 7)
+
+    def test_eviction(self):
+        cached_model_houses(self.homes, self.weather)
+        cached_model_houses(self.homes[:1], self.weather, solver="exact")
+        evict_simulations(max_entries=1)
+        self.assertEqual([json.loads(row.key_params_json)["solver"] for row in self.cached_rows()], ["exact"])
+        with override_settings(LOAD_SHIFTING_SIMULATION_CACHE_MAX_ENTRIES=2):
+            cached_model_houses(self.homes, self.weather)
+            self.assertEqual(self.cached_rows().count(), 2)
+
+
+def fake_usage_frame(ba_name=None, start_date=None, end_date=None):
+    # Two fuel rows per local hour of each day, like cache_wrapped_hourly_gen_mix_by_ba_and_type
+    hours = pd.date_range(start_date, end_date + datetime.timedelta(hours=23), freq="h",
+                          tz=datetime.timezone(datetime.timedelta(hours=-7)))
+    return pd.DataFrame({
+        "timestamp": np.repeat(hours, 2),
+        "fromba": ba_name,
+        "generation_type": np.tile(["Solar", "Natural gas"], len(hours)),
+        "Usage (MWh)": np.tile([300.0, 100.0], len(hours)),
+        "emissions_per_kwh": np.tile([0, 0.97], len(hours)),
+        "emissions": np.tile([0, 0.97 * 100 * 1000], len(hours)),
+    })
+
+
+class HourlyCO2IntensityTestCase(TestCase):
+    def test_range_across_daylight_saving_change(self):
+        frame_memory_cache.clear()
+        with mock.patch("load_shifting.utils.fetch_eia_page", side_effect=fake_eia_page_across_dst):
+            result = get_hourly_co2_intensity(
+                "CISO", start_date=datetime.datetime(2024, 3, 9), end_date=datetime.datetime(2024, 3, 11))
+
+        # Mar 10 has 23 hours, each on its own local clock
+        self.assertEqual(len(result), 71)
+        self.assertEqual(result["timestamp"].iloc[0], pd.Timestamp("2024-03-09 00:00-08:00"))
+        self.assertEqual(result["timestamp"].iloc[-1], pd.Timestamp("2024-03-11 23:00-07:00"))
+        self.assertEqual(result["timestamp"].iloc[0].utcoffset(), datetime.timedelta(hours=-8))
+        self.assertEqual(result["timestamp"].iloc[-1].utcoffset(), datetime.timedelta(hours=-7))
+        # Local generation and the BPAT imports both have 50 of every 80 MWh from gas
+        expected = EMISSIONS_BY_FUEL["Natural gas"] * 50 / 80
+        np.testing.assert_allclose(result["pounds_co2_per_kwh"], expected)
+        self.assertEqual(list(result["Usage (MWh)"].unique()), [90.0])
+
+    def test_intensity_is_materialized_once_and_read_by_range(self):
+        april_1 = datetime.datetime(2024, 4, 1)
+        april_3 = datetime.datetime(2024, 4, 3)
+        with mock.patch("load_shifting.utils.cache_wrapped_hourly_gen_mix_by_ba_and_type", side_effect=fake_usage_frame) as compute:
+            result = get_hourly_co2_intensity("CISO", start_date=april_1, end_date=april_3)
+            self.assertEqual(compute.call_count, 1)
+            self.assertEqual(HourlyCO2Intensity.objects.count(), 72)
+
+            expected = hourly_co2_intensity_from_usage(fake_usage_frame("CISO", april_1, april_3))
+            pd.testing.assert_frame_equal(result, expected)
+
+            # Sub-range: straight from the table
+            april_2 = get_hourly_co2_intensity("CISO", start_date=datetime.datetime(2024, 4, 2), end_date=datetime.datetime(2024, 4, 2))
+            self.assertEqual(compute.call_count, 1)
+            self.assertEqual(len(april_2), 24)
+            self.assertEqual(april_2["timestamp"].iloc[0], pd.Timestamp("2024-04-02T00:00-07:00"))
+            self.assertAlmostEqual(april_2["pounds_co2_per_kwh"].iloc[0], 0.97 * 100 / 400)
+
+            # Longer range: only the missing days are computed
+            get_hourly_co2_intensity("CISO", start_date=april_1, end_date=datetime.datetime(2024, 4, 5))
+            self.assertEqual(compute.call_count, 2)
+            self.assertEqual(compute.call_args.kwargs["start_date"], datetime.datetime(2024, 4, 4))
+            self.assertEqual(HourlyCO2Intensity.objects.count(), 120)
+
+    def test_incomplete_days_are_fetched_again(self):
+        # The usage comes back cut off part way through the last day, like a range that
+        # ends today or a short EIA response
+        def cut_off_usage_frame(ba_name=None, start_date=None, end_date=None):
+            usage = fake_usage_frame(ba_name, start_date, end_date)
+            return usage[usage["timestamp"] < pd.Timestamp(end_date.date()).tz_localize("-07:00") + pd.Timedelta(hours=11)]
+
+        april_1 = datetime.datetime(2024, 4, 1)
+        april_3 = datetime.datetime(2024, 4, 3)
+        with mock.patch("load_shifting.utils.cache_wrapped_hourly_gen_mix_by_ba_and_type", side_effect=cut_off_usage_frame):
+            self.assertEqual(len(get_hourly_co2_intensity("CISO", start_date=april_1, end_date=april_3)), 48 + 11)
+        self.assertEqual(list(MaterializedDateRange.objects.values_list("start_date", "end_date")),
+                         [(datetime.date(2024, 4, 1), datetime.date(2024, 4, 2))])
+
+        with mock.patch("load_shifting.utils.cache_wrapped_hourly_gen_mix_by_ba_and_type", side_effect=fake_usage_frame) as compute:
+            self.assertEqual(len(get_hourly_co2_intensity("CISO", start_date=april_1, end_date=april_3)), 72)
+        self.assertEqual(compute.call_args.kwargs["start_date"], april_3)
+
+
+def fake_varying_usage_frame(ba_name=None, start_date=None, end_date=None):
+    # Like fake_usage_frame, but gas usage changes hour by hour so the averages differ
+    usage = fake_usage_frame(ba_name, start_date, end_date)
+    hour_number = np.repeat(np.arange(len(usage) // 2), 2)
+    gas = usage["generation_type"] == "Natural gas"
+    usage.loc[gas, "Usage (MWh)"] = 50.0 + (hour_number[gas] * 37) % 200
+    usage["emissions"] = usage["emissions_per_kwh"] * usage["Usage (MWh)"] * 1000
+    return usage
+
+
+def fake_hourly_generation(ba_names, start_date=None, end_date=None):
+    # get_hourly_eia_grid_mix rows, periods in local time
+    hours = pd.date_range(start_date, end_date + datetime.timedelta(hours=23), freq="h")
+    return pd.DataFrame({
+        "period": np.repeat(hours.strftime("%Y-%m-%dT%H-07"), 2),
+        "respondent": ba_names[0],
+        "type-name": np.tile(["Solar", "Natural gas"], len(hours)),
+        "Generation (MWh)": np.tile([3.0, 1.0], len(hours)) * np.repeat(hours.day, 2),
+    })
+
+
+class RollupTestCase(TestCase):
+    def test_split_into_months(self):
+        self.assertEqual(split_into_months(datetime.date(2024, 3, 15), datetime.date(2024, 6, 2)),
+                         ([datetime.date(2024, 4, 1), datetime.date(2024, 5, 1)],
+                          [(datetime.date(2024, 3, 15), datetime.date(2024, 3, 31)), (datetime.date(2024, 6, 1), datetime.date(2024, 6, 2))]))
+        self.assertEqual(split_into_months(datetime.date(2024, 4, 1), datetime.date(2024, 4, 30)),
+                         ([datetime.date(2024, 4, 1)], []))
+        self.assertEqual(split_into_months(datetime.date(2024, 4, 3), datetime.date(2024, 4, 20)),
+                         ([], [(datetime.date(2024, 4, 3), datetime.date(2024, 4, 20))]))
+
+    def test_merged_cell_quantiles(self):
+        values = pd.Series(np.random.default_rng(5).gamma(4, 0.15, size=5000))
+        frame = pd.DataFrame({"local_date": [datetime.date(2024, 4, 1 + i % 20) for i in range(len(values))], "hour": 0, "value": values})
+        # Merge several day cells, like a range query would
+        cells = rollup_cells(frame)
+        merged = merge_cells(cells[cells["period"] == "day"], by=["period"])
+        for quantile, name in [(0.25, "25%"), (0.5, "50%"), (0.75, "75%")]:
+            self.assertAlmostEqual(merged[name].iloc[0], values.quantile(quantile), delta=0.01)
+        self.assertAlmostEqual(merged["value_min"].iloc[0], values.min())
+
+    def test_co2_intensity_rollups_match_hourly_rows(self):
+        start_date = datetime.datetime(2024, 3, 28)
+        end_date = datetime.datetime(2024, 5, 3)
+        with mock.patch("load_shifting.utils.cache_wrapped_hourly_gen_mix_by_ba_and_type", side_effect=fake_varying_usage_frame):
+            hourly = get_hourly_co2_intensity("CISO", start_date=start_date, end_date=end_date)
+            by_clock_hour = rollup_co2_intensity_by_clock_hour("CISO", start_date=start_date, end_date=end_date)
+            daily = rollup_co2_intensity_totals("CISO", start_date=start_date, end_date=end_date)
+            monthly = rollup_co2_intensity_totals("CISO", start_date=start_date, end_date=end_date, period="month")
+        self.assertTrue(RollupCell.objects.filter(period="month", period_start=datetime.date(2024, 4, 1)).exists())
+
+        hourly["hour"] = [timestamp.hour for timestamp in hourly["timestamp"]]
+        hourly["day"] = [timestamp.date() for timestamp in hourly["timestamp"]]
+        expected_means = hourly.groupby("hour")["pounds_co2_per_kwh"].mean()
+        np.testing.assert_allclose(by_clock_hour["hours_weighted_mean"], expected_means.to_numpy())
+        by_hour = hourly.groupby("hour")[["emissions", "Usage (MWh)"]].sum()
+        np.testing.assert_allclose(by_clock_hour["kwh_weighted_mean"], (by_hour["emissions"] / by_hour["Usage (MWh)"] / 1000).to_numpy())
+        np.testing.assert_allclose(by_clock_hour["value_max"], hourly.groupby("hour")["pounds_co2_per_kwh"].max().to_numpy())
+
+        self.assertEqual(len(daily), 37)
+        np.testing.assert_allclose(daily["usage_mwh"], hourly.groupby("day")["Usage (MWh)"].sum().to_numpy())
+        self.assertEqual(list(monthly["period_start"]), [datetime.date(2024, 3, 1), datetime.date(2024, 4, 1), datetime.date(2024, 5, 1)])
+        self.assertEqual(list(monthly["hours"]), [4 * 24, 30 * 24, 3 * 24])
+        self.assertAlmostEqual(monthly["emissions"].sum(), hourly["emissions"].sum())
+
+    def test_generation_rollup_by_clock_hour(self):
+        start_date = datetime.datetime(2024, 4, 1)
+        end_date = datetime.datetime(2024, 5, 2)
+        with mock.patch("load_shifting.utils.get_hourly_eia_grid_mix", side_effect=fake_hourly_generation) as fetch:
+            result = rollup_generation_by_clock_hour("CISO", start_date=start_date, end_date=end_date)
+            rollup_generation_by_clock_hour("CISO", start_date=start_date, end_date=end_date)
+            # April is rolled up once; the May edge days are fetched each time
+            self.assertEqual(fetch.call_count, 3)
+
+        self.assertEqual(len(result), 48)
+        hour_5_gas = result[(result["hour"] == 5) & (result["fuel"] == "Natural gas")]["mwh"].iloc[0]
+        self.assertAlmostEqual(hour_5_gas, sum(range(1, 31)) + 1 + 2)
+
+    def test_incomplete_months_are_not_stored(self):
+        def cut_off_generation(ba_names, start_date=None, end_date=None):
+            # April's data stops on the morning of the 30th
+            generation = fake_hourly_generation(ba_names, start_date, end_date)
+            return generation[generation["period"] < "2024-04-30T11"]
+
+        april = dict(start_date=datetime.datetime(2024, 4, 1), end_date=datetime.datetime(2024, 4, 30))
+        with mock.patch("load_shifting.utils.get_hourly_eia_grid_mix", side_effect=cut_off_generation):
+            partial = rollup_generation_by_clock_hour("CISO", **april)
+        self.assertEqual(MaterializedDateRange.objects.filter(table_name="generation").count(), 0)
+        self.assertAlmostEqual(partial[(partial["hour"] == 5) & (partial["fuel"] == "Solar")]["mwh"].iloc[0], 3 * sum(range(1, 31)))
+        self.assertAlmostEqual(partial[(partial["hour"] == 20) & (partial["fuel"] == "Solar")]["mwh"].iloc[0], 3 * sum(range(1, 30)))
+
+        with mock.patch("load_shifting.utils.get_hourly_eia_grid_mix", side_effect=fake_hourly_generation) as fetch:
+            complete = rollup_generation_by_clock_hour("CISO", **april)
+            rollup_generation_by_clock_hour("CISO", **april)
+            self.assertEqual(fetch.call_count, 1)
+        self.assertAlmostEqual(complete[(complete["hour"] == 20) & (complete["fuel"] == "Solar")]["mwh"].iloc[0], 3 * sum(range(1, 31)))
+        self.assertEqual(list(MaterializedDateRange.objects.filter(table_name="generation").values_list("start_date", "end_date")),
+                         [(datetime.date(2024, 4, 1), datetime.date(2024, 4, 30))])
+
+
+def rank_error(sorted_values, estimate, quantile):
+    # How far quantile is from the range of ranks estimate could have in sorted_values
+    low = np.searchsorted(sorted_values, estimate, side="left") / len(sorted_values)
+    high = np.searchsorted(sorted_values, estimate, side="right") / len(sorted_values)
+    return max(low - quantile, quantile - high, 0)
+
+
+class QuantileSketchTestCase(TestCase):
+    def test_small_sketches_are_exact(self):
+        values = np.random.default_rng(1).normal(size=20)
+        sketch = sketches_by_group(np.zeros(20, dtype=int), values, 1)[0]
+        np.testing.assert_allclose(sketch_quantiles(sketch, [0, 0.25, 0.5, 0.75, 1]), np.quantile(values, [0, 0.25, 0.5, 0.75, 1]))
+        np.testing.assert_array_equal(sketch_from_bytes(sketch_to_bytes(sketch)), sketch)
+        self.assertTrue(np.isnan(sketch_quantiles(sketches_by_group([], [], 1)[0], [0.5])).all())
+
+    def test_merged_day_sketches_are_within_documented_bounds(self):
+        rng = np.random.default_rng(7)
+        bimodal = np.r_[rng.normal(0.3, 0.05, 24 * 200), rng.normal(1.2, 0.2, 24 * 165)]
+        rng.shuffle(bimodal)
+        for values in [rng.gamma(2, 0.3, size=24 * 365), bimodal, rng.uniform(0, 1, 24 * 365)]:
+            days = np.repeat(np.arange(365), 24)
+            day_sketches = sketches_by_group(days, values, 365)
+            # Days into months, months into a year
+            month_sketches = merge_sketches([day_sketches[month * 31:(month + 1) * 31] for month in range(12)])
+            year_sketch = merge_sketches([month_sketches])[0]
+            self.assertLessEqual(len(year_sketch), 110)
+            self.assertEqual(year_sketch["weight"].sum(), len(values))
+
+            statistics = pd.Series(values).describe()
+            sorted_values = np.sort(values)
+            estimates = sketch_quantiles(year_sketch, [0.25, 0.5, 0.75], statistics["min"], statistics["max"])
+            for quantile, estimate in zip([0.25, 0.5, 0.75], estimates):
+                self.assertLessEqual(rank_error(sorted_values, estimate, quantile), rank_error_bound(quantile))
+                self.assertAlmostEqual(estimate, statistics["{}%".format(int(quantile * 100))], delta=0.02)
+
+    def test_boxplot_statistics_from_sketches(self):
+        start_date = datetime.datetime(2024, 3, 20)
+        end_date = datetime.datetime(2024, 5, 10)
+        with mock.patch("load_shifting.utils.cache_wrapped_hourly_gen_mix_by_ba_and_type", side_effect=fake_varying_usage_frame):
+            exact = get_hourly_co2_intensity("CISO", start_date=start_date, end_date=end_date)["pounds_co2_per_kwh"].describe()
+            statistics = rollup_co2_intensity_statistics("CISO", start_date=start_date, end_date=end_date)
+        self.assertEqual(statistics["count"], exact["count"])
+        self.assertAlmostEqual(statistics["mean"], exact["mean"])
+        self.assertEqual(statistics["min"], exact["min"])
+        self.assertEqual(statistics["max"], exact["max"])
+        for name in ["25%", "50%", "75%"]:
+            self.assertAlmostEqual(statistics[name], exact[name], delta=0.01)
+
+
+GAS_HALF_FACTORS = {"test-gas-half": dict(EMISSIONS_BY_FUEL, **{"Natural gas": 0.5})}
+
+
+class EmissionFactorTestCase(TestCase):
+    def test_factors_are_looked_up_per_category(self):
+        usage = fake_usage_frame("CISO", datetime.datetime(2024, 4, 1), datetime.datetime(2024, 4, 1))[
+            ["timestamp", "fromba", "generation_type", "Usage (MWh)"]]
+        from_strings = apply_emission_factors(usage)
+        from_categories = apply_emission_factors(usage.astype({"generation_type": "category"}))
+        np.testing.assert_array_equal(from_strings["emissions"], from_categories["emissions"])
+        self.assertEqual(list(from_strings["emissions"].iloc[:2]), [0.0, 0.97 * 100 * 1000])
+        self.assertFalse("emissions" in usage.columns)
+
+        with self.assertRaises(UnknownEmissionFactors):
+            apply_emission_factors(usage, "no-such-table")
+        with override_settings(LOAD_SHIFTING_EMISSION_FACTOR_TABLES=GAS_HALF_FACTORS):
+            self.assertEqual(apply_emission_factors(usage, "test-gas-half")["emissions_per_kwh"].iloc[1], 0.5)
+
+    @override_settings(LOAD_SHIFTING_EMISSION_FACTOR_TABLES=GAS_HALF_FACTORS)
+    def test_intensity_is_kept_per_factor_table(self):
+        april_1 = datetime.datetime(2024, 4, 1)
+        april_2 = datetime.datetime(2024, 4, 2)
+        with mock.patch("load_shifting.utils.cache_wrapped_hourly_gen_mix_by_ba_and_type", side_effect=fake_usage_frame):
+            eia = get_hourly_co2_intensity("CISO", start_date=april_1, end_date=april_2)
+            gas_half = get_hourly_co2_intensity("CISO", start_date=april_1, end_date=april_2, emission_factors="test-gas-half")
+            by_clock_hour = rollup_co2_intensity_by_clock_hour("CISO", start_date=april_1, end_date=april_2, emission_factors="test-gas-half")
+        self.assertAlmostEqual(eia["pounds_co2_per_kwh"].iloc[0], 0.97 * 100 / 400)
+        self.assertAlmostEqual(gas_half["pounds_co2_per_kwh"].iloc[0], 0.5 * 100 / 400)
+        np.testing.assert_allclose(by_clock_hour["hours_weighted_mean"], 0.5 * 100 / 400)
+        self.assertEqual(HourlyCO2Intensity.objects.count(), 2 * 48)
+
+    def test_unknown_factor_table_is_a_bad_request(self):
+        response = self.client.get("/load_shifting/co2_intensity_json?factors=no-such-table")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("eia-faq-74-v1", response.json()["error"])
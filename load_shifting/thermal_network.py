@@ -0,0 +1,194 @@
+"""
+A three-node version of the house model: indoor air, envelope (walls and roof) and
+interior mass (floor, interior walls, furniture), instead of the one lumped
+building_heat_capacity.
+
+    outdoor --2G-- envelope --2G-- air --H-- mass
+    outdoor --------air changes---- air
+
+G is the single-zone model's wall and roof conductance, split across the middle of the
+envelope so the envelope node sits between two halves of it; H is the heat transfer
+between the air and the surfaces of the interior mass. The sun lands on the mass and
+the HVAC heats or cools the air. The heat capacities add up to the single-zone model's,
+so over days the two behave alike; within a day the air responds to the HVAC much
+faster than the whole building does.
+
+The model is linear, x' = A x + B u, with x the three node temperatures and u = (outdoor
+temperature, sun W, HVAC W). With u held constant over a timestep (the HVAC decides at
+the start of the step, as in house_simulation) the exact update is
+
+    x(dt) = expm(A dt) x(0) + A^-1 (expm(A dt) - I) B u
+
+which step_matrices gets, along with the integral of x over the step (for the energy
+columns), from one matrix exponential of an augmented matrix, once per run. Each step is
+then a couple of 3x3 matrix-vector products, exact whatever the step length.
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+from scipy.linalg import expm
+
+from .house_simulation import (AIR_VOLUMETRIC_HEAT_CAPACITY, SECONDS_PER_HOUR, SMART_HVAC_COASTING_RANGE_C,
+                               HVAC_OFF, HVAC_HEATING, HVAC_COOLING, SimulationOutputs, house_constants,
+                               smart_hvac_decisions)
+
+
+AIR, ENVELOPE, MASS = 0, 1, 2
+
+# Share of the non-air heat capacity that's in the envelope; the rest is interior mass
+ENVELOPE_HEAT_CAPACITY_SHARE = 0.3
+# Convective + radiative heat transfer between room air and interior surfaces (W/m2/K)
+INTERIOR_SURFACE_COEFFICIENT = 8
+# Interior mass surface area (floor, interior walls, furniture) per m2 of floor
+MASS_AREA_PER_FLOOR_AREA = 3
+
+
+@dataclass
+class ThreeNodeParameters:
+    air_heat_capacity: float        # J/K
+    envelope_heat_capacity: float   # J/K
+    mass_heat_capacity: float       # J/K
+    envelope_conductance_w_per_k: float  # outdoor-envelope and envelope-air, each
+    air_change_w_per_k: float
+    mass_conductance_w_per_k: float  # air-mass
+
+
+@dataclass
+class StepMatrices:
+    state: np.ndarray               # x(dt) = state @ x(0) + input @ u
+    input: np.ndarray
+    integral_state: np.ndarray      # integral of x over the step = integral_state @ x(0) + integral_input @ u
+    integral_input: np.ndarray
+
+
+def three_node_parameters(home, envelope_share=ENVELOPE_HEAT_CAPACITY_SHARE,
+                          interior_surface_coefficient=INTERIOR_SURFACE_COEFFICIENT,
+                          mass_area_per_floor_area=MASS_AREA_PER_FLOOR_AREA):
+    air_heat_capacity = home.building_volume_cu_m * AIR_VOLUMETRIC_HEAT_CAPACITY
+    rest = home.building_heat_capacity - air_heat_capacity
+    return ThreeNodeParameters(
+        air_heat_capacity=air_heat_capacity,
+        envelope_heat_capacity=rest * envelope_share,
+        mass_heat_capacity=rest * (1 - envelope_share),
+        envelope_conductance_w_per_k=2 * home.surface_area_to_area_sq_m / home.wall_insulation_r_value_si,
+        air_change_w_per_k=home.building_volume_cu_m * home.ach_natural / SECONDS_PER_HOUR * AIR_VOLUMETRIC_HEAT_CAPACITY,
+        mass_conductance_w_per_k=interior_surface_coefficient * mass_area_per_floor_area * home.conditioned_floor_area_sq_m,
+    )
+
+
+def state_space(parameters):
+    """
+    (A, B) of x' = A x + B u, x = (air, envelope, mass) temperatures, u = (outdoor
+    temperature, sun W, HVAC W).
+    """
+    envelope = parameters.envelope_conductance_w_per_k
+    air_change = parameters.air_change_w_per_k
+    mass = parameters.mass_conductance_w_per_k
+    capacities = np.array([parameters.air_heat_capacity, parameters.envelope_heat_capacity, parameters.mass_heat_capacity])
+
+    conductances = np.array([
+        # air, envelope, mass
+        [-(envelope + air_change + mass), envelope, mass],
+        [envelope, -2 * envelope, 0],
+        [mass, 0, -mass],
+    ])
+    inputs = np.array([
+        # outdoor, sun, HVAC
+        [air_change, 0, 1],
+        [envelope, 0, 0],
+        [0, 1, 0],
+    ])
+    return conductances / capacities[:, np.newaxis], inputs / capacities[:, np.newaxis]
+
+
+def step_matrices(parameters, dt_seconds):
+    # expm of [[A, B, 0], [0, 0, 0], [I, 0, 0]] * dt has x(dt) in its first block row
+    # and the integral of x in its last
+    a, b = state_space(parameters)
+    augmented = np.zeros((9, 9))
+    augmented[0:3, 0:3] = a
+    augmented[0:3, 3:6] = b
+    augmented[6:9, 0:3] = np.eye(3)
+    exponential = expm(augmented * dt_seconds)
+    return StepMatrices(
+        state=exponential[0:3, 0:3],
+        input=exponential[0:3, 3:6],
+        integral_state=exponential[6:9, 0:3],
+        integral_input=exponential[6:9, 3:6],
+    )
+
+
+def simulate_house_three_node(home, inputs, initial_indoor_temperature_c=None, parameters=None):
+    """
+    simulate_house with the three-node model. All three nodes start at
+    initial_indoor_temperature_c (by default the heating setpoint). The outputs are the
+    same as simulate_house's, with the indoor temperature being the air's: the HVAC and
+    curtains go by it, and ΔT is its change. Conductive energy is what comes in through
+    the outside of the envelope; net energy is everything coming into the building, some
+    of which ends up in the envelope and mass rather than the air.
+
+    The minimum-CO2 schedule (hvac_optimizer.py) is solved for the single-zone model,
+    so homes with optimal_hvac_algorithm get a ValueError rather than basic HVAC.
+    """
+    if home.optimal_hvac_algorithm:
+        raise ValueError("The three-node model doesn't support optimal_hvac_algorithm homes, use solver \"euler\" or \"exact\"")
+    if parameters is None:
+        parameters = three_node_parameters(home)
+    dt_seconds = inputs.dt_seconds
+    matrices = step_matrices(parameters, dt_seconds)
+    constants = house_constants(home, dt_seconds)
+    decisions = smart_hvac_decisions(constants, inputs)
+    outputs = SimulationOutputs.allocate(len(inputs.temp_air))
+
+    if initial_indoor_temperature_c is None:
+        initial_indoor_temperature_c = home.heating_setpoint_c
+    temperatures = np.full(3, initial_indoor_temperature_c, dtype=np.float64)
+
+    for row in range(len(inputs.temp_air)):
+        outdoor_temperature_c = inputs.temp_air[row]
+        indoor_temperature_c = temperatures[AIR]
+        sun_w = constants.window_solar_gain * inputs.irradiance[row]
+        if indoor_temperature_c > constants.cooling_setpoint_c and constants.can_close_curtains:
+            sun_w *= 0.1
+
+        if decisions.overdrive_heating[row] and indoor_temperature_c < constants.cooling_setpoint_c:
+            hvac_mode, hvac_w = HVAC_HEATING, home.hvac_capacity_w
+        elif decisions.overdrive_cooling[row] and indoor_temperature_c > constants.heating_setpoint_c:
+            hvac_mode, hvac_w = HVAC_COOLING, -home.hvac_capacity_w
+        elif decisions.coasting[row]:
+            if indoor_temperature_c < constants.heating_setpoint_c - SMART_HVAC_COASTING_RANGE_C:
+                hvac_mode, hvac_w = HVAC_HEATING, home.hvac_capacity_w
+            elif indoor_temperature_c > constants.heating_setpoint_c + SMART_HVAC_COASTING_RANGE_C:
+                hvac_mode, hvac_w = HVAC_COOLING, -home.hvac_capacity_w
+            else:
+                hvac_mode, hvac_w = HVAC_OFF, 0
+        elif indoor_temperature_c < constants.heating_setpoint_c:
+            hvac_mode, hvac_w = HVAC_HEATING, home.hvac_capacity_w
+        elif indoor_temperature_c > constants.cooling_setpoint_c:
+            hvac_mode, hvac_w = HVAC_COOLING, -home.hvac_capacity_w
+        else:
+            hvac_mode, hvac_w = HVAC_OFF, 0
+
+        step_inputs = np.array([outdoor_temperature_c, sun_w, hvac_w])
+        integrals = matrices.integral_state @ temperatures + matrices.integral_input @ step_inputs
+        new_temperatures = matrices.state @ temperatures + matrices.input @ step_inputs
+
+        energy_from_conduction_j = parameters.envelope_conductance_w_per_k * (outdoor_temperature_c * dt_seconds - integrals[ENVELOPE])
+        energy_from_air_change_j = parameters.air_change_w_per_k * (outdoor_temperature_c * dt_seconds - integrals[AIR])
+        energy_from_sun_j = sun_w * dt_seconds
+        energy_from_hvac_j = hvac_w * dt_seconds
+
+        outputs.temperature_difference_c[row] = outdoor_temperature_c - indoor_temperature_c
+        outputs.conductive_energy_j[row] = energy_from_conduction_j
+        outputs.air_change_energy_j[row] = energy_from_air_change_j
+        outputs.radiant_energy_j[row] = energy_from_sun_j
+        outputs.hvac_energy_j[row] = energy_from_hvac_j
+        outputs.hvac_mode[row] = hvac_mode
+        outputs.net_energy_j[row] = energy_from_conduction_j + energy_from_air_change_j + energy_from_sun_j + energy_from_hvac_j
+        outputs.delta_t[row] = new_temperatures[AIR] - indoor_temperature_c
+        outputs.indoor_temperature_c[row] = new_temperatures[AIR]
+        temperatures = new_temperatures
+
+    outputs.hvac_energy_use_kwh[:] = np.abs(outputs.hvac_energy_j) / constants.hvac_joules_per_kwh_used
+    return outputs
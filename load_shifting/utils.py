@@ -5,33 +5,38 @@ import requests
 import pandas as pd
 import numpy as np
 from django.conf import settings
-from io import StringIO
-from .models import AllPurposeCSVCache
+from django.db import transaction
+from django.utils import timezone
+from .models import AllPurposeCSVCache, HourlyCO2Intensity, MaterializedDateRange, RollupCell
+from .caching import canonical_cache_key, lookup_cached_frame, store_cached_frame, frame_memory_cache
+from .caching import as_date, read_cache_row, find_cache_rows_for_range, missing_date_ranges, replace_cached_frames
+from .caching import canonical_params_key, run_single_flight
 from dataclasses import dataclass
 import pvlib
+from pvlib.iotools import psm3
 import math
-
-
-# From https://www.eia.gov/tools/faqs/faq.php?id=74&t=11
-# estimates of CO2e per kwh for fossil fuels:
-EMISSIONS_BY_FUEL = {
-    "COL": 2.30,
-    "NG": 0.97,
-    "OIL": 2.38,
-    "NUC": 0,
-    "SUN": 0,
-    "WAT": 0,
-    "WND": 0,
-    "OTH": 0.86, # from EIA's "average across all power sources", shrug emoji
-    "Hydro": 0,
-    "Solar": 0,
-    "Petroleum": 2.38,
-    "Nuclear": 0,
-    "Natural gas": 0.97,
-    "Wind": 0,
-    "Coal": 2.30,
-    "Other": 0.86, # TODO: if i determine "Other" is mostly battery, then set this to 0 and clear cache
-}
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from django_framework import http_client
+from .fuel_mix_tensor import build_fuel_mix_tensors, usage_by_fuel, fuel_mix_frame
+from .grid_flow_tracing import grid_fuel_usage, grid_co2_intensity_from_fuel_usage, fuel_columns
+from .parallel import run_per_ba
+from .rollups import rollup_cells, merge_cells, split_into_months, CELL_COLUMNS, ALL_HOURS
+from .quantile_sketch import sketch_to_bytes, sketch_from_bytes
+from .emission_factors import EMISSION_FACTOR_TABLES, DEFAULT_EMISSION_FACTORS, apply_emission_factors, default_emission_factors, emission_factors_for
+# The physical constants live in house_simulation.py, which uses them too
+from .house_simulation import JOULES_PER_KWH, JOULES_PER_MEGAJOULE, SECONDS_PER_HOUR, AIR_VOLUMETRIC_HEAT_CAPACITY
+from .house_simulation import simulation_inputs, simulate_house, simulate_houses, simulation_frame
+from .house_simulation import HVAC_MODE_NAMES
+from .thermal_network import simulate_house_three_node
+from .hvac_optimizer import cached_optimal_hvac_policy
+from .simulation_cache import cached_simulation_frames
+import re
+
+
+# Pounds of CO2e per kWh by fuel type. Emissions are worked out from these when data is
+# read, not cached; see emission_factors.py for the other tables.
+EMISSIONS_BY_FUEL = EMISSION_FACTOR_TABLES[DEFAULT_EMISSION_FACTORS]
 
 default_end_date = datetime.date.today()
 default_start_date = (datetime.date.today() - datetime.timedelta(days=365))
@@ -60,57 +65,201 @@ def cache_csv( wrapped_function ):
     The function name is used as part of the cache key, so old cache entries will be
     invalidated if the function name changes. So change the name if you are changing
     the semantics, and don't change the name if you're not!
-    """
 
-    def wrapper(*args, **kwargs):
+    Despite the name, frames are no longer stored as CSV: see caching.py for the binary
+    format, which gives back the exact same dtypes and index that were cached.
+
+    Each process also keeps recently used frames in memory (caching.frame_memory_cache),
+    so repeated calls within one worker don't touch the database at all. Every call gets
+    its own copy of the frame, so it's safe to modify the result.
+
+    Concurrent misses on the same entry, from any worker, are coalesced: one of them
+    computes the frame while the others wait for it to land in the cache.
 
-        function_name = wrapped_function.__name__
+    my_function.store(df, start_date=..., end_date=..., key=value) caches df as the result
+    of that call, for frames computed somewhere that can't write to the database (e.g. a
+    worker process, see prefetch_hourly_gen_mix). my_function.lookup(...) gives the cached
+    result of a call, or None, without computing it.
+    """
+    function_name = wrapped_function.__name__
+
+    def cache_key(kwargs):
         if not "start_date" in kwargs:
             raise Exception("No start_date param in function {} (params: {})".format(function_name, kwargs.keys()))
-        
-        start_date = kwargs["start_date"]
-        end_date = kwargs["end_date"]
         key_params_json = {
             key: kwargs[key] for key in kwargs.keys() if not key in ["start_date", "end_date"]
         }
+        return key_params_json, canonical_cache_key(function_name, key_params_json, kwargs["start_date"], kwargs["end_date"])
+
+    def wrapper(*args, **kwargs):
 
-        cache_hits = AllPurposeCSVCache.objects.filter(
-            cache_function_name = function_name,
-            key_params_json = json.dumps(key_params_json),
-            start_date = start_date,
-            end_date = end_date)
-        if cache_hits.count() > 0:
+        key_params_json, key_hash = cache_key(kwargs)
+        start_date = kwargs["start_date"]
+        end_date = kwargs["end_date"]
+        cached_df = frame_memory_cache.get(key_hash)
+        if cached_df is not None:
+            return cached_df
+
+        cached_df = lookup_cached_frame(key_hash)
+        if cached_df is not None:
             # Case of cache hit:
-            virtual_file = StringIO()
-            virtual_file.write(cache_hits[0].raw_csv)
-            virtual_file.seek(0)
-            cached_df = pd.read_csv( virtual_file )
-            virtual_file.close()
+            frame_memory_cache.put(key_hash, cached_df)
             return cached_df
 
-        # Case of cache miss:
-        result_df = wrapped_function(*args, **kwargs)
-
-        # Write new cache:
-        virtual_file = StringIO()
-        result_df.to_csv(virtual_file)
-        virtual_file.seek(0)
-        new_cache = AllPurposeCSVCache.objects.create(
-            cache_function_name = function_name,
-            cached_date = datetime.datetime.now(),
-            key_params_json = json.dumps(key_params_json),
-            start_date = start_date,
-            end_date = end_date,
-            raw_csv = virtual_file.read()
-        )
-        virtual_file.close()
-        new_cache.save()
+        # Case of cache miss. If another worker is already computing this same entry, wait
+        # for its result instead of repeating the work (see caching.run_single_flight).
+        def compute_and_store():
+            result_df = wrapped_function(*args, **kwargs)
+            store_cached_frame(function_name, key_params_json, start_date, end_date, result_df, key_hash=key_hash)
+            return result_df
+
+        result_df = run_single_flight(key_hash, lambda: lookup_cached_frame(key_hash), compute_and_store)
+        frame_memory_cache.put(key_hash, result_df)
         return result_df
 
+    def lookup(**kwargs):
+        _, key_hash = cache_key(kwargs)
+        cached_df = frame_memory_cache.get(key_hash)
+        return cached_df if cached_df is not None else lookup_cached_frame(key_hash)
+
+    def store(result_df, **kwargs):
+        key_params_json, key_hash = cache_key(kwargs)
+        store_cached_frame(function_name, key_params_json, kwargs["start_date"], kwargs["end_date"], result_df, key_hash=key_hash)
+        frame_memory_cache.put(key_hash, result_df)
+
+    wrapper.lookup = lookup
+    wrapper.store = store
     return wrapper
 
 
-@cache_csv
+def slice_frame_to_dates(df, date_column, start_date, end_date):
+    """
+    Keep the rows of df whose date_column falls between start_date and end_date (inclusive,
+    day granularity). date_column holds ISO-format period strings like EIA's
+    "2024-04-30T10-07" or "2024-04-30", so comparing the first 10 characters compares dates.
+    """
+    row_days = df[date_column].astype(str).str[:10]
+    in_range = (row_days >= as_date(start_date).isoformat()) & (row_days <= as_date(end_date).isoformat())
+    return df[in_range.values]
+
+
+def merge_cached_frames(frames, date_column):
+    """
+    Combine overlapping pieces of one time series into one frame. Rows that appear in more
+    than one piece (same values in every non-float column, e.g. same period/respondent/type)
+    are kept once, preferring the most recently fetched piece (last in frames).
+    The "timestamp" column is derived from the period, and "Unnamed: 0" is the old index
+    from CSV-format cache rows, so neither is used to tell rows apart.
+    """
+    merged_df = pd.concat(
+        [df.drop(columns=["Unnamed: 0"], errors="ignore") for df in frames], ignore_index=True)
+    key_columns = [
+        column for column in merged_df.columns
+        if column != "timestamp" and not pd.api.types.is_float_dtype(merged_df[column])
+    ]
+    merged_df = merged_df.drop_duplicates(subset=key_columns, keep="last")
+    # Concatenating categoricals with different categories falls back to object dtype
+    merged_df = categorize_eia_key_columns(merged_df)
+    return merged_df.sort_values(date_column, ascending=False, kind="stable").reset_index(drop=True)
+
+
+def cache_csv_date_range( date_column ):
+    """
+    Like @cache_csv, but for functions that return a time series where each row has a date
+    in date_column, and where calling with a bigger date range just returns more rows.
+
+        @cache_csv_date_range("period")
+        def my_timeseries(start_date=None, end_date=None, key=value):
+            ...
+
+    A request for a range that's inside an already-cached range is answered by slicing the
+    cached entry. A request that's only partly covered calls the wrapped function just for
+    the missing date ranges, merges them with what was cached, and stores the result as one
+    entry covering the combined range. Dates are handled at day granularity, so the
+    wrapped function has to return every hour of the first and last days it's asked for
+    (see eia_period_bound), or the seams between merged pieces would have holes.
+    """
+
+    def decorator(wrapped_function):
+
+        def wrapper(*args, **kwargs):
+            function_name = wrapped_function.__name__
+            if not "start_date" in kwargs:
+                raise Exception("No start_date param in function {} (params: {})".format(function_name, kwargs.keys()))
+
+            start_date = kwargs["start_date"]
+            end_date = kwargs["end_date"]
+            key_params_json = {
+                key: kwargs[key] for key in kwargs.keys() if not key in ["start_date", "end_date"]
+            }
+
+            key_hash = canonical_cache_key(function_name, key_params_json, start_date, end_date)
+            cached_df = frame_memory_cache.get(key_hash)
+            if cached_df is not None:
+                return cached_df
+
+            def lookup_covering_range():
+                covering_row, _ = find_cache_rows_for_range(function_name, key_params_json, start_date, end_date)
+                if covering_row is None:
+                    return None
+                # Case of cache hit, possibly on a bigger range than we asked for:
+                cached_df = read_cache_row(covering_row)
+                if covering_row.key_hash != key_hash:
+                    cached_df = slice_frame_to_dates(cached_df, date_column, start_date, end_date)
+                return cached_df
+
+            def fetch_missing_and_store():
+                _, touching_rows = find_cache_rows_for_range(function_name, key_params_json, start_date, end_date)
+                if len(touching_rows) == 0:
+                    # Case of cache miss:
+                    result_df = wrapped_function(*args, **kwargs)
+                    store_cached_frame(function_name, key_params_json, start_date, end_date, result_df, key_hash=key_hash)
+                    return result_df
+
+                # Case of partial cache hit: fetch only the date ranges we don't have yet.
+                gaps = missing_date_ranges(
+                    start_date, end_date, [(row.start_date, row.end_date) for row in touching_rows])
+                fetched_frames = []
+                for gap_start, gap_end in gaps:
+                    gap_kwargs = dict(
+                        kwargs,
+                        start_date=datetime.datetime.combine(gap_start, datetime.time()),
+                        end_date=datetime.datetime.combine(gap_end, datetime.time()))
+                    try:
+                        fetched_frames.append(wrapped_function(*args, **gap_kwargs))
+                    except EIAAPIExeption:
+                        # No rows for this piece of the range; the rest can still be served.
+                        print("No data for {} from {} to {}".format(function_name, gap_start, gap_end))
+
+                merged_df = merge_cached_frames(
+                    [read_cache_row(row) for row in touching_rows] + fetched_frames, date_column)
+                merged_start = min([as_date(start_date)] + [as_date(row.start_date) for row in touching_rows])
+                merged_end = max([as_date(end_date)] + [as_date(row.end_date) for row in touching_rows])
+                replace_cached_frames(
+                    touching_rows, function_name, key_params_json,
+                    datetime.datetime.combine(merged_start, datetime.time()),
+                    datetime.datetime.combine(merged_end, datetime.time()),
+                    merged_df)
+                return slice_frame_to_dates(merged_df, date_column, start_date, end_date)
+
+            cached_df = lookup_covering_range()
+            if cached_df is None:
+                # Lock on the whole series rather than this exact range, since filling in
+                # gaps rewrites the series' cache entries.
+                cached_df = run_single_flight(
+                    canonical_params_key(function_name, key_params_json),
+                    lookup_covering_range,
+                    fetch_missing_and_store)
+            frame_memory_cache.put(key_hash, cached_df)
+            return cached_df
+
+        wrapper.__name__ = wrapped_function.__name__
+        return wrapper
+
+    return decorator
+
+
+@cache_csv_date_range("period")
 def cache_wrapped_get_eia_timeseries(
     url_segment="",
     facets={},
@@ -121,7 +270,7 @@ def cache_wrapped_get_eia_timeseries(
     include_timezone=True
 ):
 
-    return get_eia_timeseries_recursive(
+    return get_eia_timeseries(
         url_segment,
         facets,
         value_column_name=value_column_name,
@@ -134,34 +283,42 @@ def cache_wrapped_get_eia_timeseries(
 
 
 
-def get_eia_timeseries_recursive(
-    url_segment,
-    facets,
-    value_column_name="value",
-    start_date=default_start_date,
-    end_date=default_end_date,
-    start_page=0,
-    frequency="daily",
-    include_timezone=True
-):
+EIA_MAX_ROWS_PER_PAGE = 5000  # This is the maximum allowed per API call from the EIA
+
+
+def eia_period_bound(day, frequency, is_end):
     """
-    A generalized helper function to fetch data from the EIA API
+    The start or end parameter for an EIA query covering whole days. A bare date on an
+    hourly query means the first hour of that day to EIA, so e.g. end=2024-04-30 would
+    leave out the rest of Apr 30, and the caches (which work in whole days) would then
+    have a hole at every seam. So hourly queries get explicit hours: T00 of the first day
+    to T23 of the last, on the period's own clock (local time for "local-hourly").
     """
+    bound = day.strftime("%Y-%m-%d")
+    if frequency in ["hourly", "local-hourly"]:
+        bound += "T23" if is_end else "T00"
+    return bound
 
+
+def fetch_eia_page(url_segment, facets, start_date, end_date, frequency, offset):
+    """
+    Fetch one page (up to EIA_MAX_ROWS_PER_PAGE rows, starting at row offset) from the EIA
+    API. Returns the parsed JSON response.
+    """
     EIA_API_KEY = os.getenv("EIA_API_KEY")
     if EIA_API_KEY is None:
         EIA_API_KEY = settings.EIA_API_KEY
     assert EIA_API_KEY is not None
 
-    max_row_count = 5000  # This is the maximum allowed per API call from the EIA
-    api_url = f"https://api.eia.gov/v2/electricity/rto/{url_segment}/data/?api_key={EIA_API_KEY}"
-    offset = start_page * max_row_count
+    # Can point at a local stand-in for offline runs, see api_fixtures.py
+    EIA_API_URL = os.getenv("EIA_API_URL")
+    if EIA_API_URL is None:
+        EIA_API_URL = getattr(settings, "EIA_API_URL", "https://api.eia.gov/v2/electricity/rto/")
 
-    if include_timezone and not "timezone" in facets:
-        facets = dict(**{"timezone": ["Pacific"]}, **facets)
+    api_url = f"{EIA_API_URL}{url_segment}/data/?api_key={EIA_API_KEY}"
 
-    date_format = "%Y-%m-%d"
-    response = requests.get(
+    response = http_client.get(
+        "eia",
         api_url,
         headers={
             "X-Params": json.dumps(
@@ -169,11 +326,11 @@ def get_eia_timeseries_recursive(
                     "frequency": frequency,
                     "data": ["value"],
                     "facets": facets,
-                    "start": datetime.datetime.strftime(start_date, date_format),
-                    "end": datetime.datetime.strftime(end_date, date_format),
+                    "start": eia_period_bound(start_date, frequency, is_end=False),
+                    "end": eia_period_bound(end_date, frequency, is_end=True),
                     "sort": [{"column": "period", "direction": "desc"}],
                     "offset": offset,
-                    "length": max_row_count,
+                    "length": EIA_MAX_ROWS_PER_PAGE,
                 }
             )
         },
@@ -181,52 +338,206 @@ def get_eia_timeseries_recursive(
     if response.status_code != 200:
         raise( Exception("EIA API gave status code {} reason {}".format(response.status_code, response.reason)))
     response_content = response.json()
-    print(response_content) 
 
     # Sometimes EIA API responses are nested under a "response" key. Sometimes not 🤷
     if "response" in response_content:
         response_content = response_content["response"]
+    return response_content
 
-    print(f"{len(response_content['data'])} rows fetched")
-    if len(response_content["data"]) == 0:
-        raise( EIAAPIExeption("no data rows"))
 
-    # Convert the data to a Pandas DataFrame and clean it up for plotting & analysis.
-    dataframe = pd.DataFrame(response_content["data"])
-    # Add a more useful timestamp column
-    dataframe["timestamp"] = dataframe["period"].apply( pd.to_datetime ) # this seems to work?
-    #pd.to_datetime , format="%Y/%m/%dT%H"
-    #)
-    # Clean up the "value" column-
+# Columns of EIA rto/* data that we keep. The rest ("respondent-name", "fromba-name",
+# "toba-name", "value-units") are long strings repeated on every row that nothing uses.
+EIA_KEY_COLUMNS = ["respondent", "fromba", "toba", "type", "fueltype", "type-name"]
+
+
+def parse_eia_period(period):
+    """
+    Vectorized version of period.apply(pd.to_datetime) for EIA period strings like
+    "2024-04-30T10-07" (local-hourly), "2024-04-30T17" (UTC hourly) or "2024-04-30" (daily).
+
+    When every row has the same UTC offset this gives a datetime64 column with that fixed
+    offset. A range that crosses a daylight saving change has two offsets, and (like the
+    per-row apply) we then return an object column of Timestamps that each keep their own
+    offset, so that local clock hours are preserved.
+    """
+    period = pd.Series(period, copy=False).astype(str)
+    offsets = period.str[13:]
+    distinct_offsets = offsets.unique()
+    if len(distinct_offsets) <= 1:
+        return pd.to_datetime(period, format="ISO8601")
+
+    timestamps = np.empty(len(period), dtype=object)
+    for offset in distinct_offsets:
+        rows_with_offset = (offsets == offset).values
+        timestamps[rows_with_offset] = pd.to_datetime(
+            period[rows_with_offset], format="ISO8601").astype(object).values
+    return pd.Series(timestamps, index=period.index)
+
+
+def eia_page_to_dataframe(response_content, value_column_name):
+    """
+    Convert one page of EIA rows into a data frame with float64 values and only the
+    columns we use.
+    """
+    rows = response_content["data"]
+    present_columns = rows[0].keys() if len(rows) > 0 else []
+    columns = {}
+    for column in ["period"] + EIA_KEY_COLUMNS:
+        if column in present_columns:
+            columns[column] = [row.get(column) for row in rows]
     # EIA always sends the value we asked for in a column called "value"
     # Oddly, this is sometimes sent as a string though it should always be a number.
     # We convert its dtype and set the name to a more useful one
-    eia_value_column_name = "value"
-    processed_df = dataframe.astype({eia_value_column_name: float}).rename(
-        columns={eia_value_column_name: value_column_name}
-    )
+    columns[value_column_name] = np.array([row.get("value") for row in rows], dtype=object).astype(np.float64)
+
+    return pd.DataFrame(columns)
+
+
+def categorize_eia_key_columns(dataframe):
+    # BA names and fuel types repeat on every row, store them as categoricals
+    for column in EIA_KEY_COLUMNS:
+        if column in dataframe.columns:
+            dataframe[column] = dataframe[column].astype("category")
+    return dataframe
+
+
+def get_eia_timeseries(
+    url_segment,
+    facets,
+    value_column_name="value",
+    start_date=default_start_date,
+    end_date=default_end_date,
+    start_page=0,
+    frequency="daily",
+    include_timezone=True,
+    max_concurrent_requests=None
+):
+    """
+    A generalized helper function to fetch data from the EIA API.
+
+    The first page tells us how many rows there are in total, so after that we know the
+    offsets of all the remaining pages and fetch them concurrently (at most
+    max_concurrent_requests at a time, default settings.EIA_MAX_CONCURRENT_REQUESTS).
+    Pages are concatenated in order, so the result is the same as fetching them one by one.
+    """
+    if max_concurrent_requests is None:
+        max_concurrent_requests = getattr(settings, "EIA_MAX_CONCURRENT_REQUESTS", 4)
+
+    if include_timezone and not "timezone" in facets:
+        facets = dict(**{"timezone": ["Pacific"]}, **facets)
+
+    def fetch_page(offset):
+        # Each page is converted to typed columns as soon as it arrives, so we never hold
+        # more than a few pages of raw JSON at once.
+        response_content = fetch_eia_page(url_segment, facets, start_date, end_date, frequency, offset)
+        if len(response_content["data"]) == 0:
+            raise( EIAAPIExeption("no data rows"))
+        return eia_page_to_dataframe(response_content, value_column_name), int(response_content["total"])
+
+    first_offset = start_page * EIA_MAX_ROWS_PER_PAGE
+    first_page, rows_total = fetch_page(first_offset)
 
     # Pagination logic
-    rows_fetched = len(processed_df) + offset
-    rows_total = int(response_content["total"])
-    more_rows_needed = rows_fetched != rows_total
-    if more_rows_needed:
-        # Recursive call to get remaining rows
-        # TODO probably be better to unroll this recursion
-        additional_rows = get_eia_timeseries_recursive(
-            url_segment=url_segment,
-            facets=facets,
-            value_column_name=value_column_name,
-            start_date=start_date,
-            end_date=end_date,
-            start_page=start_page + 1,
-            frequency=frequency,
-            include_timezone=include_timezone
-        )
-        return pd.concat([processed_df, additional_rows])
-    else:
-        return processed_df
+    remaining_offsets = range(first_offset + EIA_MAX_ROWS_PER_PAGE, rows_total, EIA_MAX_ROWS_PER_PAGE)
+    remaining_pages = []
+    if len(remaining_offsets) > 0:
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrent_requests)) as executor:
+            # executor.map returns results in the order of remaining_offsets
+            remaining_pages = [page for page, _ in executor.map(fetch_page, remaining_offsets)]
 
+    dataframe = pd.concat([first_page] + remaining_pages)
+    # Add a more useful timestamp column. Parsed after concatenating so that a range
+    # spanning a daylight saving change is handled consistently across pages.
+    dataframe["timestamp"] = parse_eia_period(dataframe["period"]).array
+    return categorize_eia_key_columns(dataframe)
+
+
+def get_eia_timeseries_recursive(url_segment, facets, **kwargs):
+    # Kept for callers of the old name; pages are no longer fetched recursively.
+    return get_eia_timeseries(url_segment, facets, **kwargs)
+
+
+
+def get_eia_timeseries_by_ba(shard_facet, balancing_authorities, facets={}, use_cache=True, **kwargs):
+    """
+    Fetch an EIA time series for several balancing authorities, caching each BA's rows
+    separately (facets={shard_facet: [ba], ...}) so that different BA lists share cache
+    entries. E.g. CISO's and PACW's neighbor lists overlap a lot, and every BA they have in
+    common only needs to be fetched once.
+
+    BAs that are (even partly) cached go through cache_wrapped_get_eia_timeseries one by
+    one. All the BAs with nothing cached are fetched together in a single EIA query,
+    then split into per-BA cache entries. BAs that have no rows get an empty entry, so
+    they aren't asked for again. Like the cache decorators, concurrent callers missing the
+    same BAs wait for one of them to fetch (see caching.run_single_flight).
+    kwargs are the other cache_wrapped_get_eia_timeseries arguments.
+
+    use_cache=False skips the cache altogether and fetches all the BAs in one query,
+    without touching the database (for worker processes, see prefetch_hourly_gen_mix).
+    """
+    if not use_cache:
+        fetch_kwargs = dict(kwargs, facets=dict({shard_facet: list(dict.fromkeys(balancing_authorities))}, **facets))
+        url_segment = fetch_kwargs.pop("url_segment")
+        return get_eia_timeseries(url_segment, **fetch_kwargs)
+
+    start_date = kwargs["start_date"]
+    end_date = kwargs["end_date"]
+    function_name = cache_wrapped_get_eia_timeseries.__name__
+
+    def shard_kwargs(ba):
+        return dict(kwargs, facets=dict({shard_facet: [ba]}, **facets))
+
+    def shard_key_params(ba):
+        return {key: value for key, value in shard_kwargs(ba).items() if not key in ["start_date", "end_date"]}
+
+    shards = []
+    uncached_bas = []
+    for ba in dict.fromkeys(balancing_authorities):  # de-duplicated, in order
+        covering_row, touching_rows = find_cache_rows_for_range(function_name, shard_key_params(ba), start_date, end_date)
+        if covering_row is None and len(touching_rows) == 0:
+            uncached_bas.append(ba)
+            continue
+        try:
+            shards.append(cache_wrapped_get_eia_timeseries(**shard_kwargs(ba)))
+        except EIAAPIExeption:
+            print("No {} data for {}".format(kwargs.get("url_segment"), ba))
+
+    if len(uncached_bas) > 0:
+        shard_key_hashes = [canonical_cache_key(function_name, shard_key_params(ba), start_date, end_date) for ba in uncached_bas]
+
+        def lookup_shards():
+            # All of uncached_bas' shards, once someone has stored them, else None
+            cached_shards = [lookup_cached_frame(key_hash) for key_hash in shard_key_hashes]
+            return None if any(shard_df is None for shard_df in cached_shards) else cached_shards
+
+        def fetch_and_store_shards():
+            fetch_kwargs = dict(kwargs, facets=dict({shard_facet: uncached_bas}, **facets))
+            url_segment = fetch_kwargs.pop("url_segment")
+            try:
+                fetched_df = get_eia_timeseries(url_segment, **fetch_kwargs)
+            except EIAAPIExeption:
+                fetched_df = pd.DataFrame({"period": pd.Series(dtype=object), shard_facet: pd.Series(dtype=object)})
+
+            fetched_shards = []
+            for ba, key_hash in zip(uncached_bas, shard_key_hashes):
+                shard_df = categorize_eia_key_columns(fetched_df[(fetched_df[shard_facet] == ba).values].reset_index(drop=True))
+                store_cached_frame(function_name, shard_key_params(ba), start_date, end_date, shard_df, key_hash=key_hash)
+                fetched_shards.append(shard_df)
+            return fetched_shards
+
+        batch_key_params = dict(kwargs, facets=dict({shard_facet: sorted(uncached_bas)}, **facets))
+        batch_key_params = {key: value for key, value in batch_key_params.items() if not key in ["start_date", "end_date"]}
+        fetched_shards = run_single_flight(
+            canonical_cache_key(function_name, batch_key_params, start_date, end_date), lookup_shards, fetch_and_store_shards)
+        shards.extend(fetched_shards)
+
+    shards = [shard_df for shard_df in shards if len(shard_df) > 0]
+    if len(shards) == 0:
+        raise( EIAAPIExeption("no data rows"))
+    combined_df = pd.concat(shards, ignore_index=True)
+    combined_df = categorize_eia_key_columns(combined_df)
+    # Same row order as a single multi-BA query would give
+    return combined_df.sort_values("period", ascending=False, kind="stable").reset_index(drop=True)
 
 
 def get_daily_eia_grid_mix_timeseries(balancing_authorities, **kwargs):
@@ -234,9 +545,9 @@ def get_daily_eia_grid_mix_timeseries(balancing_authorities, **kwargs):
     Fetch electricity generation data by fuel type.
     balancing_authorities is an array.
     """
-    return cache_wrapped_get_eia_timeseries(
+    return get_eia_timeseries_by_ba(
+        "respondent", balancing_authorities,
         url_segment="daily-fuel-type-data",
-        facets={"respondent": balancing_authorities},
         value_column_name="Generation (MWh)",
         **kwargs,
     )
@@ -246,9 +557,9 @@ def get_hourly_eia_grid_mix(balancing_authorities, **kwargs):
     Fetch elecgtricity generation data by fuel type, but hourly.
     balancing_authorities is an array.
     """
-    return cache_wrapped_get_eia_timeseries(
+    return get_eia_timeseries_by_ba(
+        "respondent", balancing_authorities,
         url_segment="fuel-type-data",
-        facets={"respondent": balancing_authorities},
         value_column_name="Generation (MWh)",
         frequency="local-hourly",
         include_timezone=False,
@@ -261,10 +572,10 @@ def get_daily_eia_net_demand_and_generation_timeseries(balancing_authorities, **
     Fetch electricity demand data
     balancing_authorities is an array.
     """
-    return cache_wrapped_get_eia_timeseries(
+    return get_eia_timeseries_by_ba(
+        "respondent", balancing_authorities,
         url_segment="daily-region-data",
         facets={
-            "respondent": balancing_authorities,
             "type": ["D", "NG", "TI"],  # Filter out the "Demand forecast" (DF) type
         },
         value_column_name="Demand (MWh)",
@@ -276,10 +587,10 @@ def get_hourly_eia_net_demand_and_generation(balancing_authorities, **kwargs):
         Fetch electricity demand data but hourly
     balancing_authorities is an array.
     """
-    return cache_wrapped_get_eia_timeseries(
+    return get_eia_timeseries_by_ba(
+        "respondent", balancing_authorities,
         url_segment="region-data",
-        facets={"respondent": balancing_authorities,
-        "type": ["D", "NG", "TI"],
+        facets={"type": ["D", "NG", "TI"],
         },
         value_column_name="Demand (MWh)",
         frequency="local-hourly",
@@ -293,9 +604,9 @@ def get_daily_eia_interchange_timeseries(balancing_authorities, **kwargs):
     Fetch electricity interchange data (imports & exports from other utilities)
     balancing_authorities is an array.
     """
-    return cache_wrapped_get_eia_timeseries(
+    return get_eia_timeseries_by_ba(
+        "toba", balancing_authorities,
         url_segment="daily-interchange-data",
-        facets={"toba": balancing_authorities},
         value_column_name=f"Interchange to local BA (MWh)",
         **kwargs,
     )
@@ -305,10 +616,9 @@ def get_hourly_eia_interchange(balancing_authorities, **kwargs):
     Fetch electricity interchange data (imports & exports) but hourly
     balancing_authorities is an array.
     """
-    return cache_wrapped_get_eia_timeseries(
+    return get_eia_timeseries_by_ba(
+        "toba", balancing_authorities,
         url_segment="interchange-data",
-        facets={"toba": balancing_authorities,
-        },
         value_column_name=f"Interchange to local BA (MWh)",
         frequency="local-hourly",
         include_timezone=False,
@@ -321,11 +631,11 @@ def compute_supply_demand_by_hour(balancing_authority):
     # Supply and demand by hour of day:
     demand_df = get_hourly_eia_net_demand_and_generation([balancing_authority])
     demand_df["hour"] = demand_df.timestamp.apply(lambda x: x.hour)
-    demand_by_hour = demand_df[["hour", "Demand (MWh)", "type-name"]].groupby(["hour", "type-name"]).sum().reset_index()
+    demand_by_hour = demand_df[["hour", "Demand (MWh)", "type-name"]].groupby(["hour", "type-name"], observed=True).sum().reset_index()
     return demand_by_hour
 
 
-def compute_hourly_consumption_by_source_ba(balancing_authority, start_date, end_date):
+def compute_hourly_consumption_by_source_ba(balancing_authority, start_date, end_date, use_cache=True):
     """
     First, more terminology (https://www.eia.gov/electricity/gridmonitor/about)
 
@@ -360,44 +670,63 @@ def compute_hourly_consumption_by_source_ba(balancing_authority, start_date, end
     You can spot check a given day to confirm that TI = NG - D
     """
 
-    demand_df = get_hourly_eia_net_demand_and_generation([balancing_authority], start_date=start_date, end_date=end_date)
-    interchange_df = get_hourly_eia_interchange([balancing_authority], start_date=start_date, end_date=end_date)
+    demand_df = get_hourly_eia_net_demand_and_generation([balancing_authority], start_date=start_date, end_date=end_date,
+                                                         use_cache=use_cache)
+    interchange_df = get_hourly_eia_interchange([balancing_authority], start_date=start_date, end_date=end_date,
+                                                use_cache=use_cache)
 
 
-    # How much energy is both generated and consumed locally
-    def get_energy_generated_and_consumed_locally(df):
-        """
-        If local demand is smaller than net (local) generation, that means:
-            amount generated and used locally == Demand (net export)
-        If local generation is smaller than local demand, that means:
-            amount generated and used locally == Net generation (net import)
-        Therefore, the amount generated and used locally is the minimum of these two
-        """
-        demand_stats = df.groupby("type-name")["Demand (MWh)"].sum()
-        
-        try:
-            return min(demand_stats["Demand"], demand_stats["Net generation"])
-        except KeyError:
-            # Sometimes for a particular timestamp we're missing demand or net generation. Be conservative and set it to zero
-            print(f'Warning - either Demand or Net generation is missing from this timestamp. Values found for "type-name": {list(demand_stats.index)}')
-            return 0
-
-    # TODO: the above seems to be printing out an awful lot of warnings. Is this a problem?
-    # TODO maybe we drop these rows instead of printing a warning?
-    energy_generated_and_used_locally = demand_df.groupby("timestamp").apply(
-        get_energy_generated_and_consumed_locally
+    return consumption_by_source_ba_from_frames(balancing_authority, demand_df, interchange_df)
+
+
+def energy_generated_and_consumed_locally(balancing_authority, demand_df):
+    """
+    How much energy is both generated and consumed locally, for each timestamp.
+
+    If local demand is smaller than net (local) generation, that means:
+        amount generated and used locally == Demand (net export)
+    If local generation is smaller than local demand, that means:
+        amount generated and used locally == Net generation (net import)
+    Therefore, the amount generated and used locally is the minimum of these two
+
+    Sometimes for a particular timestamp we're missing demand or net generation. Be
+    conservative and set it to zero. We print one summary of these gaps, rather than a
+    warning per timestamp.
+    """
+    demand_by_type = (
+        demand_df.groupby(["timestamp", "type-name"], observed=True)["Demand (MWh)"].sum()
+        .unstack("type-name")
     )
+    demand_by_type.columns = demand_by_type.columns.astype(str)
+    demand_by_type = demand_by_type.reindex(columns=["Demand", "Net generation"])
+
+    missing = demand_by_type.isna()
+    hours_with_gaps = int(missing.any(axis=1).sum())
+    if hours_with_gaps > 0:
+        print("Warning - {} of {} timestamps for {} are missing Demand ({}) or Net generation ({}), using 0 for those".format(
+            hours_with_gaps, len(demand_by_type), balancing_authority,
+            int(missing["Demand"].sum()), int(missing["Net generation"].sum())))
+
+    return demand_by_type.min(axis=1, skipna=False).fillna(0)
+
+
+def consumption_by_source_ba_from_frames(balancing_authority, demand_df, interchange_df):
+    """
+    The calculation part of compute_hourly_consumption_by_source_ba, given the hourly
+    demand/generation and interchange data frames.
+    """
+    energy_generated_and_used_locally = energy_generated_and_consumed_locally(balancing_authority, demand_df)
 
     consumed_locally_column_name = "Power consumed locally (MWh)"
 
     # How much energy is imported and then used locally, grouped by the source BA (i.e. the BA which generated the energy)
     energy_imported_then_consumed_locally_by_source_ba = (
-        interchange_df.groupby(["timestamp", "fromba"])[
+        interchange_df.groupby(["timestamp", "fromba"], observed=True)[
             "Interchange to local BA (MWh)"
         ].sum()
         # We're only interested in data points where energy is coming *in* to the local BA, i.e. where net export is negative
         # Therefore, ignore positive net exports
-        .apply(lambda interchange: max(interchange, 0))
+        .clip(lower=0)
     )
 
     # Combine these two together to get all energy used locally, grouped by the source BA (both local and connected)
@@ -414,16 +743,29 @@ def compute_hourly_consumption_by_source_ba(balancing_authority, start_date, end
             ),
         ]
     ).reset_index()
-    energy_consumed_locally_by_source_ba['timestamp'] = pd.to_datetime( energy_consumed_locally_by_source_ba.timestamp )
+    energy_consumed_locally_by_source_ba['timestamp'] = as_local_timestamps( energy_consumed_locally_by_source_ba.timestamp ).array
     return energy_consumed_locally_by_source_ba
 
 
 
 
-def compute_hourly_fuel_mix_after_import_export(balancing_authority, energy_consumed_locally_by_source_ba, start_date, end_date):
+def compute_hourly_fuel_mix_after_import_export(balancing_authority, energy_consumed_locally_by_source_ba, start_date, end_date,
+                                                emission_factors=None):
+    """
+    compute_hourly_usage_by_source_ba_and_fuel, with emissions_per_kwh and emissions
+    worked out from the emission_factors table (default: the configured default).
+    """
+    usage_by_ba_and_type = compute_hourly_usage_by_source_ba_and_fuel(
+        balancing_authority, energy_consumed_locally_by_source_ba, start_date, end_date)
+    return apply_emission_factors(usage_by_ba_and_type, emission_factors)
+
+
+def compute_hourly_usage_by_source_ba_and_fuel(balancing_authority, energy_consumed_locally_by_source_ba, start_date, end_date,
+                                               use_cache=True):
     """
     Now that we know how much (if any) energy is imported by our local BA, and from which source BAs,
     let's get a full breakdown of the grid mix (fuel types) for that imported energy.
+    Only MWh; emissions depend on which emission factors you pick, see emission_factors.py.
     """
 
     # First, get a list of all source BAs: our local BA plus the ones we're importing from
@@ -434,14 +776,15 @@ def compute_hourly_fuel_mix_after_import_export(balancing_authority, energy_cons
     hourly_eia_grid_mix = get_hourly_eia_grid_mix(
         all_source_bas,
         start_date = start_date, # energy_consumed_locally_by_source_ba.timestamp.min(),
-        end_date = end_date) #energy_consumed_locally_by_source_ba.timestamp.max() )
+        end_date = end_date, #energy_consumed_locally_by_source_ba.timestamp.max() )
+        use_cache = use_cache)
 
     # Then, fetch the fuel type breakdowns for each of those BAs
     generation_types_by_ba = hourly_eia_grid_mix.rename(
         {"respondent": "fromba", "type-name": "generation_type"}, axis="columns"
     )
-    print(len(generation_types_by_ba))
-    generation_types_by_ba["timestamp"] = pd.to_datetime( generation_types_by_ba["timestamp"] )
+    # The timestamps are parsed already (parse_eia_period); over a daylight saving change
+    # they're Timestamps with mixed offsets, which build_fuel_mix_tensors matches in UTC
 
     """
     Okay, we've fetched all the data we need, now it's time to combine it all together!
@@ -461,61 +804,509 @@ def compute_hourly_fuel_mix_after_import_export(balancing_authority, energy_cons
        total power consumed locally from this source BA * (fuel type as a % of source BA's generation)
     fuel type as a % of source BA's generation = 
       (total generation at source BA) / (total generation for this fuel type at this BA)
+
+    We do this on dense arrays indexed by [timestamp, source BA, fuel type] (see
+    fuel_mix_tensor.py) rather than by joining long data frames.
     """
+    return usage_by_source_ba_and_fuel_from_frames(generation_types_by_ba, energy_consumed_locally_by_source_ba)
 
-    total_generation_by_source_ba = generation_types_by_ba.groupby(["timestamp", "fromba"])[
-        "Generation (MWh)"
-    ].sum()
-    generation_types_by_ba["timestamp"] = pd.to_datetime( generation_types_by_ba["timestamp"] )
-    generation_types_by_ba_with_totals = generation_types_by_ba.join(
-        total_generation_by_source_ba,
-        how="left",
-        on=["timestamp", "fromba"],
-        rsuffix=" Total",
-    )
-    generation_types_by_ba_with_totals["Generation (% of BA generation)"] = (
-        generation_types_by_ba_with_totals["Generation (MWh)"]
-        / generation_types_by_ba_with_totals["Generation (MWh) Total"]
-    )
-    generation_types_by_ba_with_totals["timestamp"] = pd.to_datetime( generation_types_by_ba_with_totals.timestamp)
-    energy_consumed_locally_by_source_ba["timestamp"] = pd.to_datetime( energy_consumed_locally_by_source_ba["timestamp"] )
-    generation_types_by_ba_with_totals_and_source_ba_breakdown = generation_types_by_ba_with_totals.merge(
-        energy_consumed_locally_by_source_ba.rename(
-            {"Power consumed locally (MWh)": "Power consumed locally from source BA (MWh)"},
-            axis="columns",
-        ),
-        on=["timestamp", "fromba"],
-    )
-    full_df_reindexed = (
-        generation_types_by_ba_with_totals_and_source_ba_breakdown.set_index(
-            ["timestamp", "fromba", "generation_type"]
-        )
-    )
-    usage_by_ba_and_generation_type = (
-        (
-            full_df_reindexed["Power consumed locally from source BA (MWh)"]
-            * full_df_reindexed["Generation (% of BA generation)"]
-        )
-        .rename("Usage (MWh)")
-        .reset_index()
-    )
 
-    usage_by_ba_and_generation_type["emissions_per_kwh"] = usage_by_ba_and_generation_type["generation_type"].apply(lambda x: EMISSIONS_BY_FUEL[x])
-    usage_by_ba_and_generation_type["emissions"] = usage_by_ba_and_generation_type["emissions_per_kwh"] * usage_by_ba_and_generation_type["Usage (MWh)"] * 1000
+def usage_by_source_ba_and_fuel_from_frames(generation_types_by_ba, energy_consumed_locally_by_source_ba):
+    tensors = build_fuel_mix_tensors(generation_types_by_ba, energy_consumed_locally_by_source_ba)
+    usage = usage_by_fuel(tensors)
+    return fuel_mix_frame(tensors, usage)
 
-    return usage_by_ba_and_generation_type
+
+def fuel_mix_after_import_export_from_frames(generation_types_by_ba, energy_consumed_locally_by_source_ba, emission_factors=None):
+    return apply_emission_factors(
+        usage_by_source_ba_and_fuel_from_frames(generation_types_by_ba, energy_consumed_locally_by_source_ba),
+        emission_factors)
 
 
 
 @cache_csv
 def cache_wrapped_hourly_gen_mix_by_ba_and_type(ba_name=None, start_date=None, end_date=None):
+    # MWh only, so the cache doesn't have to be cleared when emission factors change
     consumption_by_ba = compute_hourly_consumption_by_source_ba(ba_name, start_date, end_date)
-    usage_by_ba_and_type = compute_hourly_fuel_mix_after_import_export(ba_name, consumption_by_ba, start_date, end_date)
+    usage_by_ba_and_type = compute_hourly_usage_by_source_ba_and_fuel(ba_name, consumption_by_ba, start_date, end_date)
     return usage_by_ba_and_type
 
 
+def hourly_co2_intensity_from_usage(usage_df, emission_factors=None):
+    # Group df by hour, not caring about source BA or fuel, sum up emissions and divide by
+    # kwh to get pounds of co2 per kwh for each hour
+    usage_df = apply_emission_factors(usage_df, emission_factors)
+    intensity_by_hour = usage_df[["Usage (MWh)", "emissions", "timestamp"]].groupby(
+        ["timestamp"]).aggregate("sum").reset_index()
+
+    intensity_by_hour["pounds_co2_per_kwh"] = intensity_by_hour["emissions"] / (intensity_by_hour["Usage (MWh)"]*1000)
+    return intensity_by_hour
+
+
+HOURLY_CO2_INTENSITY_TABLE = "hourly_co2_intensity"
+
+
+def materialize_hourly_co2_intensity(ba_name, start_date, end_date, emission_factors):
+    """
+    Compute the hourly intensity of ba_name for start_date..end_date from the usage
+    pipeline, with the named emission factor table, and upsert it into the
+    HourlyCO2Intensity table. The usage itself is cached, so materializing the same days
+    with another table doesn't recompute it.
+    """
+    intensity_by_hour = hourly_co2_intensity_from_usage(cache_wrapped_hourly_gen_mix_by_ba_and_type(
+        ba_name=ba_name,
+        start_date=start_date,
+        end_date=end_date), emission_factors)
+
+    rows = []
+    for timestamp, usage_mwh, emissions, intensity in zip(
+            intensity_by_hour["timestamp"], intensity_by_hour["Usage (MWh)"],
+            intensity_by_hour["emissions"], intensity_by_hour["pounds_co2_per_kwh"]):
+        rows.append(HourlyCO2Intensity(
+            ba=ba_name,
+            emission_factors=emission_factors,
+            timestamp=timestamp.to_pydatetime(),
+            utc_offset_minutes=int(timestamp.utcoffset().total_seconds() // 60),
+            local_date=timestamp.date(),
+            usage_mwh=usage_mwh,
+            emissions=emissions,
+            pounds_co2_per_kwh=None if np.isnan(intensity) else intensity,
+        ))
+
+    covered_start, covered_end = covered_days(
+        [row.local_date for row in rows], [row.timestamp.hour for row in rows], as_date(start_date), as_date(end_date))
+
+    with transaction.atomic():
+        HourlyCO2Intensity.objects.bulk_create(
+            rows,
+            batch_size=2000,
+            update_conflicts=True,
+            unique_fields=["ba", "emission_factors", "timestamp"],
+            update_fields=["utc_offset_minutes", "local_date", "usage_mwh", "emissions", "pounds_co2_per_kwh"],
+        )
+        # Days missing their first or last hours (not published yet, or cut off) aren't
+        # marked, so they're fetched again next time rather than staying incomplete
+        if covered_start is not None:
+            MaterializedDateRange.objects.create(
+                table_name=HOURLY_CO2_INTENSITY_TABLE,
+                ba=ba_name,
+                emission_factors=emission_factors,
+                start_date=covered_start,
+                end_date=covered_end,
+                materialized_date=timezone.now())
+        update_co2_intensity_rollups(ba_name, as_date(start_date), as_date(end_date), emission_factors)
+
+
+def covered_days(local_dates, local_hours, start_day, end_day):
+    """
+    The (first, last) days of start_day..end_day that the hourly rows with these local
+    dates and clock hours actually cover: from the first day that has its midnight hour to
+    the last day that has its 11pm hour. Days in between are counted even if they have
+    gaps, since EIA data does have holes. (None, None) if there's no such span.
+    """
+    local_dates = pd.Series(local_dates, dtype=object)
+    local_hours = pd.Series(local_hours, dtype=np.int64)
+    days_with_first_hour = local_dates[(local_hours == 0).values]
+    days_with_last_hour = local_dates[(local_hours == 23).values]
+    if len(days_with_first_hour) == 0 or len(days_with_last_hour) == 0:
+        return None, None
+    covered_start = max(start_day, min(days_with_first_hour))
+    covered_end = min(end_day, max(days_with_last_hour))
+    if covered_start > covered_end:
+        return None, None
+    return covered_start, covered_end
+
+
+def local_timestamps(utc_timestamps, utc_offset_minutes):
+    """
+    Turn UTC timestamps back into the local times they were reported in. Like
+    parse_eia_period, a single offset gives a datetime64 column with that fixed offset,
+    several (a daylight saving change) give an object column of Timestamps.
+    """
+    utc_timestamps = pd.DatetimeIndex(pd.to_datetime(utc_timestamps, utc=True))
+    utc_offset_minutes = np.asarray(utc_offset_minutes)
+    distinct_offsets = np.unique(utc_offset_minutes)
+    if len(distinct_offsets) <= 1:
+        offset = int(distinct_offsets[0]) if len(distinct_offsets) else 0
+        return pd.Series(utc_timestamps.tz_convert(datetime.timezone(datetime.timedelta(minutes=offset))))
+
+    timestamps = np.empty(len(utc_timestamps), dtype=object)
+    for offset in distinct_offsets:
+        rows_with_offset = utc_offset_minutes == offset
+        timestamps[rows_with_offset] = utc_timestamps[rows_with_offset].tz_convert(
+            datetime.timezone(datetime.timedelta(minutes=int(offset)))).astype(object)
+    return pd.Series(timestamps)
+
+
+def as_local_timestamps(values):
+    """
+    values (Timestamps, or the strings old CSV cache rows give back) as a timestamp column
+    that keeps every row's UTC offset, like parse_eia_period. A plain pd.to_datetime can't
+    do that for a range across a daylight saving change: it refuses mixed offsets unless
+    they're all converted to UTC.
+    """
+    values = pd.Series(values, copy=False)
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return values
+    codes, unique_values = pd.factorize(values)
+    unique_timestamps = [pd.Timestamp(value) for value in unique_values]
+    if any(timestamp.tzinfo is None for timestamp in unique_timestamps):
+        return pd.to_datetime(values)
+    utc_offset_minutes = np.array(
+        [int(timestamp.utcoffset().total_seconds() // 60) for timestamp in unique_timestamps], dtype=np.int64)
+    local = local_timestamps(pd.to_datetime(unique_timestamps, utc=True)[codes], utc_offset_minutes[codes])
+    local.index = values.index
+    return local
+
+
+def missing_hourly_co2_intensity_ranges(ba_name, start_day, end_day, emission_factors):
+    # (start, end) datetimes of the runs of days from start_day to end_day that aren't in
+    # the HourlyCO2Intensity table yet, as materialize_hourly_co2_intensity takes them
+    covered_ranges = MaterializedDateRange.objects.filter(
+        table_name=HOURLY_CO2_INTENSITY_TABLE, ba=ba_name, emission_factors=emission_factors,
+        start_date__lte=end_day, end_date__gte=start_day).values_list("start_date", "end_date")
+    return [(datetime.datetime.combine(gap_start, datetime.time()), datetime.datetime.combine(gap_end, datetime.time()))
+            for gap_start, gap_end in missing_date_ranges(start_day, end_day, list(covered_ranges))]
+
+
+def ensure_hourly_co2_intensity(ba_name, start_day, end_day, emission_factors):
+    """
+    Compute and add to the HourlyCO2Intensity table the days from start_day to end_day
+    that aren't there yet. Returns the EIAAPIExeption of a range we couldn't get data
+    for, if any, so callers can raise it if they end up with nothing.
+    """
+    fetch_error = None
+    for gap_start, gap_end in missing_hourly_co2_intensity_ranges(ba_name, start_day, end_day, emission_factors):
+        try:
+            materialize_hourly_co2_intensity(ba_name, gap_start, gap_end, emission_factors)
+        except EIAAPIExeption as e:
+            print("Couldn't get EIA data for {} from {} to {}".format(ba_name, gap_start.date(), gap_end.date()))
+            fetch_error = e
+    return fetch_error
+
+
+def hourly_gen_mix_from_eia(ba_name, date_ranges_by_ba):
+    """
+    cache_wrapped_hourly_gen_mix_by_ba_and_type's frame for each (start, end) of
+    date_ranges_by_ba[ba_name], or None where EIA has no data. Fetched straight from the
+    EIA API and computed without touching the database, so it can run in a worker process
+    (see prefetch_hourly_gen_mix).
+    """
+    frames = []
+    for start_date, end_date in date_ranges_by_ba[ba_name]:
+        try:
+            consumption_by_ba = compute_hourly_consumption_by_source_ba(ba_name, start_date, end_date, use_cache=False)
+            frames.append(compute_hourly_usage_by_source_ba_and_fuel(ba_name, consumption_by_ba, start_date, end_date,
+                                                                     use_cache=False))
+        except EIAAPIExeption:
+            frames.append(None)
+    return frames
+
+
+def prefetch_hourly_gen_mix(ba_names, start_date, end_date, emission_factors=None, max_workers=None):
+    """
+    Get the hourly usage that the HourlyCO2Intensity table is missing, for all of ba_names
+    from start_date to end_date, ready in the cache. The EIA fetches and the usage
+    calculation run in worker processes (see parallel.py), the database reads and writes
+    all happen here. Computing those BAs' intensity one after another afterwards then
+    only does the (much quicker) database work.
+    """
+    emission_factors = emission_factors or default_emission_factors()
+    date_ranges_by_ba = {
+        ba_name: missing_hourly_co2_intensity_ranges(ba_name, as_date(start_date), as_date(end_date), emission_factors)
+        for ba_name in ba_names}
+    # Leave out what's cached already, e.g. computed for another emission factor table
+    for ba_name, date_ranges in date_ranges_by_ba.items():
+        date_ranges_by_ba[ba_name] = [
+            (gap_start, gap_end) for gap_start, gap_end in date_ranges
+            if cache_wrapped_hourly_gen_mix_by_ba_and_type.lookup(ba_name=ba_name, start_date=gap_start, end_date=gap_end) is None]
+    ba_names = [ba_name for ba_name in ba_names if len(date_ranges_by_ba[ba_name]) > 0]
+
+    per_ba_frames = run_per_ba(hourly_gen_mix_from_eia, ba_names, max_workers=max_workers,
+                               date_ranges_by_ba=date_ranges_by_ba)
+    for ba_name, frames in per_ba_frames:
+        for (gap_start, gap_end), usage_df in zip(date_ranges_by_ba[ba_name], frames):
+            if usage_df is not None:
+                cache_wrapped_hourly_gen_mix_by_ba_and_type.store(usage_df, ba_name=ba_name, start_date=gap_start, end_date=gap_end)
+
+
+def hourly_co2_intensity_rows(ba_name, start_day, end_day, emission_factors):
+    # The HourlyCO2Intensity rows of ba_name for local dates start_day..end_day, as a frame
+    rows = list(HourlyCO2Intensity.objects.filter(
+        ba=ba_name, emission_factors=emission_factors, local_date__gte=start_day, local_date__lte=end_day).order_by("timestamp").values_list(
+        "timestamp", "utc_offset_minutes", "local_date", "usage_mwh", "emissions", "pounds_co2_per_kwh"))
+    columns = ["timestamp", "utc_offset_minutes", "local_date", "usage_mwh", "emissions", "pounds_co2_per_kwh"]
+    rows_df = pd.DataFrame.from_records(rows, columns=columns)
+    rows_df["pounds_co2_per_kwh"] = rows_df["pounds_co2_per_kwh"].astype(np.float64)
+    return rows_df
+
+
+def get_hourly_co2_intensity(ba_name, start_date=None, end_date=None, emission_factors=None):
+    """
+    Hourly intensity of ba_name from start_date to end_date (local dates, inclusive), as a
+    frame of timestamp, "Usage (MWh)", emissions and pounds_co2_per_kwh sorted by time.
+    Same as hourly_co2_intensity_from_usage(cache_wrapped_hourly_gen_mix_by_ba_and_type(...)),
+    but read from the HourlyCO2Intensity table. Days that aren't in the table yet are
+    computed and added first. emission_factors names the emission factor table (default:
+    the configured default).
+    """
+    emission_factors = emission_factors or default_emission_factors()
+    start_day = as_date(start_date)
+    end_day = as_date(end_date)
+
+    fetch_error = ensure_hourly_co2_intensity(ba_name, start_day, end_day, emission_factors)
+    rows_df = hourly_co2_intensity_rows(ba_name, start_day, end_day, emission_factors)
+    if len(rows_df) == 0 and fetch_error is not None:
+        raise fetch_error
+
+    return pd.DataFrame({
+        "timestamp": local_timestamps(rows_df["timestamp"], rows_df["utc_offset_minutes"]),
+        "Usage (MWh)": rows_df["usage_mwh"].to_numpy(dtype=np.float64),
+        "emissions": rows_df["emissions"].to_numpy(dtype=np.float64),
+        "pounds_co2_per_kwh": rows_df["pounds_co2_per_kwh"].to_numpy(dtype=np.float64),
+    })
+
+
+CO2_INTENSITY_ROLLUP = "co2_intensity"
+GENERATION_ROLLUP = "generation"
+
+
+def store_rollup_cells(series, ba_name, cells, emission_factors=""):
+    RollupCell.objects.bulk_create(
+        [
+            RollupCell(
+                series=series,
+                ba=ba_name,
+                fuel=cell.get("fuel", ""),
+                emission_factors=emission_factors,
+                period=cell["period"],
+                period_start=cell["period_start"],
+                hour_of_day=cell["hour_of_day"],
+                hours=cell["hours"],
+                value_sum=cell["value_sum"],
+                value_min=None if np.isnan(cell["value_min"]) else cell["value_min"],
+                value_max=None if np.isnan(cell["value_max"]) else cell["value_max"],
+                usage_mwh=cell["usage_mwh"],
+                emissions=cell["emissions"],
+                sketch=None if cell["sketch"] is None else sketch_to_bytes(cell["sketch"]),
+            )
+            for cell in cells.to_dict("records")
+        ],
+        batch_size=2000,
+        update_conflicts=True,
+        unique_fields=["series", "ba", "fuel", "emission_factors", "period", "period_start", "hour_of_day"],
+        update_fields=["hours", "value_sum", "value_min", "value_max", "usage_mwh", "emissions", "sketch"],
+    )
+
+
+def load_rollup_cells(series, ba_name, emission_factors="", **filters):
+    columns = ["period", "period_start", "hour_of_day", "fuel"] + CELL_COLUMNS
+    cells = pd.DataFrame.from_records(
+        list(RollupCell.objects.filter(series=series, ba=ba_name, emission_factors=emission_factors, **filters).values_list(*columns)), columns=columns)
+    cells["sketch"] = [None if sketch is None else sketch_from_bytes(sketch) for sketch in cells["sketch"]]
+    # Typed even when there are no cells, so merging with other cells keeps numeric columns
+    cells = cells.astype({"hour_of_day": np.int64, "hours": np.int64, "value_sum": np.float64, "value_min": np.float64,
+                          "value_max": np.float64, "usage_mwh": np.float64, "emissions": np.float64})
+    return cells
+
+
+def co2_intensity_hourly_frame(rows_df):
+    # HourlyCO2Intensity rows -> the hourly frame rollups.rollup_cells takes
+    local_times = pd.to_datetime(rows_df["timestamp"], utc=True).dt.tz_localize(None) \
+        + pd.to_timedelta(rows_df["utc_offset_minutes"], unit="m")
+    return pd.DataFrame({
+        "local_date": rows_df["local_date"],
+        "hour": local_times.dt.hour,
+        "value": rows_df["pounds_co2_per_kwh"],
+        "usage_mwh": rows_df["usage_mwh"],
+        "emissions": rows_df["emissions"],
+    })
+
+
+def update_co2_intensity_rollups(ba_name, start_day, end_day, emission_factors):
+    # Recompute the rollup cells of every month touching start_day..end_day from the
+    # HourlyCO2Intensity table
+    month_start = start_day.replace(day=1)
+    month_end = (pd.Timestamp(end_day) + pd.offsets.MonthEnd(0)).date()
+    rows_df = hourly_co2_intensity_rows(ba_name, month_start, month_end, emission_factors)
+    if len(rows_df) > 0:
+        store_rollup_cells(CO2_INTENSITY_ROLLUP, ba_name, rollup_cells(co2_intensity_hourly_frame(rows_df)), emission_factors)
+
+
+def rollup_co2_intensity_cells(ba_name, start_date, end_date, kind, emission_factors):
+    """
+    Cells covering start_date..end_date exactly, of one of three kinds:
+     - "clock_hour": a cell per clock hour; the stored month cells of the whole months in
+       the range, plus cells computed from the hourly table for the days at either end
+     - "day": the stored day cells
+     - "range": the stored all-hours month cells of the whole months, plus the stored
+       day cells of the days at either end, to be merged into one
+    """
+    start_day = as_date(start_date)
+    end_day = as_date(end_date)
+    fetch_error = ensure_hourly_co2_intensity(ba_name, start_day, end_day, emission_factors)
+
+    whole_months, edge_ranges = split_into_months(start_day, end_day)
+    cells = []
+    if kind == "clock_hour":
+        cells.append(load_rollup_cells(CO2_INTENSITY_ROLLUP, ba_name, emission_factors, period="month", period_start__in=whole_months, hour_of_day__gte=0))
+        for edge_start, edge_end in edge_ranges:
+            rows_df = hourly_co2_intensity_rows(ba_name, edge_start, edge_end, emission_factors)
+            if len(rows_df) > 0:
+                edge_cells = rollup_cells(co2_intensity_hourly_frame(rows_df))
+                cells.append(edge_cells[(edge_cells["period"] == "month") & (edge_cells["hour_of_day"] >= 0)])
+    elif kind == "day":
+        cells.append(load_rollup_cells(CO2_INTENSITY_ROLLUP, ba_name, emission_factors, period="day", period_start__gte=start_day, period_start__lte=end_day))
+    else:
+        cells.append(load_rollup_cells(CO2_INTENSITY_ROLLUP, ba_name, emission_factors, period="month", period_start__in=whole_months, hour_of_day=ALL_HOURS))
+        for edge_start, edge_end in edge_ranges:
+            cells.append(load_rollup_cells(CO2_INTENSITY_ROLLUP, ba_name, emission_factors, period="day", period_start__gte=edge_start, period_start__lte=edge_end))
+    cells = pd.concat(cells, ignore_index=True)
+    if len(cells) == 0 and fetch_error is not None:
+        raise fetch_error
+    return cells
+
+
+def rollup_co2_intensity_by_clock_hour(ba_name, start_date=None, end_date=None, emission_factors=None):
+    """
+    pounds_co2_per_kwh for each clock hour (avg of all 1-ams, avg of all 2-ams, etc.) from
+    start_date to end_date, from the rollup cells. Both ways of averaging are given:
+    hours_weighted_mean treats all hours equally, kwh_weighted_mean treats all kWh equally
+    (big kwh days matter more). Also value_min, value_max and 25%/50%/75% quantiles.
+    """
+    cells = rollup_co2_intensity_cells(ba_name, start_date, end_date, kind="clock_hour",
+                                       emission_factors=emission_factors or default_emission_factors())
+    return merge_cells(cells, by=["hour_of_day"]).rename(columns={"hour_of_day": "hour"})
+
+
+def rollup_co2_intensity_totals(ba_name, start_date=None, end_date=None, period="day", emission_factors=None):
+    """
+    Daily (period="day") or monthly ("month") totals of usage and emissions, with the
+    same statistics as rollup_co2_intensity_by_clock_hour, for start_date..end_date.
+    """
+    cells = rollup_co2_intensity_cells(ba_name, start_date, end_date, kind="day",
+                                       emission_factors=emission_factors or default_emission_factors())
+    if period == "month":
+        cells["period_start"] = [day.replace(day=1) for day in cells["period_start"]]
+    return merge_cells(cells, by=["period_start"])
+
+
+def rollup_co2_intensity_statistics(ba_name, start_date=None, end_date=None, emission_factors=None):
+    """
+    Like get_hourly_co2_intensity(...)["pounds_co2_per_kwh"].describe() (less std), but
+    from merged month and day sketches, so the cost doesn't grow with the number of hours.
+    Quantiles are approximate, see quantile_sketch.py for the error bounds.
+    """
+    cells = rollup_co2_intensity_cells(ba_name, start_date, end_date, kind="range",
+                                       emission_factors=emission_factors or default_emission_factors())
+    if len(cells) == 0:
+        return pd.Series({"count": 0, "mean": np.nan, "min": np.nan, "25%": np.nan, "50%": np.nan, "75%": np.nan, "max": np.nan})
+    cells["range"] = 0
+    merged = merge_cells(cells, by=["range"]).iloc[0]
+    return pd.Series({
+        "count": merged["hours"],
+        "mean": merged["hours_weighted_mean"],
+        "min": merged["value_min"],
+        "25%": merged["25%"],
+        "50%": merged["50%"],
+        "75%": merged["75%"],
+        "max": merged["value_max"],
+    })
+
+
+def generation_hourly_frame(hourly_generation):
+    # get_hourly_eia_grid_mix rows -> the hourly frame rollups.rollup_cells takes. The
+    # period is in local time, so the clock hour is just characters 11-12 of it.
+    period = hourly_generation["period"].astype(str)
+    return pd.DataFrame({
+        "local_date": period.str[:10],
+        "hour": period.str[11:13].astype(int),
+        "fuel": hourly_generation["type-name"].astype(str),
+        "value": hourly_generation["Generation (MWh)"],
+    })
+
+
+def rollup_generation_by_clock_hour(ba_name, start_date=None, end_date=None):
+    """
+    Total generation (MWh) of ba_name by clock hour and fuel type from start_date to
+    end_date, as a frame of hour, fuel and mwh. Whole months are rolled up once and
+    stored, as soon as their data is complete; the days at either end are rolled up from
+    the (cached) EIA data each time.
+    """
+    start_day = as_date(start_date)
+    end_day = as_date(end_date)
+    whole_months, edge_ranges = split_into_months(start_day, end_day)
+
+    rolled_up_months = set(MaterializedDateRange.objects.filter(
+        table_name=GENERATION_ROLLUP, ba=ba_name, start_date__in=whole_months).values_list("start_date", flat=True))
+    cells = []
+    incomplete_months = set()
+    for month_start in whole_months:
+        if month_start in rolled_up_months:
+            continue
+        month_end = (pd.Timestamp(month_start) + pd.offsets.MonthEnd(0)).date()
+        hourly_generation = get_hourly_eia_grid_mix(
+            [ba_name],
+            start_date=datetime.datetime.combine(month_start, datetime.time()),
+            end_date=datetime.datetime.combine(month_end, datetime.time()))
+        hourly_frame = generation_hourly_frame(hourly_generation)
+        month_cells = rollup_cells(hourly_frame, extra_keys=["fuel"], sketches=False)
+        covered_start, covered_end = covered_days(
+            [datetime.date.fromisoformat(day) for day in hourly_frame["local_date"]], hourly_frame["hour"], month_start, month_end)
+        if (covered_start, covered_end) != (month_start, month_end):
+            # Not all there yet (e.g. the current month): use it this time, roll it up later
+            cells.append(month_cells[(month_cells["period"] == "month") & (month_cells["hour_of_day"] >= 0)])
+            incomplete_months.add(month_start)
+            continue
+        with transaction.atomic():
+            store_rollup_cells(GENERATION_ROLLUP, ba_name, month_cells)
+            MaterializedDateRange.objects.create(
+                table_name=GENERATION_ROLLUP, ba=ba_name, start_date=covered_start, end_date=covered_end,
+                materialized_date=timezone.now())
+
+    stored_months = [month_start for month_start in whole_months if not month_start in incomplete_months]
+    cells.append(load_rollup_cells(GENERATION_ROLLUP, ba_name, period="month", period_start__in=stored_months, hour_of_day__gte=0))
+    for edge_start, edge_end in edge_ranges:
+        hourly_generation = get_hourly_eia_grid_mix(
+            [ba_name],
+            start_date=datetime.datetime.combine(edge_start, datetime.time()),
+            end_date=datetime.datetime.combine(edge_end, datetime.time()))
+        edge_cells = rollup_cells(generation_hourly_frame(hourly_generation), extra_keys=["fuel"], sketches=False)
+        cells.append(edge_cells[(edge_cells["period"] == "month") & (edge_cells["hour_of_day"] >= 0)])
+
+    merged = merge_cells(pd.concat(cells, ignore_index=True), by=["hour_of_day", "fuel"])
+    return pd.DataFrame({"hour": merged["hour_of_day"], "fuel": merged["fuel"], "mwh": merged["value_sum"]})
+
+
+def all_balancing_authorities():
+    # The BA codes in parentheses in list_of_all_bas.txt
+    with open(os.path.join(os.path.dirname(__file__), "list_of_all_bas.txt"), "r") as ba_file:
+        return re.findall(r'\((\w+)\)', ba_file.read())
+
+
+@cache_csv
+def cache_wrapped_grid_fuel_usage(start_date=None, end_date=None):
+    """
+    Hourly consumption of every BA by fuel type, traced through the whole interchange
+    network at once (see grid_flow_tracing.py), so imports that pass through several BAs
+    get the right mix. Timestamps are UTC.
+    Uses the same per-BA cached EIA data as the per-BA calculation.
+    """
+    ba_names = all_balancing_authorities()
+    generation_df = get_hourly_eia_grid_mix(ba_names, start_date=start_date, end_date=end_date)
+    interchange_df = get_hourly_eia_interchange(ba_names, start_date=start_date, end_date=end_date)
+    return grid_fuel_usage(generation_df, interchange_df)
+
+
+def get_grid_co2_intensity(start_date=None, end_date=None, emission_factors=None):
+    # Hourly consumption-based CO2 intensity of every BA, from the cached fuel usage
+    fuel_usage = cache_wrapped_grid_fuel_usage(start_date=start_date, end_date=end_date)
+    fuels = fuel_columns(fuel_usage)
+    return grid_co2_intensity_from_fuel_usage(fuel_usage, dict(zip(fuels, emission_factors_for(fuels, emission_factors))))
+
+
 @cache_csv
-def cache_wrapped_co2_boxplot_all_bas(ba_names = [], start_date=None, end_date=None):
+def cache_wrapped_co2_boxplot_all_bas(ba_names = [], start_date=None, end_date=None, grid_wide=False, emission_factors=None):
     # A good way to visualize this might be: bar chart with floating bars, bottom end of each bar
     # is minimum co2 intensity, top end of each bar is maximum co2 intensity, show for each BA
     # one year ago and each BA today.
@@ -527,27 +1318,37 @@ def cache_wrapped_co2_boxplot_all_bas(ba_names = [], start_date=None, end_date=N
     ba_stats = { "min": [], "max": [], "25%": [], "50%": [], "75%": []}
     good_ba_names = []
     
-    # loop through for each ba, get min and max pounds_co2_per_kwh
-    for ba_name in ba_names:
-        if ba_name in ['NSB', 'OVEC', 'EEI', 'GLHB', 'AEC', 'GRIF', ]:
-            # these return 0 rows for whatever reason
-            continue
-        try:
-            usage_df = cache_wrapped_hourly_gen_mix_by_ba_and_type(
-                ba_name=ba_name,
-                start_date=start_date,
-                end_date=end_date)
-        except EIAAPIExeption as e:
-            print("Couldn't get EIA data for {}".format(ba_name))
-            continue
-
-        # TODO: next two lines are copied from co2_intensity_json - factor these out!
-        intensity_by_hour = usage_df[["Usage (MWh)", "emissions", "timestamp"]].groupby(
-            ["timestamp"]).aggregate("sum").reset_index()
-
-        intensity_by_hour["pounds_co2_per_kwh"] = intensity_by_hour["emissions"] / (intensity_by_hour["Usage (MWh)"]*1000)
+    if grid_wide:
+        # One flow tracing solve gives every BA's intensity
+        grid_intensity = get_grid_co2_intensity(start_date=start_date, end_date=end_date, emission_factors=emission_factors)
+        grid_intensity = grid_intensity[grid_intensity["Throughput (MWh)"] > 0]
+        intensity_by_ba = dict(list(grid_intensity.groupby("ba", observed=True)["pounds_co2_per_kwh"]))
+        for ba_name in ba_names:
+            if not ba_name in intensity_by_ba:
+                print("Couldn't get EIA data for {}".format(ba_name))
+                continue
+            statistics = intensity_by_ba[ba_name].describe()
+            for key in ba_stats.keys():
+                ba_stats[key].append(statistics[key])
+            good_ba_names.append(ba_name)
+        ba_stats["ba_names"] = good_ba_names
+        return pd.DataFrame(data=ba_stats)
+
+    # these return 0 rows for whatever reason
+    ba_names = [ba_name for ba_name in ba_names if not ba_name in ['NSB', 'OVEC', 'EEI', 'GLHB', 'AEC', 'GRIF', ]]
+
+    # Each BA's EIA data is fetched and computed in a worker process, then the database
+    # work runs here, one BA after another (SQLite only takes one writer at a time)
+    prefetch_hourly_gen_mix(ba_names, start_date, end_date, emission_factors)
+    per_ba_statistics = run_per_ba(
+        co2_intensity_statistics_for_ba, ba_names,
+        max_workers=1,
+        skip_exceptions=(EIAAPIExeption,),
+        start_date=start_date,
+        end_date=end_date,
+        emission_factors=emission_factors)
 
-        statistics = intensity_by_hour["pounds_co2_per_kwh"].describe()
+    for ba_name, statistics in per_ba_statistics:
         for key in ba_stats.keys():
             ba_stats[key].append(statistics[key])
         good_ba_names.append(ba_name)
@@ -556,6 +1357,12 @@ def cache_wrapped_co2_boxplot_all_bas(ba_names = [], start_date=None, end_date=N
     return pd.DataFrame(data=ba_stats)
 
 
+def co2_intensity_statistics_for_ba(ba_name, start_date=None, end_date=None, emission_factors=None):
+    # Summary statistics of one BA's hourly pounds_co2_per_kwh, for the boxplot, merged
+    # from the rollup sketches
+    return rollup_co2_intensity_statistics(ba_name, start_date=start_date, end_date=end_date, emission_factors=emission_factors)
+
+
 def cache_and_write_to_files():
     # Used to save caches to files for use in unit tests
     start_date = datetime.datetime(year=2024, month=4, day=1)
@@ -566,17 +1373,18 @@ def cache_and_write_to_files():
     usage_by_ba_and_type = compute_hourly_fuel_mix_after_import_export("CISO", consumption_by_ba, start_date, end_date)
     #usage_by_ba_and_type.head()
 
-    for cache_object in EIAHourlyDataCache.objects.all():
-        facets = json.loads(cache_object.facets)
+    for cache_object in AllPurposeCSVCache.objects.filter(cache_function_name=cache_wrapped_get_eia_timeseries.__name__):
+        key_params = json.loads(cache_object.key_params_json)
+        facets = key_params["facets"]
         if "respondent" in facets:
             num_respondents = len(facets["respondent"])
         else:
             num_respondents = 0
         filename = "{}_{}_respondents.csv".format(
-            cache_object.url_segment, num_respondents)
+            key_params["url_segment"], num_respondents)
 
         with open(filename, "w") as outfile:
-            outfile.write(cache_object.response_csv)
+            read_cache_row(cache_object).to_csv(outfile)
 
 @cache_csv
 def get_historical_solar_weather(start_date = None, end_date = None, latitude=0, longitude=0):
@@ -595,16 +1403,45 @@ def get_historical_solar_weather(start_date = None, end_date = None, latitude=0,
 
     simulation_year = end_date.year # !
 
-    solar_weather_timeseries, solar_weather_metadata = pvlib.iotools.get_psm3(
+    solar_weather_timeseries, solar_weather_metadata = get_psm3(
         latitude=latitude,
         longitude=longitude,
-        names=simulation_year,
+        year=simulation_year,
         api_key=NREL_API_KEY,
         email=NREL_API_EMAIL,
-        map_variables=True,
-        leap_day=True,
     )
     return solar_weather_timeseries
+
+
+def get_psm3(latitude, longitude, year, api_key, email):
+    """
+    Same as pvlib.iotools.get_psm3(names=year, map_variables=True, leap_day=True), but the
+    download goes through our pooled, retrying HTTP client instead of a one-off
+    requests.get. Returns (data, metadata) like pvlib does.
+    """
+    params = {
+        "api_key": api_key,
+        "full_name": psm3.PVLIB_PYTHON,
+        "email": email,
+        "affiliation": psm3.PVLIB_PYTHON,
+        "reason": psm3.PVLIB_PYTHON,
+        "mailing_list": "false",
+        # WKT wants longitude first, with exactly one space between the coordinates
+        "wkt": "POINT({} {})".format(("%9.4f" % longitude).strip(), ("%8.4f" % latitude).strip()),
+        "names": str(year),
+        "attributes": ",".join(psm3.REQUEST_VARIABLE_MAP.get(a, a) for a in psm3.ATTRIBUTES),
+        "leap_day": "true",
+        "utc": "false",
+        "interval": 60,
+    }
+    NREL_PSM3_URL = os.getenv("NREL_PSM3_URL")
+    if NREL_PSM3_URL is None:
+        NREL_PSM3_URL = getattr(settings, "NREL_PSM3_URL", None) or psm3.PSM_URL
+    response = http_client.get("nrel", NREL_PSM3_URL, params=params)
+    if not response.ok:
+        raise requests.HTTPError("NREL PSM3 gave status code {}: {}".format(
+            response.status_code, response.text[:500]), response=response)
+    return psm3.parse_psm3(StringIO(response.content.decode("utf-8")), map_variables=True)
             
 
 @cache_csv
@@ -614,7 +1451,8 @@ def get_historical_window_irradiance(start_date = None, end_date = None, latitud
         start_date = start_date, end_date = end_date, latitude=latitude, longitude=longitude
     )
     if "Unnamed: 0" in solar_weather_timeseries.columns:
-        # Fix incorrect index (result of cacheing)
+        # Fix incorrect index (result of cacheing, only happens for cache rows written
+        # in the old CSV format)
         solar_weather_timeseries.rename(columns = {"Unnamed: 0": "timestamp"}, inplace=True)
         solar_weather_timeseries.set_index("timestamp", inplace=True)
         solar_weather_timeseries.index = pd.to_datetime(solar_weather_timeseries.index)
@@ -643,12 +1481,6 @@ def get_historical_window_irradiance(start_date = None, end_date = None, latitud
     return window_irradiance
 
 
-# Also define a few permanent constants
-JOULES_PER_KWH = 3.6e+6
-JOULES_PER_MEGAJOULE = 1e6
-SECONDS_PER_HOUR = 3600
-AIR_VOLUMETRIC_HEAT_CAPACITY = 1200 # Energy in joules per cubic meter of air per degree K. (J/m3/K)
-
 # To keep things tidier, we define a HomeCharacteristics dataclass to bunch all the defined and calculated attributes together
 @dataclass
 class HomeCharacteristics:
@@ -666,6 +1498,9 @@ class HomeCharacteristics:
     window_solar_heat_gain_coefficient: int
     can_close_curtains: bool
     smart_hvac_algorithm: bool
+    # Run the HVAC on the minimum-CO2 schedule from hvac_optimizer instead (overrides
+    # smart_hvac_algorithm)
+    optimal_hvac_algorithm: bool = False
 
     @property
     def building_volume_cu_m(self) -> int:
@@ -768,7 +1603,10 @@ def calculate_next_timestep(
         energy_from_sun_j *= 0.1
 
     # 4. Energy added or removed by the HVAC system (in Joules, J)
-    if home.smart_hvac_algorithm:
+    if home.optimal_hvac_algorithm:
+        hvac_mode, energy_from_hvac_j = optimal_hvac_algorithm(
+            timestamp, indoor_temperature_c, outdoor_temperature_c, home, lookahead_df, dt)
+    elif home.smart_hvac_algorithm:
         hvac_mode, energy_from_hvac_j = smart_hvac_algorithm(
             timestamp, indoor_temperature_c, outdoor_temperature_c, home, lookahead_df, dt)
     else:
@@ -851,6 +1689,8 @@ def smart_hvac_algorithm(timestamp, indoor_temperature_c, outdoor_temperature_c,
             # In fact we can get an exactly "correct" answer by predicting what our future
             # co2 cost of heating/cooling WOULD be if we don't heat/cool now, and compare
             # to current cost.
+            # (That's what optimal_hvac_algorithm / hvac_optimizer.py does, over the
+            # whole horizon.)
             if overdrive_heating_benefit > 2 and indoor_temperature_c < home.cooling_setpoint_c:
                 # don't overdrive heating above the point that would trigger cooling!
                 hvac_mode = "heating"
@@ -882,8 +1722,9 @@ def smart_hvac_algorithm(timestamp, indoor_temperature_c, outdoor_temperature_c,
 
         return (hvac_mode, energy_from_hvac_j)
 
-    # TODO: instead of just looking 2 hours ahead maybe a weighted average of
-    # 1 hour, 2 hours, 3 hours, 4 hours ahead?
+    # (model_one_house can also look at a weighted average of 1, 2, 3 and 4 hours
+    # ahead, see house_simulation.SMART_HVAC_LOOKAHEAD_KERNELS; this per-timestep
+    # version sticks to 2 hours.)
 
     # otherwise...
     # otherwise, follow normal algorithm.
@@ -892,9 +1733,19 @@ def smart_hvac_algorithm(timestamp, indoor_temperature_c, outdoor_temperature_c,
     
     
 
+def optimal_hvac_algorithm(timestamp, indoor_temperature_c, outdoor_temperature_c, home, lookahead_df, dt):
+    # The cheapest thing to do now, in pounds of CO2, given everything in lookahead_df is
+    # coming (see hvac_optimizer.py). The schedule is solved the first time a home and
+    # frame come through here, and reused for the rest of the timesteps.
+    policy = cached_optimal_hvac_policy(home, lookahead_df)
+    hvac_mode, energy_from_hvac_j = policy.decide(lookahead_df.index.get_loc(timestamp), indoor_temperature_c)
+    return (HVAC_MODE_NAMES[hvac_mode], energy_from_hvac_j)
+
+
 def fix_timestamp_index(df):
     # Fix incorrect index (result of cacheing)
-    # TODO - better way to do this is to check when reading CSV out of cache.
+    # Only needed for cache rows written in the old CSV format; frames from the binary
+    # cache format already come back with their DatetimeIndex.
 
     if isinstance( df.index, pd.core.indexes.range.RangeIndex):
         
@@ -907,36 +1758,89 @@ def fix_timestamp_index(df):
 
 
 
-def model_one_house(home, weather_with_co2_timeseries):
-    # Since we're starting in January, let's assume our starting temperature is the heating setpoint
-    previous_indoor_temperature_c = home.heating_setpoint_c
-
-    timesteps = []
-    delta_t = weather_with_co2_timeseries.index[1] - weather_with_co2_timeseries.index[0]
-
-    for timestamp in weather_with_co2_timeseries.index:
-        new_timestep = calculate_next_timestep(
-            timestamp=timestamp,
-            indoor_temperature_c=previous_indoor_temperature_c,
-            outdoor_temperature_c=weather_with_co2_timeseries.loc[timestamp].temp_air,
-            irradiance=weather_with_co2_timeseries.loc[timestamp].poa_direct,
-            home=home,
-            lookahead_df = weather_with_co2_timeseries,
-            dt = delta_t
+def get_weather_with_co2(latitude, longitude, ba, start_date, end_date, emission_factors=None):
+    """
+    Hourly weather (NREL PSM3, plus irradiance through south-facing windows) at latitude,
+    longitude joined with ba's hourly CO2 intensity, indexed by timestamp: the
+    weather_with_co2_timeseries that model_one_house takes.
+    """
+    historical_weather = get_historical_solar_weather(
+        start_date = start_date,
+        end_date = end_date,
+        latitude = latitude, longitude = longitude)
+    historical_weather = fix_timestamp_index(historical_weather)
+
+    window_irr = get_historical_window_irradiance(
+        start_date = start_date,
+        end_date = end_date,
+        latitude = latitude, longitude = longitude)
+    window_irr = fix_timestamp_index(window_irr)
+    historical_weather = historical_weather.join(window_irr)
+
+    corrected_intensity_by_hour = get_hourly_co2_intensity(ba, start_date=start_date, end_date=end_date,
+                                                           emission_factors=emission_factors)
+    corrected_intensity_by_hour["timestamp"] = as_local_timestamps(corrected_intensity_by_hour.timestamp)
+
+    # TODO: move consistency checks here.
+    # Local wall-clock hours on both sides. Built from whole columns rather than row by row,
+    # this used to be most of the time a (simulation cache hit) home_simulation_json took.
+    historical_weather["timestamp_hour_no_tz"] = pd.to_datetime(
+        historical_weather[["Year", "Month", "Day", "Hour"]].astype(int).rename(columns=str.lower))
+
+    intensity_timestamps = corrected_intensity_by_hour.timestamp
+    if isinstance(intensity_timestamps.dtype, pd.DatetimeTZDtype):
+        corrected_intensity_by_hour["timestamp_hour_no_tz"] = intensity_timestamps.dt.tz_localize(None).dt.floor("h")
+    else:
+        # Mixed UTC offsets (e.g. across a DST change) stay as objects
+        corrected_intensity_by_hour["timestamp_hour_no_tz"] = intensity_timestamps.apply(
+            lambda x: datetime.datetime(year=x.year, month=x.month, day=x.day, hour=x.hour)
         )
-        
-        timesteps.append(new_timestep)
-        previous_indoor_temperature_c = new_timestep["Indoor Temperature (C)"]
+
+    weather_with_co2 = historical_weather.merge(corrected_intensity_by_hour, how="inner", on="timestamp_hour_no_tz")
+    weather_with_co2.set_index("timestamp", inplace=True)
+    return weather_with_co2
+
+
+def model_one_house(home, weather_with_co2_timeseries, lookahead_kernel=None, solver="euler"):
+    # Since we're starting in January, let's assume our starting temperature is the heating setpoint.
+    # Same results as calling calculate_next_timestep for each timestep, but on arrays,
+    # see house_simulation.py. lookahead_kernel picks how far ahead a smart home looks
+    # (see house_simulation.smart_hvac_lookahead_kernel).
+    # solver "euler" steps like calculate_next_timestep does; "exact" follows the
+    # exponential the temperature takes within each step, so it stays accurate with
+    # e.g. weather_with_co2_timeseries.resample("3h").mean(); "three-node" splits the
+    # building into air, envelope and mass (see thermal_network.py), also exactly.
+    inputs = simulation_inputs(weather_with_co2_timeseries, lookahead_kernel)
+    if solver == "three-node":
+        outputs = simulate_house_three_node(home, inputs, initial_indoor_temperature_c=home.heating_setpoint_c)
+    else:
+        outputs = simulate_house(home, inputs, initial_indoor_temperature_c=home.heating_setpoint_c, solver=solver)
 
     # Estimate CO2 intensity of energy spent on HVAC depending on time of day.
+    return simulation_frame(inputs, outputs)
 
-    house_simulation = pd.DataFrame(timesteps)
 
-    house_simulation["pounds_co2"] = house_simulation["HVAC energy use (kWh)"] * house_simulation["pounds_co2_per_kwh"]
-    house_simulation["heat_xfer_from_outside"] = house_simulation['Conductive energy (J)'] + \
-        house_simulation['Air change energy (J)'] + house_simulation['Radiant energy (J)']
+def model_houses(homes, weather_with_co2_timeseries, lookahead_kernel=None, solver="euler"):
+    # model_one_house for any number of homes, stepped together over the same weather
+    # (see house_simulation.simulate_houses). Returns one frame per home.
+    inputs = simulation_inputs(weather_with_co2_timeseries, lookahead_kernel)
+    return simulation_frames(homes, inputs, solver=solver)
 
-    return house_simulation
+
+def simulation_frames(homes, inputs, solver="euler"):
+    # model_houses on already-built house_simulation.SimulationInputs
+    if solver == "three-node":
+        return [simulation_frame(inputs, simulate_house_three_node(home, inputs)) for home in homes]
+    outputs = simulate_houses(homes, inputs, solver=solver)
+    return [simulation_frame(inputs, outputs.for_home(home_number)) for home_number in range(len(homes))]
+
+
+def cached_model_houses(homes, weather_with_co2_timeseries, lookahead_kernel=None, solver="euler"):
+    # model_houses, but homes already simulated over the same inputs come from the
+    # simulation cache (see simulation_cache.py) and the rest are added to it
+    inputs = simulation_inputs(weather_with_co2_timeseries, lookahead_kernel)
+    return cached_simulation_frames(
+        homes, inputs, solver, lambda missing_homes: simulation_frames(missing_homes, inputs, solver=solver))
 
 
 def combine_house_simulation_with_co2_intensity(house_simulation, carbon_intensity):
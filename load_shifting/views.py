@@ -1,13 +1,11 @@
 from django.shortcuts import render
 from django.http import JsonResponse
-import pandas as pd
-from .utils import get_hourly_eia_net_demand_and_generation, get_hourly_eia_interchange, get_hourly_eia_grid_mix
-from .utils import compute_hourly_consumption_by_source_ba, compute_hourly_fuel_mix_after_import_export, cache_wrapped_hourly_gen_mix_by_ba_and_type
-from .utils import cache_wrapped_co2_boxplot_all_bas
-from .utils import get_historical_solar_weather, get_historical_window_irradiance, HomeCharacteristics, model_one_house
-from .utils import combine_house_simulation_with_co2_intensity, fix_timestamp_index
+from .utils import cache_wrapped_co2_boxplot_all_bas, all_balancing_authorities
+from .utils import rollup_co2_intensity_by_clock_hour, rollup_generation_by_clock_hour
+from .utils import HomeCharacteristics, cached_model_houses, get_weather_with_co2
+from .caching import frame_memory_cache
+from .emission_factors import default_emission_factors, emission_factor_table, UnknownEmissionFactors
 import datetime
-import json
 import re
 
 
@@ -26,17 +24,8 @@ def energy_mix_json(request):
     start_date = datetime.datetime(year=year, month=4, day=1)
     end_date = datetime.datetime(year=year, month=4, day=30)
 
-    hourly_usage = get_hourly_eia_grid_mix([ba], start_date = start_date, end_date = end_date)
-    hourly_usage["hour"] = pd.to_datetime(hourly_usage.period, format="ISO8601").apply(lambda x: x.hour)
-    print(hourly_usage["type-name"].unique())
-
-    # TODO: cache this data frame!!
-
-    usage_by_clock_hour = pd.DataFrame(data = {
-        "hour": hourly_usage.hour,
-        "fuel": hourly_usage["type-name"],
-        "mwh": hourly_usage["Generation (MWh)"]
-    }).groupby(["hour", "fuel"]).aggregate("sum").reset_index()
+    # Generation by clock hour and fuel, from the pre-aggregated rollups
+    usage_by_clock_hour = rollup_generation_by_clock_hour(ba, start_date = start_date, end_date = end_date)
 
     # Convert data frame to the JSON format expected by D3.js:
     json_data_series = []
@@ -55,37 +44,36 @@ def co2_intensity(request):
     return render(request, "load_shifting/co2.html", context)
 
 
-def co2_intensity_by_clock_hour(usage_df):
-    # Group df by hour, not caring about source BA, sum up emissions and divide by kwh
-    # to get a data frame of hourly tons-co2-per-kwh
-    corrected_intensity_by_hour = usage_df[["Usage (MWh)", "emissions", "timestamp"]].groupby(
-        ["timestamp"]).aggregate("sum").reset_index()
-
-    corrected_intensity_by_hour["pounds_co2_per_kwh"] = corrected_intensity_by_hour["emissions"] / (corrected_intensity_by_hour["Usage (MWh)"]*1000)
+def requested_emission_factors(request):
+    # ?factors=<table name> picks the emission factor table (see emission_factors.py).
+    # Raises UnknownEmissionFactors if there's no such table.
+    emission_factors = request.GET.get("factors") or default_emission_factors()
+    emission_factor_table(emission_factors)
+    return emission_factors
 
-    # Reduce to one data point per clock hour (e.g. avg of all 1-ams, avgs of all 2-ams, etc.)
-    corrected_intensity_by_hour["hour"] = pd.to_datetime(corrected_intensity_by_hour.timestamp).apply(lambda x: x.hour)
 
-    # Note we get different results here depending on whether we treat this avg as "all hours weighted equally" (current behavior)
-    # vs "all kwh weighted equally" (big kwh days matter more)
-    intensity_by_clock_hour = corrected_intensity_by_hour[["hour", "pounds_co2_per_kwh"]].groupby(["hour"]).aggregate("mean").reset_index()
-    return intensity_by_clock_hour
+def unknown_emission_factors_response(error):
+    return JsonResponse({"error": str(error)}, status=400)
 
 
-    
 def co2_intensity_json(request):
     # TODO get these 3 from the request:
     ba = "CISO"
     start_date = datetime.datetime(year=2024, month=4, day=1)
     end_date = datetime.datetime(year=2024, month=4, day=30)
+    try:
+        emission_factors = requested_emission_factors(request)
+    except UnknownEmissionFactors as e:
+        return unknown_emission_factors_response(e)
     
-    usage_df = cache_wrapped_hourly_gen_mix_by_ba_and_type(
-        ba_name=ba,
-        start_date=start_date,
-        end_date=end_date)
-
-    intensity_by_clock_hour = co2_intensity_by_clock_hour(usage_df)
-    json_data_series = intensity_by_clock_hour.to_dict("records")
+    # One data point per clock hour (e.g. avg of all 1-ams, avgs of all 2-ams, etc.), from the rollups.
+    # Note we get different results here depending on whether we treat this avg as "all hours weighted equally" (default)
+    # vs "all kwh weighted equally" (?weighting=kwh, big kwh days matter more)
+    intensity_by_clock_hour = rollup_co2_intensity_by_clock_hour(ba, start_date=start_date, end_date=end_date,
+                                                                 emission_factors=emission_factors)
+    mean_column = "kwh_weighted_mean" if request.GET.get("weighting") == "kwh" else "hours_weighted_mean"
+    intensity_by_clock_hour = intensity_by_clock_hour.rename(columns={mean_column: "pounds_co2_per_kwh"})
+    json_data_series = intensity_by_clock_hour[["hour", "pounds_co2_per_kwh"]].to_dict("records")
     return JsonResponse({"ba_stats": json_data_series})
 
 
@@ -102,11 +90,20 @@ def co2_intensity_boxplot_json(request):
     biggest_bas = ["CISO", "SWPP", "ERCO", "MISO", "TVA", "SOCO", "PJM", "NYIS", "ISNE"]
     start_date = datetime.datetime(year=2024, month=4, day=1)
     end_date = datetime.datetime(year=2024, month=4, day=30)
-
+    try:
+        emission_factors = requested_emission_factors(request)
+    except UnknownEmissionFactors as e:
+        return unknown_emission_factors_response(e)
+
+    # ?mode=grid traces flows through the whole grid at once, which makes it cheap to
+    # show every BA
+    grid_wide = request.GET.get("mode") == "grid"
     df = cache_wrapped_co2_boxplot_all_bas(
-        ba_names = biggest_bas, # all_of_bas,
+        ba_names = all_balancing_authorities() if grid_wide else biggest_bas,
         start_date = start_date,
-        end_date = end_date
+        end_date = end_date,
+        grid_wide = grid_wide,
+        emission_factors = emission_factors,
     )
 
     json_data_series = df.to_dict("records")
@@ -228,56 +225,21 @@ def home_simulation_json(request):
     start_date = datetime.datetime(year=2022, month=1, day=1)
     end_date = datetime.datetime(year=2022, month=12, day=31)
     
-    historical_weather_2022 = get_historical_solar_weather(
-        start_date = start_date,
-        end_date = end_date,
-        latitude = building_latitude, longitude = building_longitude)
-    historical_weather_2022 = fix_timestamp_index(historical_weather_2022)
-    
-    window_irr_2022 = get_historical_window_irradiance(
-        start_date = start_date,
-        end_date = end_date,
-        latitude = building_latitude, longitude = building_longitude)
-    window_irr_2022 = fix_timestamp_index(window_irr_2022)
-    historical_weather_2022 = historical_weather_2022.join(window_irr_2022)
-    
     ba = "CISO" # TODO get from address or lat/lon.
-    usage_df = cache_wrapped_hourly_gen_mix_by_ba_and_type(
-        ba_name=ba,
-        start_date=start_date,
-        end_date=end_date)
-
-    corrected_intensity_by_hour = usage_df[["Usage (MWh)", "emissions", "timestamp"]].groupby(
-        ["timestamp"]).aggregate("sum").reset_index()
-
-    corrected_intensity_by_hour["pounds_co2_per_kwh"] = corrected_intensity_by_hour["emissions"] / (corrected_intensity_by_hour["Usage (MWh)"]*1000)
-    corrected_intensity_by_hour["timestamp"] = pd.to_datetime(corrected_intensity_by_hour.timestamp)
-
-    # TODO: move consistency checks here.
-    historical_weather_2022["timestamp_hour_no_tz"] = historical_weather_2022.apply(
-        lambda row: datetime.datetime(year=int(row["Year"]), month=int(row["Month"]), day=int(row["Day"]), hour=int(row["Hour"])),
-        axis=1
-    )
-    
-    corrected_intensity_by_hour["timestamp_hour_no_tz"] = corrected_intensity_by_hour.timestamp.apply(
-        lambda x: datetime.datetime(year=x.year, month=x.month, day=x.day, hour=x.hour)
-    )
-
-    weather_with_co2_2022 = historical_weather_2022.merge(corrected_intensity_by_hour, how="inner", on="timestamp_hour_no_tz")
-    weather_with_co2_2022.set_index("timestamp", inplace=True)
-
-    # TODO maybe make this a loop through an arbitrary number of houses:
-    print("Simulating old house")
-    old_house_simulation = model_one_house(
-        old_home, weather_with_co2_2022)
+    try:
+        emission_factors = requested_emission_factors(request)
+    except UnknownEmissionFactors as e:
+        return unknown_emission_factors_response(e)
+    weather_with_co2_2022 = get_weather_with_co2(building_latitude, building_longitude, ba, start_date, end_date,
+                                                 emission_factors=emission_factors)
+
+    # All the houses are stepped through the year together (model_houses takes any number).
+    # The inputs don't change between page loads, so this is normally a cache hit, see
+    # simulation_cache.py
+    old_house_simulation, new_house_simulation, smart_house_simulation = cached_model_houses(
+        [old_home, new_home, smart_home], weather_with_co2_2022)
     print("Old house total CO2 for year: {}".format( old_house_simulation["pounds_co2"].sum()))
-    print("Simulating new house")
-    new_house_simulation = model_one_house(
-        new_home, weather_with_co2_2022)
     print("New house total CO2 for year: {}".format( new_house_simulation["pounds_co2"].sum()))
-    print("Simulating smart house")
-    smart_house_simulation = model_one_house(
-        smart_home, weather_with_co2_2022)
     print("Smart house total CO2 for year: {}".format( smart_house_simulation["pounds_co2"].sum()))
     
 
@@ -330,6 +292,11 @@ def home_simulation_json(request):
 
 
 
+def cache_stats_json(request):
+    # Stats for the in-memory cache tier of whichever worker process served this request
+    return JsonResponse({"memory_cache": frame_memory_cache.stats()})
+
+
 def home_simulation(request):
     context = { "debug": "" }
     return render(request, "load_shifting/home_simulation.html", context)